@@ -0,0 +1,112 @@
+"""
+قياس أداء format_order_data (تصفية الأنماط بالكلمة الثابتة) مقابل الحلقة القديمة على re.search
+
+    python benchmarks/bench_format.py
+    python benchmarks/bench_format.py --orders 5000 --repeat 5
+
+يتم توليد نصوص طلبات عربية/إنجليزية واقعية (أسطر متعددة وسطر واحد بفواصل)،
+والتأكد أولاً أن الطريقتين تعطيان نفس النتيجة لكل نص
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+
+def legacy_format_free_text(order_data):
+    # نسخة من التنفيذ السابق: حلقة على كل الأنماط مع re.search لكل سطر
+    formatted_lines = []
+    lines = order_data.split('\n')
+    if len(lines) == 1:
+        lines = re.split(r'[،,;|]', order_data)
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        matched = False
+        for emoji, pattern_list in main.ORDER_FIELD_PATTERNS.items():
+            for pattern in pattern_list:
+                match = re.search(pattern, line, re.IGNORECASE)
+                if match:
+                    formatted_lines.append(f"{emoji} {match.group(1).strip()}")
+                    matched = True
+                    break
+            if matched:
+                break
+        if not matched:
+            formatted_lines.append(f"📌 {line}")
+    return "\n".join(formatted_lines)
+
+
+NAMES = ["محمد أحمد", "Sara Ali", "عبد الرحمن", "Youssef", "منى حسن", "Omar Khaled"]
+WALLETS = ["فودافون كاش 01012345678", "InstaPay ali@instapay", "اتصالات كاش", "Orange Cash"]
+LINE_TEMPLATES = [
+    "العميل {name}", "Name: {name}", "اسم {name}",
+    "تليجرام @{user}", "username {user}", "تواصل @{user}",
+    "شفــت {shift}", "Agent {shift}", "Product USDT",
+    "سعـر البيـع {price}", "Price {price}", "PriceIN {price}",
+    "المبلـغ {amount}", "Amount {amount} EGP", "much2 {amount}",
+    "جنيـه {wallet}", "PaidBy {wallet}", "طريقة الدفع فودافون",
+    "رقم/اسم المحفظـة {wallet}", "Wallet {wallet}", "CashControl {wallet}",
+    "الإيصـال https://short.url/{code}", "Receipt https://short.url/{code}",
+    "الرصيــد {amount}", "Balance {amount}", "$ {amount}",
+    "منصة Binance", "Platform Bybit", "ORDER {code}", "ID {code}", "redid {code}",
+    "ملاحظة العميل مستعجل", "Note please hurry", "شكراً لكم", "see attached screenshot",
+    "تم التحويل من حساب آخر", "------", "{amount}",
+]
+
+
+def build_corpus(orders, seed=7):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(orders):
+        values = {
+            'name': rng.choice(NAMES), 'user': f"user{rng.randint(1, 9999)}", 'shift': rng.choice(["A", "B", "ليلي"]),
+            'price': f"{rng.uniform(45, 55):.2f}", 'amount': rng.randint(100, 50000), 'wallet': rng.choice(WALLETS),
+            'code': f"{rng.randint(10 ** 7, 10 ** 8)}",
+        }
+        lines = [rng.choice(LINE_TEMPLATES).format(**values) for _ in range(rng.randint(6, 30))]
+        # ثلث الطلبات ملصوقة في سطر واحد بفواصل
+        corpus.append("، ".join(lines) if rng.random() < 0.33 else "\n".join(lines))
+    return corpus
+
+
+def timed(fn, corpus, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for text in corpus:
+            fn(text)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.orders)
+    mismatches = sum(1 for text in corpus if legacy_format_free_text(text) != main.format_order_data(text))
+    if mismatches:
+        print(f"❌ {mismatches} order(s) formatted differently from the legacy implementation")
+        sys.exit(1)
+
+    lines = sum(len(text.splitlines()) or text.count("،") + 1 for text in corpus)
+    legacy = timed(legacy_format_free_text, corpus, args.repeat)
+    compiled = timed(main.format_order_data, corpus, args.repeat)
+    print(f"orders: {len(corpus)}, lines: ~{lines}, identical output: yes")
+    print(f"legacy re.search loop: {legacy * 1000:8.1f} ms ({legacy / len(corpus) * 1e6:7.1f} us/order)")
+    print(f"keyword prefilter:     {compiled * 1000:8.1f} ms ({compiled / len(corpus) * 1e6:7.1f} us/order)")
+    print(f"speedup: {legacy / compiled:.1f}x")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,84 @@
+"""
+قياس زمن استعادة حالة الطلبات من الـ journal مقابل حجمه
+
+    python benchmarks/bench_journal.py
+    python benchmarks/bench_journal.py --sizes 1000 10000 100000 --active 500
+
+لكل حجم يتم توليد دورة حياة طلبات واقعية (طلب، تنبيه تأخر، صورة، تنفيذ)
+ثم قياس الاستعادة مرتين: من journal كامل بدون ضغط، ومن snapshot بعد الضغط
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+
+def write_journal(directory, entries, active):
+    journal = main.StateJournal(directory, compact_every=10 ** 12)
+    store = main.MemoryStateStore({}, {}, journal)
+    now = datetime.now()
+    written = 0
+    order = 0
+    while written < entries:
+        contact_id = f"contact-{order}"
+        store.record_message(contact_id, "order", order, "telegram", now)
+        written += 1
+        if order % 5 == 0:
+            store.record_message(contact_id, "delay", order + 1, "telegram", now)
+            written += 1
+        if order % 7 == 0:
+            store.set_pending_photo(f"-100{order}", {'contact_id': contact_id, 'channel': 'telegram',
+                                                     'scenario': 'order', 'request_message_id': order})
+            store.pop_pending_photo(f"-100{order}")
+            written += 2
+        # نترك آخر active طلب مفتوحاً والباقي يتم تنفيذه
+        if order >= active:
+            finished = f"contact-{order - active}"
+            store.remove_message(finished, "order")
+            store.remove_message(finished, "delay")
+            written += 2
+        order += 1
+    journal.close()
+    return store
+
+
+def measure_restore(directory):
+    # الـ journal يحجز المجلد، لذلك كل استعادة تغلقه بعد القياس
+    started = time.perf_counter()
+    store = main.MemoryStateStore({}, {}, main.StateJournal(directory))
+    elapsed = time.perf_counter() - started
+    store.journal.close()
+    return elapsed, store.count(), store
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 500000])
+    parser.add_argument("--active", type=int, default=200, help="number of orders still open at the end")
+    args = parser.parse_args()
+
+    main.logger.setLevel("WARNING")
+    print(f"{'entries':>10} {'journal MB':>11} {'replay s':>10} {'snapshot s':>11} {'contacts':>9}")
+    for size in args.sizes:
+        directory = tempfile.mkdtemp(prefix="ordertaker-journal-")
+        try:
+            store = write_journal(directory, size, args.active)
+            journal_mb = os.path.getsize(store.journal.journal_path) / 1e6
+            replay_seconds, contacts, restored = measure_restore(directory)
+
+            restored.journal.compact()
+            snapshot_seconds, _, _ = measure_restore(directory)
+            print(f"{size:>10} {journal_mb:>11.2f} {replay_seconds:>10.3f} {snapshot_seconds:>11.4f} {contacts:>9}")
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main_bench()
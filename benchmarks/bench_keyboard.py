@@ -0,0 +1,110 @@
+"""
+قياس زمن وذاكرة بناء payload رسالة الجروب: القوالب المرمّزة مسبقاً مقابل البناء الكامل لكل رسالة
+
+    python benchmarks/bench_keyboard.py
+    python benchmarks/bench_keyboard.py --calls 200000
+
+الطريقة القديمة تبني القواميس المتداخلة للأزرار ثم يرمّزها requests بـ json.dumps،
+والجديدة تملأ contact_id و channel في قالب JSON جاهز. يتم التأكد أولاً أن الناتج متطابق
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main  # noqa: E402
+
+GROUP_ID = "-1001234567890"
+MESSAGE = "✈️ 📩 <b>طلب جديد</b>\n👤 العميل محمد أحمد\n💵 المبلـغ 1500\n🆔 98765432"
+
+
+def legacy_payload(message, contact_id, channel, scenario):
+    # نسخة من التنفيذ السابق + الترميز الذي كان يقوم به requests (json=payload)
+    sendpulse_url = f"https://login.sendpulse.com/chatbots/chats?contact_id={contact_id}&channel={channel}"
+    keyboard = {"inline_keyboard": []}
+    if scenario == "delay":
+        keyboard["inline_keyboard"] = [
+            [{"text": "📷 إرسال صورة", "callback_data": f"sendpic:{contact_id}:{channel}:delay"}],
+            [{"text": "💬 فتح المحادثة", "url": sendpulse_url}]
+        ]
+    elif scenario == "photo":
+        keyboard["inline_keyboard"] = [
+            [{"text": "📷 إرسال صورة", "callback_data": f"sendpic:{contact_id}:{channel}:photo"}]
+        ]
+    else:
+        keyboard["inline_keyboard"] = [
+            [
+                {"text": "✅ تم التنفيذ", "callback_data": f"done:{contact_id}:{channel}:order"},
+                {"text": "❌ إلغاء", "callback_data": f"cancel:{contact_id}:{channel}:order"},
+            ],
+            [{"text": "📷 إرسال صورة", "callback_data": f"sendpic:{contact_id}:{channel}:order"}],
+            [
+                {"text": "🔄 تحويل ناقص", "callback_data": f"transfer_minus:{contact_id}:{channel}"},
+                {"text": "🔄 تحويل زائد", "callback_data": f"transfer_plus:{contact_id}:{channel}"}
+            ],
+            [{"text": "💬 فتح المحادثة", "url": sendpulse_url}]
+        ]
+    payload = {"chat_id": GROUP_ID, "text": message, "parse_mode": "HTML", "reply_markup": keyboard}
+    return json.dumps(payload, allow_nan=False).encode("utf-8")
+
+
+def template_payload(message, contact_id, channel, scenario):
+    # نفس خطوات send_scenario_message_to_telegram الحالية
+    keyboard = main.KEYBOARD_TEMPLATES.get(scenario, main.KEYBOARD_TEMPLATES["order"])
+    body = main.SCENARIO_PAYLOAD_TEMPLATE % (
+        main.json_dumps(GROUP_ID),
+        main.json_dumps(message),
+        keyboard.render(contact_id, channel)
+    )
+    return body.encode("utf-8")
+
+
+def run(fn, calls):
+    scenarios = ["order", "order", "order", "delay", "photo"]
+    started = time.perf_counter()
+    for i in range(calls):
+        fn(MESSAGE, f"6856d410b7a0{i:08d}", "telegram", scenarios[i % 5])
+    return time.perf_counter() - started
+
+
+def peak_bytes_per_call(fn, samples=200):
+    peaks = []
+    for i in range(samples):
+        tracemalloc.start()
+        fn(MESSAGE, f"contact{i}", "messenger", "order")
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return sum(peaks) / len(peaks)
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=50000)
+    args = parser.parse_args()
+
+    main.logger.setLevel("WARNING")
+
+    for scenario in ["order", "delay", "photo", "unknown"]:
+        for contact_id in ["abc123", 'quote"and\\slash', "عميل"]:
+            expected = json.loads(legacy_payload(MESSAGE, contact_id, "telegram", scenario))
+            actual = json.loads(template_payload(MESSAGE, contact_id, "telegram", scenario))
+            if expected != actual:
+                print(f"❌ payload mismatch for scenario={scenario} contact_id={contact_id!r}")
+                sys.exit(1)
+
+    legacy = run(legacy_payload, args.calls)
+    templated = run(template_payload, args.calls)
+    print(f"json encoder: {'orjson' if main.orjson else 'stdlib json'}, calls: {args.calls}, identical payloads: yes")
+    print(f"legacy dict build + json.dumps: {legacy / args.calls * 1e6:6.2f} us/call, "
+          f"peak {peak_bytes_per_call(legacy_payload):7.0f} B/call, body {len(legacy_payload(MESSAGE, 'c', 'telegram', 'order'))} B")
+    print(f"precomputed template:           {templated / args.calls * 1e6:6.2f} us/call, "
+          f"peak {peak_bytes_per_call(template_payload):7.0f} B/call, body {len(template_payload(MESSAGE, 'c', 'telegram', 'order'))} B")
+    print(f"speedup: {legacy / templated:.1f}x")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,223 @@
+"""
+اختبار حمل OrderTaker مقابل سيرفرات Telegram/SendPulse المحلية (بدون إنترنت)
+
+    python benchmarks/bench_load.py
+    python benchmarks/bench_load.py --rate 200 --duration 30 --latency-ms 80 --rate-429 0.02
+    python benchmarks/bench_load.py --server flask --env OUTBOUND_WORKERS=8
+    python benchmarks/bench_load.py --mode async --rate 200
+
+يتم تشغيل التطبيق في process منفصل (gunicorn افتراضياً كما في الـ procfile) موجّه إلى الـ stubs،
+ثم إرسال طلبات /webhook (طلبات جديدة) و /telegram (ضغط أزرار) بمعدل ثابت (open loop)
+والتقرير: p50/p95/p99 لكل route، الطلبات في الثانية، وعدد الاتصالات الخارجية لكل طلب
+"""
+import argparse
+import itertools
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_servers import StubConfig, start_stub_servers, stub_environment  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# حدود تليجرام الحقيقية (20 رسالة/دقيقة للجروب) تجعل الطابور هو عنق الزجاجة، لذلك نرفعها افتراضياً
+DEFAULT_APP_ENV = {
+    "TELEGRAM_GLOBAL_RATE": "100000",
+    "TELEGRAM_CHAT_RATE_PER_MINUTE": "6000000",
+    "TELEGRAM_CHAT_BURST": "100000",
+    "DELETE_BATCH_WINDOW": "0.2",
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_app(server, mode, port, env, gunicorn_args):
+    env = dict(env, SERVING_MODE=mode)
+    if server == "gunicorn":
+        command = ["gunicorn", "main:app", "--bind", f"127.0.0.1:{port}", "--timeout", "120"] + gunicorn_args
+        if mode == "async":
+            command += ["-k", "gevent", "--worker-connections", "1000"]
+    else:
+        command = [sys.executable, "main.py"]
+    log = open(os.path.join(ROOT, "benchmarks", "bench_load_app.log"), "w")
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"❌ App exited with code {process.returncode}, see benchmarks/bench_load_app.log")
+        try:
+            if requests.get(f"{base_url}/health", timeout=1).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise SystemExit("❌ App did not become healthy within 30s")
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class LoadGenerator:
+    """
+    إرسال الطلبات بمعدل ثابت بغض النظر عن زمن الرد (open loop) حتى لا يخفي البطء التأخير الحقيقي
+    """
+
+    def __init__(self, base_url, concurrency, callback_ratio):
+        self.base_url = base_url
+        self.callback_ratio = callback_ratio
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.local = threading.local()
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+        self.latencies = {"/webhook": [], "/telegram": []}
+        self.statuses = {}
+        self.orders = []   # contact_ids المرسلة لاستخدامها في ضغط الأزرار
+
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def next_request(self):
+        n = next(self.counter)
+        with self.lock:
+            contact_id = self.orders[n % len(self.orders)] if self.orders else None
+        # نسبة ثابتة من الطلبات ضغط أزرار على طلبات سابقة، والباقي طلبات جديدة
+        if contact_id and (n % 100) < self.callback_ratio * 100:
+            action = ("done", "cancel", "transfer_plus", "transfer_minus")[n % 4]
+            update = {
+                "update_id": n,
+                "callback_query": {
+                    "id": f"cb{n}",
+                    "from": {"id": 1, "first_name": "Bench"},
+                    "message": {"chat": {"id": -1001000000000}, "message_id": 1000 + n},
+                    "data": f"{action}:{contact_id}:telegram:order" if action in ("done", "cancel") else f"{action}:{contact_id}:telegram",
+                },
+            }
+            return "/telegram", update
+        contact_id = f"bench{n:08d}"
+        with self.lock:
+            self.orders.append(contact_id)
+        order = {
+            "contact_id": contact_id,
+            "channel": "telegram",
+            "scenario": "order",
+            "neworder": f"العميل Bench {n}\nالمبلـغ {n % 5000 + 100}\nطريقة الدفع فودافون كاش\nID {n}",
+        }
+        return "/webhook", order
+
+    def send(self, route, payload):
+        started = time.perf_counter()
+        try:
+            status = self.session().post(f"{self.base_url}{route}", json=payload, timeout=30).status_code
+        except requests.RequestException:
+            status = "error"
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latencies[route].append(elapsed)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def run(self, rate, duration):
+        interval = 1.0 / rate
+        started = time.perf_counter()
+        futures = []
+        sent = 0
+        while True:
+            scheduled = started + sent * interval
+            if scheduled - started >= duration:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(self.executor.submit(self.send, *self.next_request()))
+            sent += 1
+        for future in futures:
+            future.result()
+        return time.perf_counter() - started
+
+
+def wait_for_dispatch_drain(base_url, timeout=30):
+    # الإرسال إلى الجروب يتم في الخلفية: ننتظر فراغ الطابور قبل عد الاتصالات الخارجية
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            text = requests.get(f"{base_url}/metrics", timeout=5).text
+            depth = [line for line in text.splitlines() if line.startswith("ordertaker_dispatch_queue_depth ")]
+            if depth and float(depth[0].split()[1]) == 0:
+                time.sleep(1)
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=50, help="target requests per second")
+    parser.add_argument("--duration", type=float, default=15, help="seconds of load")
+    parser.add_argument("--concurrency", type=int, default=64, help="max in-flight client requests")
+    parser.add_argument("--callback-ratio", type=float, default=0.3, help="share of /telegram button presses")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--server", choices=["gunicorn", "flask"], default="gunicorn")
+    parser.add_argument("--mode", choices=["sync", "async"], default="sync", help="SERVING_MODE of the app")
+    parser.add_argument("--gunicorn-args", default="", help='extra gunicorn arguments, e.g. "-w 4 --threads 8"')
+    parser.add_argument("--env", action="append", default=[], help="extra KEY=VALUE for the app process")
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_429, seed=1)
+    telegram, sendpulse = start_stub_servers(config)
+
+    port = free_port()
+    env = dict(os.environ, **DEFAULT_APP_ENV, **stub_environment(telegram, sendpulse), PORT=str(port))
+    env.update(item.split("=", 1) for item in args.env)
+    process, base_url = start_app(args.server, args.mode, port, env, args.gunicorn_args.split())
+
+    try:
+        generator = LoadGenerator(base_url, args.concurrency, args.callback_ratio)
+        elapsed = generator.run(args.rate, args.duration)
+        wait_for_dispatch_drain(base_url)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+    total = sum(len(values) for values in generator.latencies.values())
+    orders = len(generator.latencies["/webhook"])
+    telegram_calls = telegram.snapshot()
+    sendpulse_calls = sendpulse.snapshot()
+    outbound = sum(telegram_calls.values()) + sum(sendpulse_calls.values())
+
+    print(f"server: {args.server} ({args.mode}) {args.gunicorn_args}".rstrip())
+    print(f"stub latency: {args.latency_ms}±{args.jitter_ms} ms, errors: {args.error_rate:.1%}, 429: {args.rate_429:.1%}")
+    print(f"requests: {total} in {elapsed:.1f}s = {total / elapsed:.1f} req/s (target {args.rate:g}), statuses: {generator.statuses}")
+    print(f"{'route':<10} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for route, values in generator.latencies.items():
+        print(f"{route:<10} {len(values):>7} {percentile(values, 0.5) * 1000:>8.1f} {percentile(values, 0.95) * 1000:>8.1f} "
+              f"{percentile(values, 0.99) * 1000:>8.1f} {max(values, default=0) * 1000:>8.1f}")
+    print(f"outbound calls: {outbound} ({outbound / max(orders, 1):.2f} per order)")
+    print(f"  telegram:  {dict(sorted(telegram_calls.items()))}")
+    print(f"  sendpulse: {dict(sorted(sendpulse_calls.items()))}")
+
+
+if __name__ == "__main__":
+    main()
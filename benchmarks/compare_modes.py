@@ -0,0 +1,118 @@
+"""
+التأكد أن وضع async (gevent) يعطي نفس الاتصالات الخارجية ونفس الردود التي يعطيها وضع sync
+
+    python benchmarks/compare_modes.py
+    python benchmarks/compare_modes.py --rate 100 --duration 10
+    python benchmarks/compare_modes.py --env STATE_BACKEND=sqlite --env STATE_SQLITE_PATH=/tmp/compare.db
+
+يتم تشغيل نفس الحمل (نفس الطلبات بنفس الترتيب) على التطبيق مرة في كل وضع مقابل stubs جديدة بدون أخطاء،
+ثم مقارنة عدد الاتصالات لكل method في Telegram و SendPulse وتوزيع الردود لكل route.
+يرجع exit code 1 عند أي اختلاف
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_load import DEFAULT_APP_ENV, LoadGenerator, free_port, start_app, wait_for_dispatch_drain  # noqa: E402
+from stub_servers import StubConfig, start_stub_servers, stub_environment  # noqa: E402
+
+# رسائل التأكيد تُمسح بعد 5 ثواني: ننتظرها قبل عد الاتصالات حتى يدخل deleteMessage في المقارنة
+DELETE_SETTLE_SECONDS = 7
+
+
+class RecordingLoadGenerator(LoadGenerator):
+    """
+    نفس LoadGenerator مع تسجيل (route، كود HTTP، حقل status أو method في الرد) لكل طلب
+    job_id وقيم الوقت تختلف بين التشغيلات لذلك لا تدخل في المقارنة
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.responses = Counter()
+
+    def send(self, route, payload):
+        try:
+            response = self.session().post(f"{self.base_url}{route}", json=payload, timeout=30)
+            body = response.json()
+            outcome = (route, response.status_code, body.get("status") or body.get("method"))
+        except (requests.RequestException, ValueError):
+            outcome = (route, "error", None)
+        with self.lock:
+            self.responses[outcome] += 1
+
+
+def run_mode(mode, args):
+    config = StubConfig(args.latency_ms, args.jitter_ms, seed=1)
+    telegram, sendpulse = start_stub_servers(config)
+
+    port = free_port()
+    env = dict(os.environ, **DEFAULT_APP_ENV, **stub_environment(telegram, sendpulse), PORT=str(port))
+    env.update(item.split("=", 1) for item in args.env)
+    process, base_url = start_app(args.server, mode, port, env, args.gunicorn_args.split())
+
+    try:
+        generator = RecordingLoadGenerator(base_url, args.concurrency, args.callback_ratio)
+        generator.run(args.rate, args.duration)
+        wait_for_dispatch_drain(base_url)
+        time.sleep(DELETE_SETTLE_SECONDS)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+        telegram.shutdown()
+        sendpulse.shutdown()
+
+    outbound = Counter({f"telegram:{method}": count for method, count in telegram.snapshot().items()})
+    outbound.update({f"sendpulse:{method}": count for method, count in sendpulse.snapshot().items()})
+    # long polling يعتمد على الوقت فقط وليس على الحمل
+    outbound.pop("telegram:getUpdates", None)
+    # تجميع المسح في دفعات يعتمد على التوقيت: نقارن عدد الرسائل الممسوحة وليس عدد الاتصالات
+    outbound["telegram:deleted messages"] = (outbound.pop("telegram:deleteMessage", 0)
+                                             + outbound.pop("telegram:deleteMessages.message_ids", 0))
+    outbound.pop("telegram:deleteMessages", None)
+    return outbound, generator.responses
+
+
+def print_diff(title, sync_counts, async_counts):
+    keys = sorted(set(sync_counts) | set(async_counts), key=str)
+    mismatches = [key for key in keys if sync_counts.get(key, 0) != async_counts.get(key, 0)]
+    print(f"{title}: {'identical' if not mismatches else f'{len(mismatches)} mismatches'}")
+    print(f"  {'key':<50} {'sync':>7} {'async':>7}")
+    for key in keys:
+        marker = "  ❌" if key in mismatches else ""
+        print(f"  {str(key):<50} {sync_counts.get(key, 0):>7} {async_counts.get(key, 0):>7}{marker}")
+    return not mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=50, help="target requests per second")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of load per mode")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--callback-ratio", type=float, default=0.3)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--server", choices=["gunicorn", "flask"], default="gunicorn")
+    parser.add_argument("--gunicorn-args", default="", help="extra gunicorn arguments for both modes")
+    parser.add_argument("--env", action="append", default=[], help="extra KEY=VALUE for the app process")
+    args = parser.parse_args()
+
+    results = {}
+    for mode in ("sync", "async"):
+        print(f"running {mode} mode...")
+        results[mode] = run_mode(mode, args)
+
+    (sync_outbound, sync_responses), (async_outbound, async_responses) = results["sync"], results["async"]
+    same_outbound = print_diff("outbound calls", sync_outbound, async_outbound)
+    same_responses = print_diff("responses (route, http status, status)", sync_responses, async_responses)
+    if not (same_outbound and same_responses):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
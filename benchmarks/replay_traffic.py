@@ -0,0 +1,140 @@
+"""
+إعادة تشغيل طلبات /webhook و /telegram المسجلة (TRAFFIC_RECORD_PATH) على نسخة OrderTaker
+
+    python benchmarks/replay_traffic.py traffic.jsonl --target http://127.0.0.1:5000
+    python benchmarks/replay_traffic.py traffic.jsonl --target http://127.0.0.1:5000 --speed 5
+
+يحافظ على الفروق الزمنية الأصلية بين الطلبات مقسومة على --speed
+لكل تشغيل يتم إزاحة update_id وإضافة لاحقة ثابتة إلى contact_id (في /webhook وفي callback_data بنفس الشكل)
+حتى لا تعتبر ذاكرة منع التكرار (update_id وبصمة محتوى /webhook لمدة IDEMPOTENCY_TTL) الطلبات مكررة
+وترد من الـ cache بدون اتصالات خارجية. --keep-ids يرسل الطلبات كما سُجلت (التكرار المسجل من SendPulse
+يُعامل كتكرار حقيقي، وإعادة التشغيل على نفس النسخة خلال IDEMPOTENCY_TTL تحتاج IDEMPOTENCY_TTL=0)
+"""
+import argparse
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_load import percentile  # noqa: E402
+
+
+def load_recording(path):
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    # الأسطر من عدة workers قد لا تكون مرتبة تماماً
+    entries.sort(key=lambda entry: entry["t"])
+    return entries
+
+
+def describe_mix(entries):
+    mix = Counter()
+    for entry in entries:
+        body = entry["body"]
+        if entry["route"] == "/webhook":
+            mix[f"webhook:{body.get('scenario', 'order')}"] += 1
+        elif "callback_query" in body:
+            mix[f"telegram:{body['callback_query'].get('data', '').split(':')[0]}"] += 1
+        elif "photo" in body.get("message", {}):
+            mix["telegram:photo"] += 1
+        else:
+            mix["telegram:other"] += 1
+    return mix
+
+
+def vary_body(body, id_offset, contact_suffix):
+    """
+    نسخة من الطلب بـ update_id مزاح و contact_id بلاحقة التشغيل
+    نفس contact_id يأخذ نفس اللاحقة في /webhook و callback_data فتبقى الأزرار مرتبطة بطلباتها
+    """
+    if id_offset and "update_id" in body:
+        body = dict(body, update_id=body["update_id"] + id_offset)
+    if not contact_suffix:
+        return body
+    if body.get("contact_id"):
+        body = dict(body, contact_id=f"{body['contact_id']}{contact_suffix}")
+    callback = body.get("callback_query")
+    if callback and isinstance(callback.get("data"), str):
+        parts = callback["data"].split(":")
+        if len(parts) > 1:
+            parts[1] += contact_suffix
+            body = dict(body, callback_query=dict(callback, data=":".join(parts)))
+    return body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording")
+    parser.add_argument("--target", default="http://127.0.0.1:5000")
+    parser.add_argument("--speed", type=float, default=1.0, help="N for N× speed")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--keep-ids", action="store_true",
+                        help="send the recorded update_id and contact_id values unchanged")
+    args = parser.parse_args()
+
+    entries = load_recording(args.recording)
+    if not entries:
+        raise SystemExit("❌ Recording is empty")
+
+    span = entries[-1]["t"] - entries[0]["t"]
+    print(f"{len(entries)} requests recorded over {span:.1f}s, replaying at {args.speed:g}× (~{span / args.speed:.1f}s)")
+    print(f"mix: {dict(describe_mix(entries).most_common())}")
+
+    id_offset = 0 if args.keep_ids else int(time.time() * 1000) % 10 ** 9 * 1000
+    contact_suffix = "" if args.keep_ids else f"-r{secrets.token_hex(3)}"
+    local = threading.local()
+    lock = threading.Lock()
+    latencies = {"/webhook": [], "/telegram": []}
+    statuses = Counter()
+    lateness = []
+
+    def send(entry, scheduled):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        body = vary_body(entry["body"], id_offset, contact_suffix)
+        started = time.perf_counter()
+        try:
+            status = local.session.post(f"{args.target}{entry['route']}", json=body, timeout=30).status_code
+        except requests.RequestException:
+            status = "error"
+        with lock:
+            latencies.setdefault(entry["route"], []).append(time.perf_counter() - started)
+            lateness.append(started - scheduled)
+            statuses[status] += 1
+
+    executor = ThreadPoolExecutor(max_workers=args.concurrency)
+    first = entries[0]["t"]
+    started = time.perf_counter()
+    futures = []
+    for entry in entries:
+        scheduled = started + (entry["t"] - first) / args.speed
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        futures.append(executor.submit(send, entry, scheduled))
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - started
+
+    print(f"sent {len(entries)} in {elapsed:.1f}s = {len(entries) / elapsed:.1f} req/s, statuses: {dict(statuses)}")
+    print(f"schedule lateness p99: {percentile(lateness, 0.99) * 1000:.1f} ms")
+    print(f"{'route':<10} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, values in latencies.items():
+        print(f"{route:<10} {len(values):>7} {percentile(values, 0.5) * 1000:>8.1f} "
+              f"{percentile(values, 0.95) * 1000:>8.1f} {percentile(values, 0.99) * 1000:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
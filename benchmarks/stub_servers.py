@@ -0,0 +1,240 @@
+"""
+سيرفرات محلية تحاكي Telegram Bot API و SendPulse وخدمة رفع الصور لقياس الأداء بدون إنترنت
+
+    python benchmarks/stub_servers.py --latency-ms 80 --error-rate 0.01 --rate-429 0.02
+
+تُستخدم من bench_load.py داخل نفس الـ process، أو تشغيلها منفردة ثم توجيه OrderTaker إليها:
+    TELEGRAM_API_URL=http://127.0.0.1:8081 SENDPULSE_API_URL=http://127.0.0.1:8082 \\
+    PHOTO_UPLOAD_URL=http://127.0.0.1:8082/upload python main.py
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# صورة JPEG صغيرة ثابتة لـ /file/bot<token>/...
+STUB_PHOTO = b"\xff\xd8\xff\xe0" + b"\x00" * 20000 + b"\xff\xd9"
+
+
+class StubConfig:
+    """
+    إعدادات السلوك المشتركة بين السيرفرات
+    latency_ms ± jitter_ms لكل طلب، error_rate نسبة ردود 500، rate_429 نسبة ردود 429 مع retry_after
+    """
+
+    def __init__(self, latency_ms=50, jitter_ms=20, error_rate=0.0, rate_429=0.0, retry_after=1, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def draw(self):
+        with self.lock:
+            delay = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            roll = self.random.random()
+        if roll < self.rate_429:
+            return delay, 429
+        if roll < self.rate_429 + self.error_rate:
+            return delay, 500
+        return delay, 200
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, config):
+        super().__init__(address, handler)
+        self.config = config
+        self.calls = Counter()   # method → عدد الطلبات
+        self.calls_lock = threading.Lock()
+        # بعيداً عن message_id التي يستخدمها bench_load في ضغطات الأزرار (1000 + n) حتى لا يتكرر مفتاح المسح
+        self.message_ids = itertools.count(10 ** 7)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record(self, method, amount=1):
+        with self.calls_lock:
+            self.calls[method] += amount
+
+    def snapshot(self):
+        with self.calls_lock:
+            return dict(self.calls)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name=f"stub-{self.server_address[1]}")
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def send_json(self, status, payload, extra_headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def inject_failure(self, method):
+        """
+        انتظار زمن الاستجابة ثم إرجاع True إذا تم إرسال رد خطأ (429 أو 500)
+        """
+        self.server.record(method)
+        delay, status = self.server.config.draw()
+        if delay:
+            time.sleep(delay)
+        if status == 429:
+            self.send_429()
+            return True
+        if status == 500:
+            self.send_json(500, {"ok": False, "error_code": 500, "description": "Injected stub error"})
+            return True
+        return False
+
+    def send_429(self):
+        retry_after = self.server.config.retry_after
+        self.send_json(429, {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}",
+                             "parameters": {"retry_after": retry_after}}, {"Retry-After": str(retry_after)})
+
+
+class TelegramStubHandler(StubHandler):
+    """/bot<token>/<method> و /file/bot<token>/<path>"""
+
+    def do_GET(self):
+        self.handle_call()
+
+    def do_POST(self):
+        self.handle_call()
+
+    def handle_call(self):
+        path = self.path.split("?", 1)[0]
+        body = self.read_body()
+
+        if path.startswith("/file/bot"):
+            if self.inject_failure("file"):
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(STUB_PHOTO)))
+            self.end_headers()
+            self.wfile.write(STUB_PHOTO)
+            return
+
+        method = path.rsplit("/", 1)[-1]
+        if method == "getUpdates":
+            # لا توجد تحديثات: نحاكي long polling قصير
+            self.server.record(method)
+            time.sleep(1)
+            self.send_json(200, {"ok": True, "result": []})
+            return
+
+        if self.inject_failure(method):
+            return
+
+        if method == "deleteMessages":
+            # عدد الرسائل الممسوحة لا يعتمد على طريقة تجميعها في دفعات
+            try:
+                self.server.record("deleteMessages.message_ids", len(json.loads(body or b"{}").get("message_ids", [])))
+            except ValueError:
+                pass
+
+        if method == "sendMessage":
+            result = {"message_id": next(self.server.message_ids), "date": int(time.time())}
+        elif method == "getFile":
+            result = {"file_id": "stub", "file_path": "photos/stub.jpg", "file_size": len(STUB_PHOTO)}
+        else:
+            result = True
+        self.send_json(200, {"ok": True, "result": result})
+
+
+class SendPulseStubHandler(StubHandler):
+    """/oauth/access_token و /<channel>/contacts/... و /<channel>/flows/run و /upload"""
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+        self.read_body()
+        method = path.lstrip("/")
+
+        if self.inject_failure(method):
+            return
+
+        if method == "oauth/access_token":
+            self.send_json(200, {"access_token": "stub-token", "token_type": "Bearer", "expires_in": 3600})
+        elif method == "upload":
+            self.send_json(200, {"status": "success", "data": {"url": f"{self.server.url.replace('http:', 'https:')}/1/stub.jpg"}})
+        else:
+            self.send_json(200, {"success": True, "data": {"id": "stub"}})
+
+
+def start_stub_servers(config, host="127.0.0.1", telegram_port=0, sendpulse_port=0):
+    """
+    تشغيل السيرفرين في threads داخل نفس الـ process
+    ترجع (telegram_server, sendpulse_server)، والرابط في server.url
+    """
+    telegram = StubServer((host, telegram_port), TelegramStubHandler, config).start()
+    sendpulse = StubServer((host, sendpulse_port), SendPulseStubHandler, config).start()
+    return telegram, sendpulse
+
+
+def stub_environment(telegram, sendpulse):
+    # متغيرات البيئة التي توجه OrderTaker إلى السيرفرات المحلية
+    return {
+        "TELEGRAM_API_URL": telegram.url,
+        "SENDPULSE_API_URL": sendpulse.url,
+        "PHOTO_UPLOAD_URL": f"{sendpulse.url}/upload",
+        "TELEGRAM_TOKEN": "123456:stub",
+        "GROUP_ID": "-1001000000000",
+        "SENDPULSE_API_ID": "stub",
+        "SENDPULSE_API_SECRET": "stub",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--sendpulse-port", type=int, default=8082)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_429, args.retry_after)
+    telegram, sendpulse = start_stub_servers(config, args.host, args.telegram_port, args.sendpulse_port)
+    for name, value in stub_environment(telegram, sendpulse).items():
+        print(f"{name}={value}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"telegram calls: {telegram.snapshot()} | sendpulse calls: {sendpulse.snapshot()}")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+# إعدادات gunicorn (يتم تحميلها تلقائياً من مجلد التشغيل)
+
+
+def post_worker_init(worker):
+    # بدء المهام الخلفية داخل كل worker بعد الـ fork (checker التأخير في الـ leader فقط مع المخزن المشترك)
+    from main import start_background_services
+    start_background_services()
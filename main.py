@@ -1,17 +1,176 @@
 import os
+
+# وضع التشغيل: sync (الافتراضي، worker لكل طلب) أو async (gevent: كل طلب greenlet على event loop واحد)
+# في وضع async يجب أن يتم الـ monkey patch قبل استيراد requests/threading حتى تصبح كل الاتصالات غير متزامنة
+# gunicorn: SERVING_MODE=async gunicorn main:app -k gevent --worker-connections 1000
+SERVING_MODE = os.getenv("SERVING_MODE", "sync").lower()
+if SERVING_MODE == "async":
+    from gevent import monkey
+    monkey.patch_all()
+
 import requests
-from flask import Flask, request
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse
+from flask import Flask, request, g
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import time
 import tempfile
 import shutil
 import threading
+import heapq
+import bisect
+import itertools
+import math
+import queue
+import uuid
+import atexit
+import fcntl
 from datetime import datetime, timedelta
 import re
 import json
+import hashlib
+import hmac
+import random
+import mmap
+import secrets
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+
+# مكتبة JSON أسرع إن كانت مثبتة (اختيارية)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# في وضع async: العمليات الحاجزة التي لا يحولها monkey patch (fsync و sqlite3) تعمل في threadpool حقيقي
+# حتى لا توقف الـ event loop وكل الطلبات معه
+if SERVING_MODE == "async":
+    import gevent
+
+    def run_blocking(function, *args):
+        return gevent.get_hub().threadpool.apply(function, args)
+else:
+    def run_blocking(function, *args):
+        return function(*args)
+
+# إعداد logging: الطلب يضع السجل في طابور فقط، والتنسيق والكتابة في thread منفصل
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# text (الافتراضي) أو json (سطر JSON لكل سجل)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# عند امتلاء الطابور يتم تجاهل السجلات الجديدة بدلاً من إيقاف الطلب
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+# أقصى عدد سجلات INFO/DEBUG من نفس السطر في الكود خلال كل نافذة (0 = بدون حد)
+LOG_SAMPLE_MAX_PER_SITE = int(os.getenv("LOG_SAMPLE_MAX_PER_SITE", 50))
+LOG_SAMPLE_WINDOW = float(os.getenv("LOG_SAMPLE_WINDOW", 10))
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        if getattr(record, "suppressed", 0):
+            line += f" (+{record.suppressed} similar suppressed)"
+        return line
+
+class LogSampler(logging.Filter):
+    """
+    حد لكل call site (ملف + سطر) لسجلات INFO/DEBUG: أول max_per_site في كل نافذة تمر والباقي يُعد فقط
+    أول سجل يمر بعد النافذة يحمل عدد السجلات المحذوفة. WARNING وما فوقها لا تتأثر
+    """
+
+    def __init__(self, max_per_site, window):
+        super().__init__()
+        self.max_per_site = max_per_site
+        self.window = window
+        self.sites = {}   # (pathname, lineno) → [window_start, passed, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.max_per_site or record.levelno >= logging.WARNING:
+            return True
+        now = record.created
+        with self.lock:
+            site = self.sites.get((record.pathname, record.lineno))
+            if site is None or now - site[0] >= self.window:
+                suppressed = site[2] if site else 0
+                self.sites[(record.pathname, record.lineno)] = [now, 1, 0]
+                record.suppressed = suppressed
+                return True
+            if site[1] < self.max_per_site:
+                site[1] += 1
+                return True
+            site[2] += 1
+            return False
 
-# إعداد logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    يضع السجل في الطابور بدون تنسيقه (التنسيق يتم في الـ listener)
+    ويبدأ الـ listener داخل كل process (الـ threads لا تنتقل مع fork في gunicorn)
+    """
+
+    def __init__(self, log_queue, target):
+        super().__init__(log_queue)
+        self.target = target
+        self.listener = None
+        self.pid = None
+        self.dropped = 0
+        self.listener_lock = threading.Lock()
+
+    def ensure_listener(self):
+        # listener واحد لكل process حتى لو سجلت عدة threads لأول مرة في نفس الوقت
+        if self.pid != os.getpid():
+            with self.listener_lock:
+                if self.pid != os.getpid():
+                    self.listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+                    self.listener.start()
+                    atexit.register(self.listener.stop)
+                    self.pid = os.getpid()
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        self.ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def configure_logging():
+    if LOG_FORMAT == "json":
+        formatter = JsonLogFormatter()
+    else:
+        formatter = TextLogFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE), stream_handler)
+    queue_handler.addFilter(LogSampler(LOG_SAMPLE_MAX_PER_SITE, LOG_SAMPLE_WINDOW))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    return queue_handler
+
+log_handler = configure_logging()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
@@ -35,7 +194,584 @@ FLOW_IDS = {
 }
 
 # =============================
-# 1. دالة مسح الرسائل من التليجرام
+# 1. مقاييس Prometheus (عدادات و histograms خفيفة بدون مكتبات خارجية)
+# =============================
+# حدود الـ buckets بالثواني لزمن الطلبات الداخلة والخارجة
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def format_metric_labels(labelnames, labels):
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, labels):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    """عداد لكل مجموعة labels، الزيادة تحت lock قصير جداً"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{format_metric_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class Histogram:
+    """
+    histogram لكل مجموعة labels: نخزن عدد كل bucket فقط ونحسب القيم التراكمية عند القراءة
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.series = {}   # labels → [counts لكل bucket + inf, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in self.series.items()]
+        labelnames = self.labelnames + ("le",)
+        for labels, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f"{self.name}_bucket{format_metric_labels(labelnames, labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_metric_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{format_metric_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class Gauge:
+    """قيمة لحظية: إما تُضبط مباشرة أو تُحسب من دالة وقت القراءة فقط (بدون تكلفة على الـ hot path)"""
+
+    def __init__(self, name, documentation, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        value = self.value
+        if self.function:
+            try:
+                value = self.function()
+            except Exception as e:
+                logger.error("❌ Error collecting metric %s: %s", self.name, e)
+                return []
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+metrics_registry = []
+
+def register_metric(metric):
+    metrics_registry.append(metric)
+    return metric
+
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+http_requests_total = register_metric(Counter(
+    "ordertaker_http_requests_total", "Incoming HTTP requests by route and status", ("route", "method", "status")))
+http_request_duration = register_metric(Histogram(
+    "ordertaker_http_request_duration_seconds", "Incoming HTTP request latency by route", ("route",)))
+upstream_requests_total = register_metric(Counter(
+    "ordertaker_upstream_requests_total", "Outbound API calls by upstream, method and status code", ("upstream", "method", "status")))
+upstream_request_duration = register_metric(Histogram(
+    "ordertaker_upstream_request_duration_seconds", "Outbound API call latency by upstream and method", ("upstream", "method")))
+
+def observe_upstream(upstream, method, started, response):
+    # response=None يعني أن الطلب فشل باستثناء (timeout، اتصال...)
+    upstream_request_duration.observe(time.perf_counter() - started, upstream, method)
+    upstream_requests_total.inc(upstream, method, response.status_code if response is not None else "error")
+
+# =============================
+# 2. عملاء HTTP مع connection pooling لكل API
+# =============================
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+SENDPULSE_API_URL = os.getenv("SENDPULSE_API_URL", "https://api.sendpulse.com")
+PHOTO_UPLOAD_URL = os.getenv("PHOTO_UPLOAD_URL", "https://tmpfiles.org/api/v1/upload")
+
+# مهلة الاتصال قصيرة ومهلة القراءة أطول (connect, read)
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 30))
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+# عدد الاتصالات المفتوحة (keep-alive) لكل host
+# في وضع async مئات الطلبات تنتظر في نفس الـ process لذلك الـ pool أكبر
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", 200 if SERVING_MODE == "async" else 20))
+SENDPULSE_POOL_SIZE = int(os.getenv("SENDPULSE_POOL_SIZE", 100 if SERVING_MODE == "async" else 10))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", 2))
+
+def build_http_session(pool_size, max_retries=HTTP_MAX_RETRIES):
+    """
+    إنشاء Session بـ connection pool وإعادة محاولة أخطاء الاتصال فقط (الطلب لم يُرسل بعد)
+    أخطاء القراءة وأكواد 5xx تعيدها RetryPolicy للطلبات الآمنة فقط مع circuit breaker
+    """
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=0,
+        status=0,
+        other=0,
+        backoff_factor=0.3,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# circuit breaker لكل host: بعد عدد من الفشل المتتالي نرفض الطلبات فوراً لفترة ثم نجرب طلباً واحداً
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30))
+# إعادة المحاولة للطلبات الآمنة (idempotent): exponential backoff مع jitter
+HTTP_RETRY_ATTEMPTS = int(os.getenv("HTTP_RETRY_ATTEMPTS", 3))
+HTTP_RETRY_BASE_DELAY = float(os.getenv("HTTP_RETRY_BASE_DELAY", 0.2))
+HTTP_RETRY_MAX_DELAY = float(os.getenv("HTTP_RETRY_MAX_DELAY", 3))
+HTTP_RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """الـ upstream معطل حالياً والطلب رُفض بدون إرساله"""
+
+class CircuitBreaker:
+    """
+    closed: الطلبات تمر، وبعد failure_threshold فشل متتالي → open
+    open: كل الطلبات تُرفض فوراً حتى تمر reset_timeout → half_open
+    half_open: طلب تجريبي واحد فقط، نجاحه يغلق الدائرة وفشله يعيد فتحها
+    """
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self.trial_in_flight = False
+            if self.state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return
+        raise CircuitOpenError(f"Circuit open for {self.name}")
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                logger.info("✅ Circuit closed for %s", self.name)
+            self.state = "closed"
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logger.error("🚫 Circuit opened for %s after %s failure(s)", self.name, self.failures)
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.trial_in_flight = False
+
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(url):
+    host = urlparse(url).netloc
+    with circuit_breakers_lock:
+        if host not in circuit_breakers:
+            circuit_breakers[host] = CircuitBreaker(host)
+        return circuit_breakers[host]
+
+class RetryPolicy:
+    """
+    الطلبات الآمنة (idempotent) تعاد بعد أخطاء الشبكة وأكواد 5xx بتأخير عشوائي (full jitter)
+    الطلبات غير الآمنة لا تعاد هنا (أخطاء الاتصال قبل الإرسال يعيدها build_http_session)
+    """
+
+    def __init__(self, attempts=HTTP_RETRY_ATTEMPTS, base_delay=HTTP_RETRY_BASE_DELAY, max_delay=HTTP_RETRY_MAX_DELAY):
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, url, idempotent, send):
+        """
+        send: دالة ترسل الطلب مرة واحدة وترجع الـ response
+        ترفع CircuitOpenError إذا كان الـ host معطلاً
+        """
+        breaker = get_circuit_breaker(url)
+        attempts = self.attempts if idempotent else 1
+        for attempt in range(attempts):
+            breaker.before_call()
+            try:
+                response = send()
+            except requests.exceptions.RequestException as e:
+                breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    raise
+                logger.warning("🔁 Retrying %s after error: %s", breaker.name, e)
+            else:
+                if response.status_code < 500:
+                    breaker.record_success()
+                    return response
+                breaker.record_failure()
+                if attempt + 1 >= attempts or response.status_code not in HTTP_RETRY_STATUSES:
+                    return response
+                logger.warning("🔁 Retrying %s after HTTP %s", breaker.name, response.status_code)
+                response.close()
+            time.sleep(self.delay(attempt))
+
+retry_policy = RetryPolicy()
+
+# حدود Telegram: ~30 رسالة في الثانية للبوت و ~20 رسالة في الدقيقة للجروب
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))
+TELEGRAM_CHAT_RATE_PER_MINUTE = float(os.getenv("TELEGRAM_CHAT_RATE_PER_MINUTE", 20))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", 10))
+# عدد مرات إعادة المحاولة بعد 429، وأقصى retry_after نقبل انتظاره
+TELEGRAM_429_MAX_RETRIES = int(os.getenv("TELEGRAM_429_MAX_RETRIES", 3))
+TELEGRAM_MAX_RETRY_AFTER = float(os.getenv("TELEGRAM_MAX_RETRY_AFTER", 60))
+
+# أولويات الإرسال: الطلبات وتعديل الأزرار قبل عمليات المسح التجميلية
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+TELEGRAM_LOW_PRIORITY_METHODS = {"deleteMessage", "deleteMessages"}
+# طلبات يمكن تكرارها بدون أثر جانبي إضافي (sendMessage ليس منها)
+TELEGRAM_IDEMPOTENT_METHODS = {"editMessageText", "deleteMessage", "deleteMessages", "answerCallbackQuery",
+                               "getFile", "setWebhook", "deleteWebhook"}
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now):
+        # المدة المتبقية حتى يتوفر token واحد (0 = متاح الآن)
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        # بعد انتهاء المهلة نسمح برسالة واحدة ثم بالمعدل العادي بدون burst
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 1)
+
+class TelegramRateLimiter:
+    """
+    token bucket عام للبوت + bucket لكل جروب (لطرق send* فقط)
+    الطلبات منخفضة الأولوية تنتظر طالما هناك طلبات عالية الأولوية منتظرة
+    """
+
+    def __init__(self, global_rate, chat_rate_per_minute, chat_burst, max_chat_buckets=1000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate_per_minute / 60.0
+        self.chat_burst = chat_burst
+        self.max_chat_buckets = max_chat_buckets
+        self.chat_buckets = OrderedDict()   # chat_id → bucket بترتيب آخر استخدام
+        self.waiting_high = 0
+        self.condition = threading.Condition()
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.max_chat_buckets:
+                self.evict_idle_buckets()
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def evict_idle_buckets(self):
+        # حذف الأقدم استخداماً من الـ buckets الممتلئة وغير المحظورة فقط (حذفها لا يغير أي انتظار)،
+        # والجروبات النشطة أو التي عليها retry_after تبقى حتى لو تجاوزنا الحد
+        now = time.monotonic()
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if len(self.chat_buckets) < self.max_chat_buckets:
+                break
+            if bucket.wait_time(now) <= 0 and bucket.tokens >= bucket.capacity:
+                del self.chat_buckets[chat_id]
+
+    def acquire(self, chat_id, priority):
+        with self.condition:
+            if priority == PRIORITY_HIGH:
+                self.waiting_high += 1
+            try:
+                while True:
+                    if priority != PRIORITY_HIGH and self.waiting_high:
+                        self.condition.wait()
+                        continue
+                    now = time.monotonic()
+                    buckets = [self.global_bucket]
+                    if chat_id is not None:
+                        buckets.append(self.chat_bucket(chat_id))
+                    wait_time = max(bucket.wait_time(now) for bucket in buckets)
+                    if wait_time <= 0:
+                        for bucket in buckets:
+                            bucket.take()
+                        return
+                    self.condition.wait(wait_time)
+            finally:
+                if priority == PRIORITY_HIGH:
+                    self.waiting_high -= 1
+                    self.condition.notify_all()
+
+    def penalize(self, chat_id, retry_after):
+        # تطبيق retry_after القادم من Telegram على الجروب أو على البوت كله
+        with self.condition:
+            bucket = self.chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+            bucket.block(retry_after)
+
+telegram_limiter = TelegramRateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE_PER_MINUTE, TELEGRAM_CHAT_BURST)
+
+def telegram_retry_after(response):
+    try:
+        return float(response.json().get("parameters", {}).get("retry_after", 1))
+    except (ValueError, AttributeError):
+        return 1.0
+
+class TelegramClient:
+    """عميل Telegram Bot API يعيد استخدام نفس الاتصالات ويلتزم بحدود الإرسال"""
+
+    def __init__(self, base_url, pool_size, limiter=None):
+        self.base_url = base_url.rstrip("/")
+        self.session = build_http_session(pool_size)
+        self.limiter = limiter
+
+    def method_url(self, method):
+        return f"{self.base_url}/bot{os.getenv('TELEGRAM_TOKEN')}/{method}"
+
+    def file_url(self, file_path):
+        return f"{self.base_url}/file/bot{os.getenv('TELEGRAM_TOKEN')}/{file_path}"
+
+    def call(self, http_method, method, priority=None, chat_id=None, **kwargs):
+        """
+        تنفيذ طلب مع انتظار الـ rate limiter وإعادة المحاولة بعد 429 حسب retry_after
+        حد الجروب (رسائل/دقيقة) يطبق على رسائل send* فقط، أما retry_after فيوقف bucket الجروب لأي method
+        ولا يوقف البوت كله إلا إذا لم يكن هناك chat_id
+        """
+        if priority is None:
+            priority = PRIORITY_LOW if method in TELEGRAM_LOW_PRIORITY_METHODS else PRIORITY_HIGH
+        # GROUP_ID يصل كنص من post_raw وكرقم من post: نفس الجروب يجب أن يستخدم نفس الـ bucket
+        chat_key = str(chat_id) if chat_id is not None else None
+        acquire_key = chat_key if method.startswith("send") else None
+
+        for attempt in range(TELEGRAM_429_MAX_RETRIES + 1):
+            if self.limiter:
+                self.limiter.acquire(acquire_key, priority)
+            response = self.request(http_method, method, self.method_url(method), **kwargs)
+            if response.status_code != 429:
+                return response
+
+            retry_after = telegram_retry_after(response)
+            if retry_after > TELEGRAM_MAX_RETRY_AFTER or attempt == TELEGRAM_429_MAX_RETRIES:
+                break
+            logger.warning("⏳ Telegram rate limited %s (chat %s), retrying after %ss", method, chat_key, retry_after)
+            if self.limiter:
+                self.limiter.penalize(chat_key, retry_after)
+                # المحاولة التالية تنتظر انتهاء حظر الجروب حتى لو لم تكن send*
+                acquire_key = chat_key
+            else:
+                time.sleep(retry_after)
+
+        logger.error("❌ Telegram %s still rate limited after %s attempts", method, attempt + 1)
+        return response
+
+    def request(self, http_method, method, url, **kwargs):
+        idempotent = http_method == "GET" or method in TELEGRAM_IDEMPOTENT_METHODS
+        return retry_policy.call(url, idempotent, lambda: self.send_once(http_method, method, url, **kwargs))
+
+    def send_once(self, http_method, method, url, **kwargs):
+        started = time.perf_counter()
+        response = None
+        try:
+            response = self.session.request(http_method, url, **kwargs)
+            return response
+        finally:
+            observe_upstream("telegram", method, started, response)
+
+    def post(self, method, payload, timeout=HTTP_TIMEOUT, priority=None):
+        return self.call("POST", method, priority, payload.get("chat_id"), json=payload, timeout=timeout)
+
+    def post_raw(self, method, body, chat_id, timeout=HTTP_TIMEOUT, priority=None):
+        # body: JSON مرمّز مسبقاً (bytes)
+        return self.call("POST", method, priority, chat_id, data=body,
+                         headers={"Content-Type": "application/json"}, timeout=timeout)
+
+    def get(self, method, params=None, timeout=HTTP_TIMEOUT):
+        return self.call("GET", method, params=params, timeout=timeout)
+
+    def download(self, file_url, timeout=HTTP_TIMEOUT):
+        # الزمن المقاس حتى وصول الـ headers فقط (المحتوى يُقرأ لاحقاً كـ stream)
+        return self.request("GET", "file", file_url, stream=True, timeout=timeout)
+
+class SendPulseClient:
+    """عميل SendPulse API مع التوكن المخزن مؤقتاً وإعادة المحاولة عند 401"""
+
+    def __init__(self, base_url, pool_size):
+        self.base_url = base_url.rstrip("/")
+        self.session = build_http_session(pool_size)
+
+    def request(self, path, **kwargs):
+        # فقط طلب التوكن آمن للتكرار، رسائل العملاء والـ flows لا تعاد
+        url = f"{self.base_url}{path}"
+        return retry_policy.call(url, path == "/oauth/access_token", lambda: self.send_once(path, url, **kwargs))
+
+    def send_once(self, path, url, **kwargs):
+        started = time.perf_counter()
+        response = None
+        try:
+            response = self.session.post(url, **kwargs)
+            return response
+        finally:
+            observe_upstream("sendpulse", path.lstrip("/"), started, response)
+
+    def request_token(self, payload, timeout=HTTP_TIMEOUT):
+        return self.request("/oauth/access_token", data=payload, timeout=timeout)
+
+    def post(self, path, payload, timeout=HTTP_TIMEOUT):
+        """
+        إرسال طلب POST مع التوكن المخزن مؤقتاً
+        عند رد 401 يتم إلغاء التوكن وإعادة المحاولة مرة واحدة
+        """
+        token = get_sendpulse_token()
+        if not token:
+            logger.error("No token available for SendPulse")
+            return None
+
+        headers = {"Authorization": f"Bearer {token}"}
+        response = self.request(path, json=payload, headers=headers, timeout=timeout)
+
+        if response.status_code == 401:
+            logger.warning("SendPulse token rejected for %s, refreshing and retrying once", path)
+            invalidate_sendpulse_token(token)
+            token = get_sendpulse_token()
+            if not token:
+                logger.error("No token available for SendPulse")
+                return None
+            headers = {"Authorization": f"Bearer {token}"}
+            response = self.request(path, json=payload, headers=headers, timeout=timeout)
+
+        return response
+
+telegram_client = TelegramClient(TELEGRAM_API_URL, TELEGRAM_POOL_SIZE, telegram_limiter)
+sendpulse_client = SendPulseClient(SENDPULSE_API_URL, SENDPULSE_POOL_SIZE)
+# رفع الصور إلى خدمة التخزين المؤقت
+upload_session = build_http_session(4)
+
+def upload_request(**kwargs):
+    # الرفع غير آمن للتكرار (الـ body قد يكون stream)، لكنه يمر بالـ circuit breaker
+    def send_once():
+        started = time.perf_counter()
+        response = None
+        try:
+            response = upload_session.post(PHOTO_UPLOAD_URL, **kwargs)
+            return response
+        finally:
+            observe_upstream("upload", "upload", started, response)
+    return retry_policy.call(PHOTO_UPLOAD_URL, False, send_once)
+
+# =============================
+# 3. تنفيذ الاتصالات الخارجية المستقلة بالتوازي
+# =============================
+# الحد الأقصى للاتصالات المتوازية المشتركة بين كل الطلبات داخل الـ process
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", 16))
+
+fanout_executor = None
+fanout_executor_pid = None
+fanout_lock = threading.Lock()
+
+def get_fanout_executor():
+    # executor لكل process (الـ threads لا تنتقل مع fork في gunicorn)
+    global fanout_executor, fanout_executor_pid
+    if fanout_executor_pid != os.getpid():
+        with fanout_lock:
+            if fanout_executor_pid != os.getpid():
+                fanout_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+                fanout_executor_pid = os.getpid()
+    return fanout_executor
+
+def fan_out(*calls):
+    """
+    تشغيل دوال مستقلة (بدون arguments) بالتوازي وإرجاع نتائجها بنفس الترتيب (None يتم تخطيها ونتيجتها None)
+    أول دالة تعمل في الـ thread الحالي والباقي على الـ executor المشترك
+    إذا فشلت دالة يتم انتظار الباقي ثم إعادة رفع أول استثناء
+    لا تستدعي fan_out من داخل دالة تعمل عليه حتى لا تنتظر الـ workers بعضها
+    """
+    results = [None] * len(calls)
+    pending = [(index, call) for index, call in enumerate(calls) if call is not None]
+    if not pending:
+        return results
+    executor = get_fanout_executor()
+    futures = [(index, executor.submit(call)) for index, call in pending[1:]]
+
+    error = None
+    index, call = pending[0]
+    try:
+        results[index] = call()
+    except Exception as e:
+        error = e
+    for index, future in futures:
+        try:
+            results[index] = future.result()
+        except Exception as e:
+            error = error or e
+    if error:
+        raise error
+    return results
+
+# =============================
+# 4. دالة مسح الرسائل من التليجرام
 # =============================
 def delete_telegram_message(chat_id, message_id):
     try:
@@ -44,86 +780,255 @@ def delete_telegram_message(chat_id, message_id):
             logger.error("TELEGRAM_TOKEN not set")
             return False
             
-        url = f"https://api.telegram.org/bot{token}/deleteMessage"
         payload = {
             "chat_id": chat_id,
             "message_id": message_id
         }
-        response = requests.post(url, json=payload, timeout=30)
+        response = telegram_client.post("deleteMessage", payload)
         
         if response.status_code == 200:
-            logger.info(f"Message {message_id} deleted successfully from chat {chat_id}")
+            logger.info("Message %s deleted successfully from chat %s", message_id, chat_id)
             return True
         else:
-            logger.error(f"Failed to delete message {message_id}: {response.status_code} - {response.text}")
+            logger.error("Failed to delete message %s: %s - %s", message_id, response.status_code, response.text)
             return False
     except Exception as e:
-        logger.error(f"Error deleting message: {e}")
+        logger.error("Error deleting message: %s", e)
         return False
 
+# الحد الأقصى لعدد الرسائل في طلب deleteMessages واحد
+TELEGRAM_DELETE_BATCH_LIMIT = 100
+
+def delete_telegram_messages(chat_id, message_ids):
+    """
+    مسح عدة رسائل من نفس الجروب بطلب deleteMessages واحد لكل 100 رسالة
+    عند فشل الطلب المجمع نرجع لمسح كل رسالة على حدة
+    """
+    if len(message_ids) == 1:
+        return delete_telegram_message(chat_id, message_ids[0])
+
+    all_deleted = True
+    for start in range(0, len(message_ids), TELEGRAM_DELETE_BATCH_LIMIT):
+        chunk = message_ids[start:start + TELEGRAM_DELETE_BATCH_LIMIT]
+        try:
+            response = telegram_client.post("deleteMessages", {
+                "chat_id": chat_id,
+                "message_ids": chunk
+            })
+            if response.status_code == 200 and response.json().get("ok"):
+                logger.info("Messages %s deleted successfully from chat %s", chunk, chat_id)
+                continue
+            logger.warning("Bulk delete failed for chat %s: %s, falling back to single deletes", chat_id, response.status_code)
+        except Exception as e:
+            logger.warning("Error in bulk delete for chat %s: %s, falling back to single deletes", chat_id, e)
+
+        for message_id in chunk:
+            all_deleted = delete_telegram_message(chat_id, message_id) and all_deleted
+    return all_deleted
+
 # =============================
-# 2. دالة مسح رسالة بعد تأخير
+# 5. مجدول المهام المؤجلة (thread واحد بدلاً من thread لكل رسالة)
 # =============================
+class TimerScheduler:
+    """
+    مجدول مبني على heap يعمل بـ thread واحد مهما كان عدد المهام
+    أوقات التنفيذ تُقرب إلى resolution لتُجمع المهام المتقاربة وتُنفذ معاً،
+    وكل callback يستقبل قائمة بـ args جميع مهامه المستحقة في نفس الدورة
+    """
+
+    def __init__(self, name, resolution=0.25):
+        self.name = name
+        self.resolution = resolution
+        self.heap = []      # (due, seq, key)
+        self.entries = {}   # key → (due, seq, callback, args)
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def due_time(self, delay_seconds):
+        due = time.monotonic() + max(delay_seconds, 0)
+        return math.ceil(due / self.resolution) * self.resolution
+
+    def schedule(self, key, delay_seconds, callback, *args):
+        with self.condition:
+            due = self.due_time(delay_seconds)
+            seq = next(self.counter)
+            self.entries[key] = (due, seq, callback, args)
+            heapq.heappush(self.heap, (due, seq, key))
+            self.start()
+            # إيقاظ الـ thread فقط إذا أصبحت هذه المهمة الأقرب
+            if self.heap[0][1] == seq:
+                self.condition.notify()
+
+    def cancel(self, key):
+        with self.condition:
+            # الحذف من الـ heap يتم لاحقاً عند الوصول للعنصر (lazy deletion)
+            removed = self.entries.pop(key, None) is not None
+            if len(self.heap) > 64 and len(self.heap) > 2 * len(self.entries):
+                self.compact()
+            return removed
+
+    def reschedule(self, key, delay_seconds):
+        with self.condition:
+            entry = self.entries.get(key)
+            if not entry:
+                return False
+            self.schedule(key, delay_seconds, entry[2], *entry[3])
+            return True
+
+    def pending_count(self):
+        with self.condition:
+            return len(self.entries)
+
+    def compact(self):
+        self.heap = [item for item in self.heap if self.is_current(item)]
+        heapq.heapify(self.heap)
+
+    def is_current(self, item):
+        entry = self.entries.get(item[2])
+        return entry is not None and entry[1] == item[1]
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name=self.name)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def pop_due(self):
+        # انتظار أول مهمة مستحقة ثم إخراج كل المهام المستحقة معاً
+        with self.condition:
+            while True:
+                while self.heap and not self.is_current(self.heap[0]):
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                wait_time = self.heap[0][0] - time.monotonic()
+                if wait_time > 0:
+                    self.condition.wait(wait_time)
+                    continue
+                break
+
+            now = time.monotonic()
+            batches = {}
+            while self.heap and self.heap[0][0] <= now:
+                item = heapq.heappop(self.heap)
+                if not self.is_current(item):
+                    continue
+                _, _, callback, args = self.entries.pop(item[2])
+                batches.setdefault(callback, []).append(args)
+            return batches
+
+    def run(self):
+        while True:
+            for callback, batch in self.pop_due().items():
+                try:
+                    callback(batch)
+                except Exception as e:
+                    logger.error("❌ Error in %s task %s: %s", self.name, callback.__name__, e)
+
+# نافذة تجميع عمليات المسح: كل الرسائل المستحقة في نفس النافذة تُمسح بطلب واحد لكل جروب
+DELETE_BATCH_WINDOW = float(os.getenv("DELETE_BATCH_WINDOW", 0.5))
+
+def delete_messages_batch(batch):
+    # batch: قائمة (chat_id, message_id) حان وقت مسحها في نفس الدورة
+    by_chat = {}
+    for chat_id, message_id in batch:
+        by_chat.setdefault(chat_id, []).append(message_id)
+    for chat_id, message_ids in by_chat.items():
+        delete_telegram_messages(chat_id, message_ids)
+
+deletion_scheduler = TimerScheduler("message-deletions", resolution=DELETE_BATCH_WINDOW)
+
 def delete_message_after_delay(chat_id, message_id, delay_seconds):
-    def delete():
-        time.sleep(delay_seconds)
-        delete_telegram_message(chat_id, message_id)
-    
-    thread = threading.Thread(target=delete)
-    thread.daemon = True
-    thread.start()
+    deletion_scheduler.schedule((chat_id, message_id), delay_seconds, delete_messages_batch, chat_id, message_id)
+
+def queue_message_deletion(chat_id, message_id):
+    # مسح "فوري" يُجمع مع باقي عمليات المسح في نفس النافذة
+    delete_message_after_delay(chat_id, message_id, DELETE_BATCH_WINDOW)
 
 # =============================
-# 3. دالة للحصول على Access Token من SendPulse
+# 6. دالة للحصول على Access Token من SendPulse
 # =============================
-def get_sendpulse_token():
+# التوكن المخزن مؤقتاً (token, expires_at) - يُقرأ كـ tuple واحد بدون قفل
+sendpulse_token_state = (None, 0.0)
+# قفل يضمن أن thread واحد فقط يجدد التوكن والباقي ينتظر نتيجته
+sendpulse_token_lock = threading.Lock()
+
+# تجديد التوكن قبل انتهاء صلاحيته بهذا العدد من الثواني
+SENDPULSE_TOKEN_REFRESH_MARGIN = int(os.getenv("SENDPULSE_TOKEN_REFRESH_MARGIN", 60))
+
+def fetch_sendpulse_token():
     try:
         client_id = os.getenv("SENDPULSE_API_ID")
         client_secret = os.getenv("SENDPULSE_API_SECRET")
         
         if not client_id or not client_secret:
             logger.error("SendPulse API credentials not set")
-            return None
+            return None, 0
             
-        url = "https://api.sendpulse.com/oauth/access_token"
         payload = {
             "grant_type": "client_credentials",
             "client_id": client_id,
             "client_secret": client_secret
         }
-        response = requests.post(url, data=payload, timeout=30)
+        response = sendpulse_client.request_token(payload)
         data = response.json()
         token = data.get("access_token")
         if not token:
             logger.error("Failed to get SendPulse token")
-        return token
+            return None, 0
+        return token, int(data.get("expires_in", 3600))
     except Exception as e:
-        logger.error(f"Error getting SendPulse token: {e}")
-        return None
+        logger.error("Error getting SendPulse token: %s", e)
+        return None, 0
+
+def get_sendpulse_token():
+    global sendpulse_token_state
+    token, expires_at = sendpulse_token_state
+    if token and time.monotonic() < expires_at:
+        return token
+
+    with sendpulse_token_lock:
+        # ربما قام thread آخر بتجديد التوكن أثناء انتظارنا للقفل
+        token, expires_at = sendpulse_token_state
+        if token and time.monotonic() < expires_at:
+            return token
+
+        token, expires_in = fetch_sendpulse_token()
+        if not token:
+            return None
+
+        expires_at = time.monotonic() + max(expires_in - SENDPULSE_TOKEN_REFRESH_MARGIN, 0)
+        sendpulse_token_state = (token, expires_at)
+        logger.info("🔑 SendPulse token refreshed (expires in %ss)", expires_in)
+        return token
+
+def invalidate_sendpulse_token(token):
+    global sendpulse_token_state
+    with sendpulse_token_lock:
+        # لا نمسح توكن جديد قام thread آخر بتجديده بالفعل
+        if sendpulse_token_state[0] == token:
+            sendpulse_token_state = (None, 0.0)
 
 # =============================
-# 4. تشغيل Flow في SendPulse
+# 7. تشغيل Flow في SendPulse
 # =============================
 def run_flow(contact_id, channel, flow_type):
     try:
-        token = get_sendpulse_token()
-        if not token:
-            logger.error("No token available for SendPulse")
-            return False
-
         # تحديد الـ endpoint بناءً على القناة
         if channel == "telegram":
-            url = "https://api.sendpulse.com/telegram/flows/run"
+            path = "/telegram/flows/run"
         elif channel == "messenger":
-            url = "https://api.sendpulse.com/messenger/flows/run"
+            path = "/messenger/flows/run"
         else:
-            logger.error(f"Unknown channel for flow: {channel}")
+            logger.error("Unknown channel for flow: %s", channel)
             return False
 
         # الحصول على الـ flow_id المناسب للقناة ونوع التحويل
         flow_id = FLOW_IDS.get(channel, {}).get(flow_type)
         if not flow_id:
-            logger.error(f"No flow_id defined for channel: {channel} and flow type: {flow_type}")
+            logger.error("No flow_id defined for channel: %s and flow type: %s", channel, flow_type)
             return False
 
         payload = {
@@ -134,82 +1039,74 @@ def run_flow(contact_id, channel, flow_type):
             }
         }
 
-        headers = {"Authorization": f"Bearer {token}"}
-        
-        logger.info(f"Running {flow_type} flow for contact {contact_id} on channel {channel}")
-        logger.info(f"Flow ID: {flow_id}")
+        logger.info("Running %s flow for contact %s on channel %s", flow_type, contact_id, channel)
+        logger.info("Flow ID: %s", flow_id)
         
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+        response = sendpulse_client.post(path, payload)
+        if response is None:
+            return False
         
-        logger.info(f"SendPulse Flow response status: {response.status_code}")
+        logger.info("SendPulse Flow response status: %s", response.status_code)
         
         if response.status_code == 200:
-            logger.info(f"{flow_type} flow started successfully for client {contact_id} on channel {channel}")
+            logger.info("%s flow started successfully for client %s on channel %s", flow_type, contact_id, channel)
             return True
         else:
-            logger.error(f"Failed to start {flow_type} flow for {contact_id}: {response.status_code} - {response.text}")
+            logger.error("Failed to start %s flow for %s: %s - %s", flow_type, contact_id, response.status_code, response.text)
             return False
     except Exception as e:
-        logger.error(f"Error running flow: {e}")
+        logger.error("Error running flow: %s", e)
         return False
 
 # =============================
-# 5. إرسال رسالة للعميل عبر SendPulse (Telegram)
+# 8. إرسال رسالة للعميل عبر SendPulse (Telegram)
 # =============================
 def send_to_client_telegram(contact_id, text):
     try:
-        token = get_sendpulse_token()
-        if not token:
-            logger.error("No token available for SendPulse")
-            return False
-            
-        url = "https://api.sendpulse.com/telegram/contacts/sendText"
+        path = "/telegram/contacts/sendText"
         payload = {"contact_id": contact_id, "text": text}
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+        response = sendpulse_client.post(path, payload)
+        if response is None:
+            return False
         
         if response.status_code == 200:
-            logger.info(f"Message sent to Telegram client {contact_id}")
+            logger.info("Message sent to Telegram client %s", contact_id)
             return True
         else:
-            logger.error(f"Failed to send message to Telegram {contact_id}: {response.status_code}")
+            logger.error("Failed to send message to Telegram %s: %s", contact_id, response.status_code)
             return False
     except Exception as e:
-        logger.error(f"Error sending to Telegram client: {e}")
+        logger.error("Error sending to Telegram client: %s", e)
         return False
 
 # =============================
-# 6. إرسال رسالة للعميل عبر SendPulse (Messenger)
+# 9. إرسال رسالة للعميل عبر SendPulse (Messenger)
 # =============================
 def send_to_client_messenger(contact_id, text):
     try:
-        token = get_sendpulse_token()
-        if not token:
-            logger.error("No token available for SendPulse")
-            return False
-            
-        url = "https://api.sendpulse.com/messenger/contacts/sendText"
+        path = "/messenger/contacts/sendText"
         payload = {
             "contact_id": contact_id,
             "message_type": "RESPONSE",
             "message_tag": "ACCOUNT_UPDATE",
             "text": text
         }
-        headers = {"Authorization": f"Bearer {token}"}
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+        response = sendpulse_client.post(path, payload)
+        if response is None:
+            return False
         
         if response.status_code == 200:
-            logger.info(f"Message sent to Messenger client {contact_id}")
+            logger.info("Message sent to Messenger client %s", contact_id)
             return True
         else:
-            logger.error(f"Failed to send message to Messenger {contact_id}: {response.status_code}")
+            logger.error("Failed to send message to Messenger %s: %s", contact_id, response.status_code)
             return False
     except Exception as e:
-        logger.error(f"Error sending to Messenger client: {e}")
+        logger.error("Error sending to Messenger client: %s", e)
         return False
 
 # =============================
-# 7. دالة موحدة لإرسال الرسائل بناءً على القناة
+# 10. دالة موحدة لإرسال الرسائل بناءً على القناة
 # =============================
 def send_to_client(contact_id, text, channel):
     if channel == "telegram":
@@ -217,84 +1114,282 @@ def send_to_client(contact_id, text, channel):
     elif channel == "messenger":
         return send_to_client_messenger(contact_id, text)
     else:
-        logger.error(f"Unknown channel: {channel}")
+        logger.error("Unknown channel: %s", channel)
         return False
 
 # =============================
-# 8. تحميل الصورة من Telegram وإنشاء رابط مؤقت
+# 11. تحميل الصورة من Telegram وإنشاء رابط مؤقت
 # =============================
-def download_and_create_temp_url(telegram_file_url, telegram_token, contact_id):
+# حجم الدفعة التي تمر من تحميل Telegram إلى الرفع مباشرة
+PHOTO_STREAM_CHUNK_SIZE = int(os.getenv("PHOTO_STREAM_CHUNK_SIZE", 64 * 1024))
+# الملفات الأكبر من هذا الحجم (أو بدون Content-Length) تُحفظ على القرص أولاً
+PHOTO_STREAM_MAX_BYTES = int(os.getenv("PHOTO_STREAM_MAX_BYTES", 20 * 1024 * 1024))
+
+class MultipartStream:
+    """
+    جسم multipart/form-data يُقرأ دفعة بدفعة من رد التحميل مباشرة
+    الذاكرة المستخدمة لا تتجاوز دفعة واحدة، و __len__ يسمح بإرسال Content-Length
+    بدلاً من chunked encoding
+    """
+
+    def __init__(self, response, content_length, filename, chunk_size=PHOTO_STREAM_CHUNK_SIZE):
+        self.response = response
+        self.content_length = content_length
+        self.chunk_size = chunk_size
+        self.boundary = uuid.uuid4().hex
+        self.head = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode()
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return len(self.head) + self.content_length + len(self.tail)
+
+    def __iter__(self):
+        yield self.head
+        for chunk in self.response.iter_content(chunk_size=self.chunk_size):
+            yield chunk
+        yield self.tail
+
+def upload_photo_stream(response, content_length, filename):
+    # تمرير الصورة من Telegram إلى خدمة الرفع بدون ملف مؤقت
+    body = MultipartStream(response, content_length, filename)
+    logger.info("Relaying photo to upload service: %s bytes", content_length)
+    return upload_request(
+        data=body,
+        headers={"Content-Type": body.content_type},
+        timeout=HTTP_TIMEOUT
+    )
+
+def upload_photo_via_disk(response, filename):
+    # الملفات الكبيرة: حفظ الصورة على القرص ثم رفعها
+    temp_dir = tempfile.mkdtemp()
     try:
-        # إنشاء مجلد مؤقت في ذاكرة Railway
-        temp_dir = tempfile.mkdtemp()
-        file_path = os.path.join(temp_dir, f"photo_{contact_id}.jpg")
-        
-        logger.info(f"Downloading photo from: {telegram_file_url}")
+        file_path = os.path.join(temp_dir, filename)
+        with open(file_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=PHOTO_STREAM_CHUNK_SIZE):
+                f.write(chunk)
+
+        # الحصول على حجم الملف
+        file_size = os.path.getsize(file_path)
+        logger.info("Photo downloaded to disk spool: %s bytes", file_size)
+
+        # رفع الصورة إلى خدمة تخزين مؤقتة
+        with open(file_path, 'rb') as f:
+            return upload_request(
+                files={'file': f},
+                timeout=HTTP_TIMEOUT
+            )
+    finally:
+        # تنظيف الملف المؤقت
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def download_and_create_temp_url(telegram_file_url, contact_id):
+    try:
+        filename = f"photo_{contact_id}.jpg"
+        logger.info("Downloading photo from Telegram for contact %s", contact_id)
         
         # تحميل الصورة من Telegram
-        response = requests.get(telegram_file_url, stream=True, timeout=30)
-        
-        if response.status_code == 200:
-            # حفظ الصورة في الملف المؤقت
-            with open(file_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
-            
-            # الحصول على حجم الملف
-            file_size = os.path.getsize(file_path)
-            logger.info(f"Photo downloaded successfully: {file_size} bytes")
-            
-            # رفع الصورة إلى خدمة تخزين مؤقتة
-            with open(file_path, 'rb') as f:
-                upload_response = requests.post(
-                    'https://tmpfiles.org/api/v1/upload',
-                    files={'file': f},
-                    timeout=30
-                )
-            
-            # تنظيف الملف المؤقت
-            shutil.rmtree(temp_dir)
+        with telegram_client.download(telegram_file_url) as response:
+            if response.status_code != 200:
+                logger.error("Failed to download photo: %s", response.status_code)
+                return None
+
+            content_length = int(response.headers.get('Content-Length') or 0)
+            if 0 < content_length <= PHOTO_STREAM_MAX_BYTES:
+                upload_response = upload_photo_stream(response, content_length, filename)
+            else:
+                upload_response = upload_photo_via_disk(response, filename)
             
-            if upload_response.status_code == 200:
-                upload_data = upload_response.json()
-                if upload_data.get('status') == 'success':
-                    # tmpfiles.org يعطينا رابط تنزيل مباشر
-                    download_url = upload_data['data']['url']
-                    # نحتاج لتحويل الرابط إلى صيغة مباشرة
-                    direct_url = download_url.replace('tmpfiles.org/', 'tmpfiles.org/dl/')
-                    logger.info(f"Temporary URL created: {direct_url}")
-                    return direct_url
-                else:
-                    logger.error(f"Upload failed: {upload_data}")
-                    return None
+        if upload_response.status_code == 200:
+            upload_data = upload_response.json()
+            if upload_data.get('status') == 'success':
+                # tmpfiles.org يعطينا رابط تنزيل مباشر
+                download_url = upload_data['data']['url']
+                # نحتاج لتحويل الرابط إلى صيغة مباشرة
+                direct_url = download_url.replace('tmpfiles.org/', 'tmpfiles.org/dl/')
+                logger.info("Temporary URL created: %s", direct_url)
+                return direct_url
             else:
-                logger.error(f"Upload failed with status: {upload_response.status_code}")
+                logger.error("Upload failed: %s", upload_data)
                 return None
         else:
-            logger.error(f"Failed to download photo: {response.status_code}")
-            # تنظيف الملف المؤقت في حالة الخطأ
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
+            logger.error("Upload failed with status: %s", upload_response.status_code)
             return None
             
     except Exception as e:
-        logger.error(f"Error in download_and_create_temp_url: {e}")
-        # تنظيف الملف المؤقت في حالة الخطأ
-        if 'temp_dir' in locals() and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
+        logger.error("Error in download_and_create_temp_url: %s", e)
         return None
 
 # =============================
-# 9. إرسال صورة للعميل عبر SendPulse API (Telegram)
+# 12. تخزين صور الدعم الفني وتقديمها من OrderTaker نفسه
 # =============================
-def send_photo_to_client_telegram(contact_id, photo_url):
+# الرابط العام للتطبيق: تقديم الصور من OrderTaker نفسه يتفعل فقط عند ضبطه صراحة، وإلا نستخدم tmpfiles.org
+# (بدون https:// يتم إضافتها، مثل RAILWAY_STATIC_URL الذي يحتوي على الدومين فقط)
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").strip().rstrip("/")
+if PUBLIC_BASE_URL and "://" not in PUBLIC_BASE_URL:
+    PUBLIC_BASE_URL = f"https://{PUBLIC_BASE_URL}"
+# مدة صلاحية رابط الصورة
+PHOTO_URL_TTL = int(os.getenv("PHOTO_URL_TTL", 3600))
+# حجم نسخ الصور في الذاكرة (read cache فقط)، كل صورة تُكتب أولاً في الـ spool المشترك بين الـ workers
+PHOTO_CACHE_MAX_BYTES = int(os.getenv("PHOTO_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+PHOTO_SPOOL_DIR = os.getenv("PHOTO_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "ordertaker-photos"))
+# كل كم ثانية يتم حذف ملفات الـ spool المنتهية (على deletion_scheduler وليس أثناء حفظ الصور)
+PHOTO_SPOOL_SWEEP_INTERVAL = float(os.getenv("PHOTO_SPOOL_SWEEP_INTERVAL", 300))
+
+class PhotoCache:
+    """
+    كل صورة تُكتب في ملف داخل الـ spool (write-through) حتى يقدمها أي worker عبر mmap،
+    و LRU محدود الحجم في الذاكرة (photo_id → bytes) مع انتهاء صلاحية يوفر قراءة الملف في نفس الـ worker
+    """
+
+    def __init__(self, max_bytes, spool_dir, ttl):
+        self.max_bytes = max_bytes
+        self.spool_dir = spool_dir
+        self.ttl = ttl
+        self.entries = OrderedDict()   # photo_id → (data, expires_at)
+        self.size = 0
+        self.lock = threading.Lock()
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def spool_path(self, photo_id):
+        return os.path.join(self.spool_dir, f"{photo_id}.jpg")
+
+    def put(self, photo_id, data):
+        # الكتابة في الـ spool قبل إرجاع الرابط، فطلب /photos قد يصل إلى worker آخر
+        self.write_spool(photo_id, data)
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            self.purge_expired()
+            if len(data) > self.max_bytes:
+                return
+            self.entries[photo_id] = (data, expires_at)
+            self.size += len(data)
+            while self.size > self.max_bytes and self.entries:
+                old_id, (old_data, old_expires) = self.entries.popitem(last=False)
+                self.size -= len(old_data)
+
+    def write_spool(self, photo_id, data):
+        tmp_path = self.spool_path(photo_id) + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.spool_path(photo_id))
+
+    def purge_expired(self):
+        # نسخ الذاكرة فقط (self.lock يجب أن يكون محجوزاً)، ملفات الـ spool يحذفها sweep_spool
+        now = time.time()
+        while self.entries:
+            photo_id, (data, expires_at) = next(iter(self.entries.items()))
+            if expires_at > now:
+                break
+            del self.entries[photo_id]
+            self.size -= len(data)
+
+    def sweep_spool(self):
+        # حذف ملفات الـ spool المنتهية (قد تكون من worker آخر) بدون حجز self.lock
+        now = time.time()
+        for name in os.listdir(self.spool_dir):
+            path = os.path.join(self.spool_dir, name)
+            try:
+                if os.path.getmtime(path) + self.ttl < now:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, photo_id):
+        """
+        ترجع (bytes أو mmap، دالة الإغلاق) أو None
+        """
+        with self.lock:
+            entry = self.entries.get(photo_id)
+            if entry:
+                self.entries.move_to_end(photo_id)
+                return entry[0], None
+        try:
+            with open(self.spool_path(photo_id), 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return mapped, mapped.close
+        except (OSError, ValueError):
+            return None
+
+photo_cache = None
+
+def get_photo_cache():
+    global photo_cache
+    if photo_cache is None:
+        photo_cache = PhotoCache(PHOTO_CACHE_MAX_BYTES, PHOTO_SPOOL_DIR, PHOTO_URL_TTL)
+        deletion_scheduler.schedule("photo-spool-sweep", PHOTO_SPOOL_SWEEP_INTERVAL, sweep_photo_spool)
+    return photo_cache
+
+def sweep_photo_spool(batch):
+    # مهمة دورية على deletion_scheduler تعيد جدولة نفسها
     try:
-        token = get_sendpulse_token()
-        if not token:
-            logger.error("No token available for SendPulse")
+        photo_cache.sweep_spool()
+    finally:
+        deletion_scheduler.schedule("photo-spool-sweep", PHOTO_SPOOL_SWEEP_INTERVAL, sweep_photo_spool)
+
+def photo_url_key():
+    # مفتاح التوقيع ثابت بين الـ workers وبعد إعادة التشغيل
+    secret = os.getenv("PHOTO_URL_SECRET") or f"photo-url:{os.getenv('TELEGRAM_TOKEN')}"
+    return hashlib.sha256(secret.encode()).digest()
+
+def sign_photo_id(photo_id, expires_at):
+    return hmac.new(photo_url_key(), f"{photo_id}:{expires_at}".encode(), hashlib.sha256).hexdigest()[:32]
+
+def verify_photo_signature(photo_id, expires_at, signature):
+    try:
+        if int(expires_at) < time.time():
             return False
-            
-        url = "https://api.sendpulse.com/telegram/contacts/send"
+    except (TypeError, ValueError):
+        return False
+    return hmac.compare_digest(sign_photo_id(photo_id, expires_at), signature or "")
+
+def download_photo_bytes(telegram_file_url):
+    # ترجع None إذا فشل التحميل أو كانت الصورة أكبر من PHOTO_STREAM_MAX_BYTES
+    with telegram_client.download(telegram_file_url) as response:
+        if response.status_code != 200:
+            logger.error("Failed to download photo: %s", response.status_code)
+            return None
+        data = bytearray()
+        for chunk in response.iter_content(chunk_size=PHOTO_STREAM_CHUNK_SIZE):
+            data.extend(chunk)
+            if len(data) > PHOTO_STREAM_MAX_BYTES:
+                logger.warning("Photo too large for self-hosting, falling back to upload service")
+                return None
+        return bytes(data)
+
+def create_photo_url(telegram_file_url, contact_id):
+    """
+    إنشاء رابط موقّع ومؤقت للصورة يقدمه OrderTaker بنفسه
+    يرجع لـ tmpfiles.org إذا لم يكن PUBLIC_BASE_URL معرّفاً أو كانت الصورة كبيرة
+    """
+    if PUBLIC_BASE_URL:
+        try:
+            data = download_photo_bytes(telegram_file_url)
+            if data:
+                photo_id = secrets.token_urlsafe(16)
+                get_photo_cache().put(photo_id, data)
+                expires_at = int(time.time()) + PHOTO_URL_TTL
+                signature = sign_photo_id(photo_id, expires_at)
+                logger.info("🖼️ Photo for contact %s cached as %s (%s bytes)", contact_id, photo_id, len(data))
+                return f"{PUBLIC_BASE_URL}/photos/{photo_id}.jpg?exp={expires_at}&sig={signature}"
+        except Exception as e:
+            logger.error("Error caching photo for self-hosting: %s", e)
+
+    return download_and_create_temp_url(telegram_file_url, contact_id)
+
+# =============================
+# 13. إرسال صورة للعميل عبر SendPulse API (Telegram)
+# =============================
+def send_photo_to_client_telegram(contact_id, photo_url):
+    try:
+        path = "/telegram/contacts/send"
         
         payload = {
             "contact_id": contact_id,
@@ -305,36 +1400,31 @@ def send_photo_to_client_telegram(contact_id, photo_url):
             }
         }
         
-        headers = {"Authorization": f"Bearer {token}"}
+        logger.info("Sending photo to Telegram contact %s", contact_id)
+        logger.info("Photo URL: %s", photo_url)
         
-        logger.info(f"Sending photo to Telegram contact {contact_id}")
-        logger.info(f"Photo URL: {photo_url}")
-        
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+        response = sendpulse_client.post(path, payload)
+        if response is None:
+            return False
         
-        logger.info(f"SendPulse Telegram response status: {response.status_code}")
+        logger.info("SendPulse Telegram response status: %s", response.status_code)
         
         if response.status_code == 200:
-            logger.info(f"Photo sent successfully to Telegram client {contact_id}")
+            logger.info("Photo sent successfully to Telegram client %s", contact_id)
             return True
         else:
-            logger.error(f"Failed to send photo to Telegram {contact_id}: {response.status_code}")
+            logger.error("Failed to send photo to Telegram %s: %s", contact_id, response.status_code)
             return False
     except Exception as e:
-        logger.error(f"Error sending photo to Telegram client: {e}")
+        logger.error("Error sending photo to Telegram client: %s", e)
         return False
 
 # =============================
-# 10. إرسال صورة للعميل عبر SendPulse API (Messenger)
+# 14. إرسال صورة للعميل عبر SendPulse API (Messenger)
 # =============================
 def send_photo_to_client_messenger(contact_id, photo_url):
     try:
-        token = get_sendpulse_token()
-        if not token:
-            logger.error("No token available for SendPulse")
-            return False
-            
-        url = "https://api.sendpulse.com/messenger/contacts/send"
+        path = "/messenger/contacts/send"
         
         payload = {
             "contact_id": contact_id,
@@ -346,27 +1436,27 @@ def send_photo_to_client_messenger(contact_id, photo_url):
             }
         }
         
-        headers = {"Authorization": f"Bearer {token}"}
-        
-        logger.info(f"Sending photo to Messenger contact {contact_id}")
-        logger.info(f"Photo URL: {photo_url}")
+        logger.info("Sending photo to Messenger contact %s", contact_id)
+        logger.info("Photo URL: %s", photo_url)
         
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+        response = sendpulse_client.post(path, payload)
+        if response is None:
+            return False
         
-        logger.info(f"SendPulse Messenger response status: {response.status_code}")
+        logger.info("SendPulse Messenger response status: %s", response.status_code)
         
         if response.status_code == 200:
-            logger.info(f"Photo sent successfully to Messenger client {contact_id}")
+            logger.info("Photo sent successfully to Messenger client %s", contact_id)
             return True
         else:
-            logger.error(f"Failed to send photo to Messenger {contact_id}: {response.status_code}")
+            logger.error("Failed to send photo to Messenger %s: %s", contact_id, response.status_code)
             return False
     except Exception as e:
-        logger.error(f"Error sending photo to Messenger client: {e}")
+        logger.error("Error sending photo to Messenger client: %s", e)
         return False
 
 # =============================
-# 11. دالة موحدة لإرسال الصور بناءً على القناة
+# 15. دالة موحدة لإرسال الصور بناءً على القناة
 # =============================
 def send_photo_to_client(contact_id, photo_url, channel):
     if channel == "telegram":
@@ -374,12 +1464,83 @@ def send_photo_to_client(contact_id, photo_url, channel):
     elif channel == "messenger":
         return send_photo_to_client_messenger(contact_id, photo_url)
     else:
-        logger.error(f"Unknown channel for photo sending: {channel}")
+        logger.error("Unknown channel for photo sending: %s", channel)
         return False
 
 # =============================
-# 12. دالة تنسيق بيانات الطلب - محسنة للتعامل مع JSON
+# 16. دالة تنسيق بيانات الطلب - محسنة للتعامل مع JSON
 # =============================
+# الأنماط الشائعة في بيانات الطلب (الترتيب مهم: أول نمط يطابق هو المعتمد)
+ORDER_FIELD_PATTERNS = {
+    '👤': [r'العميل\s*(.+)', r'اسم\s*(.+)', r'Name\s*(.+)'],
+    '📱': [r'تليجرام\s*(.+)', r'تيليجرام\s*(.+)', r'@(\w+)', r'username\s*(.+)'],
+    '🛒': [r'شفــت\s*(.+)', r'منتج\s*(.+)', r'Product\s*(.+)', r'Agent\s*(.+)'],
+    '💰': [r'سعـر البيـع\s*(.+)', r'سعر\s*(.+)', r'Price\s*(.+)', r'PriceIN\s*(.+)'],
+    '💵': [r'المبلـغ\s*(.+)', r'مبلغ\s*(.+)', r'Amount\s*(.+)', r'much2\s*(.+)'],
+    '💳': [r'جنيـه\s*(.+)', r'دفع\s*(.+)', r'Payment\s*(.+)', r'PaidBy\s*(.+)'],
+    '🏦': [r'المحفظـة\s*(.+)', r'محفظة\s*(.+)', r'Wallet\s*(.+)', r'CashControl\s*(.+)'],
+    '🧾': [r'الإيصـال\s*(.+)', r'إيصال\s*(.+)', r'Receipt\s*(.+)', r'ShortUrl\s*(.+)'],
+    '💎': [r'الرصيــد\s*(.+)', r'رصيد\s*(.+)', r'Balance\s*(.+)', r'much\s*(.+)'],
+    '💻': [r'منصة\s*(.+)', r'Platform\s*(.+)', r'\$\s*(.+)'],
+    '🆔': [r'ORDER\s*(.+)', r'رقم\s*(.+)', r'ID\s*(.+)', r'redid\s*(.+)'],
+    '📝': [r'ملاحظ\s*(.+)', r'Note\s*(.+)', r'ملاحظة\s*(.+)']
+}
+
+def order_pattern_keyword(pattern):
+    """
+    الجزء الثابت في بداية النمط (مثل "Price" في r"Price\s*(.+)")، أو "" إذا بدأ النمط برمز regex
+    النمط لا يمكن أن يطابق سطراً لا يحتوي هذه الكلمة (بنفس re.IGNORECASE)، لذلك يكفي البحث عنها قبل تشغيله
+    """
+    keyword = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            keyword.append(pattern[i + 1])
+            i += 2
+        elif char in "\\.^$*+?{}[]|()" or char.isspace():
+            break
+        else:
+            keyword.append(char)
+            i += 1
+    return "".join(keyword)
+
+def compile_order_field_matchers(patterns):
+    """
+    (الرمز، الكلمة بحروف صغيرة، الكلمة كـ regex، النمط المترجم) بنفس ترتيب الأنماط: أول نمط يطابق هو المعتمد
+    re.IGNORECASE يطابق حروفاً غير ASCII مع حروف ASCII (مثل K و ſ و İ)، لذلك المقارنة النصية
+    بـ lower() تستخدم فقط للأسطر ASCII، وباقي الأسطر تبحث عن الكلمة بـ regex حرفي بنفس الـ flags
+    """
+    matchers = []
+    for emoji, pattern_list in patterns.items():
+        for pattern in pattern_list:
+            keyword = order_pattern_keyword(pattern)
+            matchers.append((emoji, keyword.lower(), re.compile(re.escape(keyword), re.IGNORECASE),
+                             re.compile(pattern, re.IGNORECASE)))
+    return matchers
+
+ORDER_FIELD_MATCHERS = compile_order_field_matchers(ORDER_FIELD_PATTERNS)
+# النص المنظم مسبقاً يحتوي على أحد هذه الرموز
+FORMATTED_ORDER_EMOJIS = re.compile('|'.join(ORDER_FIELD_PATTERNS))
+ORDER_LINE_SEPARATORS = re.compile(r'[،,;|]')
+
+def match_order_field(line):
+    """
+    ترجع (الرمز، القيمة) لأول نمط يطابق السطر أو None
+    الأنماط التي لا توجد كلمتها الثابتة في السطر يتم تخطيها بدون تشغيل الـ regex الكامل
+    """
+    lowered = line.lower() if line.isascii() else None
+    for emoji, keyword, keyword_pattern, pattern in ORDER_FIELD_MATCHERS:
+        if lowered is not None:
+            found = keyword in lowered
+        else:
+            found = keyword_pattern.search(line)
+        if found:
+            match = pattern.search(line)
+            if match:
+                return emoji, match.group(1).strip()
+    return None
+
 def format_order_data(order_data):
     """
     تنسيق بيانات الطلب لتكون أكثر تنظيماً ووضوحاً
@@ -420,53 +1581,28 @@ def format_order_data(order_data):
                 return order_data
                 
             # إذا كان النص يحتوي على رموز تعبيرية، نعتقد أنه منظم مسبقاً
-            if any(emoji in order_data for emoji in ['👤', '📱', '🛒', '💰', '💵', '💳', '🏦', '🧾', '💎', '💻', '🆔', '📝']):
+            if FORMATTED_ORDER_EMOJIS.search(order_data):
                 return order_data
 
             formatted_lines = []
             
-            # البحث عن الأنماط الشائعة في البيانات
-            patterns = {
-                '👤': [r'العميل\s*(.+)', r'اسم\s*(.+)', r'Name\s*(.+)'],
-                '📱': [r'تليجرام\s*(.+)', r'تيليجرام\s*(.+)', r'@(\w+)', r'username\s*(.+)'],
-                '🛒': [r'شفــت\s*(.+)', r'منتج\s*(.+)', r'Product\s*(.+)', r'Agent\s*(.+)'],
-                '💰': [r'سعـر البيـع\s*(.+)', r'سعر\s*(.+)', r'Price\s*(.+)', r'PriceIN\s*(.+)'],
-                '💵': [r'المبلـغ\s*(.+)', r'مبلغ\s*(.+)', r'Amount\s*(.+)', r'much2\s*(.+)'],
-                '💳': [r'جنيـه\s*(.+)', r'دفع\s*(.+)', r'Payment\s*(.+)', r'PaidBy\s*(.+)'],
-                '🏦': [r'المحفظـة\s*(.+)', r'محفظة\s*(.+)', r'Wallet\s*(.+)', r'CashControl\s*(.+)'],
-                '🧾': [r'الإيصـال\s*(.+)', r'إيصال\s*(.+)', r'Receipt\s*(.+)', r'ShortUrl\s*(.+)'],
-                '💎': [r'الرصيــد\s*(.+)', r'رصيد\s*(.+)', r'Balance\s*(.+)', r'much\s*(.+)'],
-                '💻': [r'منصة\s*(.+)', r'Platform\s*(.+)', r'\$\s*(.+)'],
-                '🆔': [r'ORDER\s*(.+)', r'رقم\s*(.+)', r'ID\s*(.+)', r'redid\s*(.+)'],
-                '📝': [r'ملاحظ\s*(.+)', r'Note\s*(.+)', r'ملاحظة\s*(.+)']
-            }
-            
             # تقسيم النص إلى أسطر إذا كان يحتوي على فواصل
             lines = order_data.split('\n')
             if len(lines) == 1:
                 # إذا كان سطر واحد، حاول تقسيمه بفواصل أخرى
-                lines = re.split(r'[،,;|]', order_data)
+                lines = ORDER_LINE_SEPARATORS.split(order_data)
             
             for line in lines:
                 line = line.strip()
                 if not line:
                     continue
                     
-                matched = False
-                # البحث عن أنماط في السطر
-                for emoji, pattern_list in patterns.items():
-                    for pattern in pattern_list:
-                        match = re.search(pattern, line, re.IGNORECASE)
-                        if match:
-                            value = match.group(1).strip()
-                            formatted_lines.append(f"{emoji} {value}")
-                            matched = True
-                            break
-                    if matched:
-                        break
-                
-                # إذا لم يتم العثور على نمط، أضف السطر كما هو مع رمز عام
-                if not matched:
+                # البحث عن أنماط في السطر (أول نمط يطابق بعد تصفية الكلمات الثابتة)
+                field = match_order_field(line)
+                if field:
+                    formatted_lines.append(f"{field[0]} {field[1]}")
+                else:
+                    # إذا لم يتم العثور على نمط، أضف السطر كما هو مع رمز عام
                     formatted_lines.append(f"📌 {line}")
             
             return "\n".join(formatted_lines)
@@ -474,398 +1610,1604 @@ def format_order_data(order_data):
             return str(order_data)
         
     except Exception as e:
-        logger.error(f"Error formatting order data: {e}")
+        logger.error("Error formatting order data: %s", e)
         return str(order_data)
 
 # =============================
-# 13. إرسال رسالة إلى جروب تليجرام بناءً على السيناريو
+# 17. إرسال رسالة إلى جروب تليجرام بناءً على السيناريو
 # =============================
-def send_scenario_message_to_telegram(message, contact_id, channel, scenario):
+def json_dumps(value):
+    # ترميز JSON مضغوط، باستخدام orjson إن كان متاحاً
+    if orjson is not None:
+        return orjson.dumps(value).decode("utf-8")
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+class KeyboardTemplate:
+    """
+    لوحة أزرار مرمّزة JSON مرة واحدة عند التشغيل
+    مع أماكن فارغة لـ contact_id و channel تُملأ لكل رسالة
+    """
+    CONTACT_SLOT = "__CONTACT_ID__"
+    CHANNEL_SLOT = "__CHANNEL__"
+
+    def __init__(self, rows):
+        encoded = json_dumps({"inline_keyboard": rows})
+        self.parts = re.split(f"({self.CONTACT_SLOT}|{self.CHANNEL_SLOT})", encoded)
+
+    def render(self, contact_id, channel):
+        # json_dumps(...)[1:-1] يهرّب القيمة لتوضع داخل نص JSON موجود
+        values = {
+            self.CONTACT_SLOT: json_dumps(str(contact_id))[1:-1],
+            self.CHANNEL_SLOT: json_dumps(str(channel))[1:-1]
+        }
+        return "".join([values.get(part, part) for part in self.parts])
+
+def build_keyboard_templates():
+    contact, channel = KeyboardTemplate.CONTACT_SLOT, KeyboardTemplate.CHANNEL_SLOT
+    # رابط SendPulse مع contact_id و channel
+    open_chat = [{"text": "💬 فتح المحادثة", "url": f"https://login.sendpulse.com/chatbots/chats?contact_id={contact}&channel={channel}"}]
+
+    def sendpic(scenario):
+        return [{"text": "📷 إرسال صورة", "callback_data": f"sendpic:{contact}:{channel}:{scenario}"}]
+
+    return {
+        # طلب جديد - جميع الأزرار (وهو أيضاً القالب الافتراضي للسيناريو غير المعروف)
+        "order": KeyboardTemplate([
+            [
+                {"text": "✅ تم التنفيذ", "callback_data": f"done:{contact}:{channel}:order"},
+                {"text": "❌ إلغاء", "callback_data": f"cancel:{contact}:{channel}:order"},
+            ],
+            sendpic("order"),
+            [
+                {"text": "🔄 تحويل ناقص", "callback_data": f"transfer_minus:{contact}:{channel}"},
+                {"text": "🔄 تحويل زائد", "callback_data": f"transfer_plus:{contact}:{channel}"}
+            ],
+            open_chat
+        ]),
+        # شكوى تأخر - زر فتح المحادثة وزر إرسال صورة
+        "delay": KeyboardTemplate([sendpic("delay"), open_chat]),
+        # طلب صورة - زر إرسال صورة فقط
+        "photo": KeyboardTemplate([sendpic("photo")])
+    }
+
+KEYBOARD_TEMPLATES = build_keyboard_templates()
+SCENARIO_PAYLOAD_TEMPLATE = '{"chat_id":%s,"text":%s,"parse_mode":"HTML","reply_markup":%s}'
+
+class DispatchError(Exception):
+    """
+    فشل إرسال رسالة الجروب. retryable=True فقط إذا كان مؤكداً أن تليجرام لم ينشر الرسالة
+    (خطأ اتصال قبل الإرسال، circuit مفتوح، 429 أو 5xx)، لأن sendMessage ليس idempotent
+    """
+
+    def __init__(self, description, retryable=False):
+        super().__init__(description)
+        self.retryable = retryable
+
+def request_never_sent(error):
+    # ConnectTimeout و NewConnectionError تحدث قبل إرسال أي byte، أما read timeout فقد يصل الطلب لتليجرام
+    if isinstance(error, (CircuitOpenError, requests.exceptions.ConnectTimeout)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], "reason", None), urllib3.exceptions.NewConnectionError)
+    return False
+
+def send_scenario_message_to_telegram(message, contact_id, channel, scenario, raise_errors=False):
+    """
+    ترجع message_id أو False عند الفشل
+    raise_errors: رفع DispatchError بدلاً من False حتى يقرر طابور الإرسال إن كانت إعادة المحاولة آمنة
+    """
     try:
         token = os.getenv("TELEGRAM_TOKEN")
         group_id = os.getenv("GROUP_ID")
 
         if not token or not group_id:
             logger.error("TELEGRAM_TOKEN or GROUP_ID not set")
+            if raise_errors:
+                raise DispatchError("TELEGRAM_TOKEN or GROUP_ID not set")
             return False
 
-        url = f"https://api.telegram.org/bot{token}/sendMessage"
-        
-        # إنشاء رابط SendPulse مع contact_id و channel
-        sendpulse_url = f"https://login.sendpulse.com/chatbots/chats?contact_id={contact_id}&channel={channel}"
-        
         # إضافة رمز القناة إلى الرسالة
         channel_icon = "📱" if channel == "messenger" else "✈️"
         message_with_channel = f"{channel_icon} {message}"
         
-        # ⚡ **بناء الأزرار بناءً على نوع السيناريو**
-        keyboard = {"inline_keyboard": []}
-        
-        if scenario == "order":
-            # طلب جديد - جميع الأزرار
-            keyboard["inline_keyboard"] = [
-                [
-                    {"text": "✅ تم التنفيذ", "callback_data": f"done:{contact_id}:{channel}:order"},
-                    {"text": "❌ إلغاء", "callback_data": f"cancel:{contact_id}:{channel}:order"},
-                ],
-                [
-                    {"text": "📷 إرسال صورة", "callback_data": f"sendpic:{contact_id}:{channel}:order"},
-                ],
-                [
-                    {"text": "🔄 تحويل ناقص", "callback_data": f"transfer_minus:{contact_id}:{channel}"},
-                    {"text": "🔄 تحويل زائد", "callback_data": f"transfer_plus:{contact_id}:{channel}"}
-                ],
-                [
-                    {"text": "💬 فتح المحادثة", "url": sendpulse_url}
-                ]
-            ]
-        elif scenario == "delay":
-            # شكوى تأخر - زر فتح المحادثة وزر إرسال صورة
-            keyboard["inline_keyboard"] = [
-                [
-                    {"text": "📷 إرسال صورة", "callback_data": f"sendpic:{contact_id}:{channel}:delay"},
-                ],
-                [
-                    {"text": "💬 فتح المحادثة", "url": sendpulse_url}
-                ]
-            ]
-        elif scenario == "photo":
-            # طلب صورة - زر إرسال صورة فقط
-            keyboard["inline_keyboard"] = [
-                [
-                    {"text": "📷 إرسال صورة", "callback_data": f"sendpic:{contact_id}:{channel}:photo"},
-                ]
-            ]
-        else:
-            # سيناريو غير معروف - نستخدم الأزرار الافتراضية (order)
-            keyboard["inline_keyboard"] = [
-                [
-                    {"text": "✅ تم التنفيذ", "callback_data": f"done:{contact_id}:{channel}:order"},
-                    {"text": "❌ إلغاء", "callback_data": f"cancel:{contact_id}:{channel}:order"},
-                ],
-                [
-                    {"text": "📷 إرسال صورة", "callback_data": f"sendpic:{contact_id}:{channel}:order"},
-                ],
-                [
-                    {"text": "🔄 تحويل ناقص", "callback_data": f"transfer_minus:{contact_id}:{channel}"},
-                    {"text": "🔄 تحويل زائد", "callback_data": f"transfer_plus:{contact_id}:{channel}"}
-                ],
-                [
-                    {"text": "💬 فتح المحادثة", "url": sendpulse_url}
-                ]
-            ]
-        
-        payload = {
-            "chat_id": group_id,
-            "text": message_with_channel,
-            "parse_mode": "HTML",
-            "reply_markup": keyboard
-        }
-        response = requests.post(url, json=payload, timeout=30)
+        # ⚡ **الأزرار من القالب المبني مسبقاً للسيناريو (الافتراضي: order)**
+        keyboard = KEYBOARD_TEMPLATES.get(scenario, KEYBOARD_TEMPLATES["order"])
+        body = SCENARIO_PAYLOAD_TEMPLATE % (
+            json_dumps(group_id),
+            json_dumps(message_with_channel),
+            keyboard.render(contact_id, channel)
+        )
+        response = telegram_client.post_raw("sendMessage", body.encode("utf-8"), group_id)
         
         if response.status_code == 200:
             message_id = response.json()['result']['message_id']
             
-            # حفظ معرف الرسالة في الذاكرة لتتبع رسائل العميل مع الوقت
-            if contact_id not in client_messages:
-                client_messages[contact_id] = {}
+            # حفظ معرف الرسالة لتتبع رسائل العميل مع الوقت (ومواعيد التأخر للطلبات)
+            state_store.record_message(contact_id, scenario, message_id, channel, datetime.now())
+            
+            logger.info("✅ Message sent and stored: contact_id=%s, scenario=%s, message_id=%s", contact_id, scenario, message_id)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📊 Current client_messages count: %s", state_store.count())
             
-            client_messages[contact_id][scenario] = {
+            return message_id
+        else:
+            logger.error("❌ Failed to send to Telegram: %s", response.status_code)
+            if raise_errors:
+                # 429 و 5xx: الرسالة لم تُنشر، باقي 4xx أخطاء دائمة (payload غير صالح، جروب غير موجود...)
+                status = response.status_code
+                raise DispatchError(f"Telegram HTTP {status}", status == 429 or status >= 500)
+            return False
+    except DispatchError:
+        raise
+    except Exception as e:
+        logger.error("❌ Error sending to Telegram: %s", e)
+        if raise_errors:
+            if request_never_sent(e):
+                raise DispatchError(str(e), True) from e
+            if isinstance(e, requests.exceptions.RequestException):
+                raise DispatchError(f"{e} (the message may have been posted)") from e
+            raise DispatchError(str(e)) from e
+        return False
+
+# =============================
+# 18. فهرس مواعيد تأخر الطلبات (min-heap)
+# =============================
+# المدة التي يعتبر بعدها الطلب متأخراً
+ORDER_DELAY_SECONDS = int(os.getenv("ORDER_DELAY_SECONDS", 300))
+# إعادة محاولة إرسال التنبيه إذا فشل
+DELAY_ALERT_RETRY_SECONDS = int(os.getenv("DELAY_ALERT_RETRY_SECONDS", 60))
+
+class OrderDeadlineIndex:
+    """
+    heap لمواعيد التأخر (due_ts, contact_id) بدلاً من فحص كل الطلبات كل دقيقة
+    الإضافة والحذف O(log n)، والحذف يتم بشكل lazy عند الوصول للعنصر
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}   # contact_id → due_ts
+        self.condition = threading.Condition()
+
+    def add(self, contact_id, due_ts):
+        with self.condition:
+            self.deadlines[contact_id] = due_ts
+            heapq.heappush(self.heap, (due_ts, contact_id))
+            # إيقاظ الـ checker إذا أصبح هذا الموعد الأقرب
+            if self.heap[0] == (due_ts, contact_id):
+                self.condition.notify_all()
+
+    def remove(self, contact_id):
+        with self.condition:
+            self.deadlines.pop(contact_id, None)
+            if len(self.heap) > 64 and len(self.heap) > 2 * len(self.deadlines):
+                self.heap = [(due, cid) for cid, due in self.deadlines.items()]
+                heapq.heapify(self.heap)
+
+    def next_deadline(self):
+        with self.condition:
+            self.drop_stale()
+            return self.heap[0][0] if self.heap else None
+
+    def drop_stale(self):
+        while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    def pop_due(self, now):
+        with self.condition:
+            due = []
+            self.drop_stale()
+            while self.heap and self.heap[0][0] <= now:
+                due_ts, contact_id = heapq.heappop(self.heap)
+                del self.deadlines[contact_id]
+                due.append((contact_id, due_ts))
+                self.drop_stale()
+            return due
+
+    def wait_until_due(self):
+        # النوم حتى أقرب موعد بالضبط (أو حتى إضافة موعد أقرب)
+        with self.condition:
+            while True:
+                self.drop_stale()
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                wait_time = self.heap[0][0] - time.time()
+                if wait_time <= 0:
+                    return
+                self.condition.wait(wait_time)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+# =============================
+# 19. سجل تغييرات الحالة (journal) مع snapshots دورية
+# =============================
+# مجلد الـ journal (فارغ = بدون حفظ على القرص)
+# الـ journal لـ process واحد فقط: مع عدة gunicorn workers أول worker يحجز المجلد والباقي يعمل بدونه،
+# ولحفظ حالة كل الـ workers استخدم STATE_BACKEND=sqlite
+STATE_JOURNAL_DIR = os.getenv("STATE_JOURNAL_DIR", "")
+# الكتابة على القرص تتم كل هذه المدة دفعة واحدة (group commit)
+STATE_JOURNAL_FLUSH_MS = int(os.getenv("STATE_JOURNAL_FLUSH_MS", 50))
+# عدد السجلات التي يتم بعدها ضغط الـ journal في snapshot
+STATE_JOURNAL_COMPACT_EVERY = int(os.getenv("STATE_JOURNAL_COMPACT_EVERY", 10000))
+
+class StateJournal:
+    """
+    journal بإضافة فقط (سطر JSON لكل تغيير) يُكتب من thread خلفي
+    الإضافة لا تلمس القرص: السطور تُجمع في الذاكرة ثم تُكتب مع fsync واحد لكل دفعة
+    عند تجاوز STATE_JOURNAL_COMPACT_EVERY يتم كتابة snapshot كامل وتفريغ الـ journal
+    كل عملية تضبط أو تحذف مفتاحاً واحداً، لذلك إعادة تطبيق الـ journal على snapshot أحدث آمنة
+    """
+
+    def __init__(self, directory, flush_interval=STATE_JOURNAL_FLUSH_MS / 1000.0,
+                 compact_every=STATE_JOURNAL_COMPACT_EVERY):
+        os.makedirs(directory, exist_ok=True)
+        # compact من process آخر يستبدل الـ snapshot بحالته هو فقط ويفرغ الـ journal، لذلك المجلد لمالك واحد
+        self.lock_fd = os.open(os.path.join(directory, "state.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self.lock_fd)
+            raise RuntimeError(f"State journal {directory} is already used by another process")
+        self.journal_path = os.path.join(directory, "state.journal")
+        self.snapshot_path = os.path.join(directory, "state.snapshot")
+        self.flush_interval = flush_interval
+        self.compact_every = compact_every
+        self.buffer = []
+        self.entries_since_snapshot = 0
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.snapshot_fn = None
+        self.file = None
+        self.thread = None
+
+    def load(self):
+        # قراءة آخر snapshot ثم سجلات الـ journal بعده
+        snapshot = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+
+        entries = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # آخر سطر قد يكون ناقصاً إذا توقف البرنامج أثناء الكتابة
+                        logger.warning("Skipping corrupt journal line in %s", self.journal_path)
+        self.entries_since_snapshot = len(entries)
+        return snapshot, entries
+
+    def append(self, entry):
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + "\n"
+        with self.condition:
+            self.buffer.append(line)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="state-journal")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def take_buffer(self):
+        with self.condition:
+            lines, self.buffer = self.buffer, []
+            return lines
+
+    def write_lines(self, lines):
+        if not lines:
+            return
+        with self.write_lock:
+            run_blocking(self.write_journal, "".join(lines))
+            self.entries_since_snapshot += len(lines)
+
+    def write_journal(self, text):
+        if self.file is None:
+            self.file = open(self.journal_path, 'a', encoding='utf-8')
+        self.file.write(text)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def flush(self):
+        self.write_lines(self.take_buffer())
+
+    def compact(self):
+        """
+        كتابة snapshot للحالة الحالية ثم تفريغ الـ journal
+        snapshot_fn تنسخ الحالة وتأخذ السطور المنتظرة تحت قفل المخزن
+        """
+        state, lines = self.snapshot_fn()
+        self.write_lines(lines)
+
+        with self.write_lock:
+            run_blocking(self.write_snapshot, state)
+            self.entries_since_snapshot = 0
+        logger.info("🗜️ State journal compacted into snapshot (%s contacts)", len(state.get('messages', {})))
+
+    def write_snapshot(self, state):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.journal_path, 'w', encoding='utf-8')
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        # كتابة السطور المنتظرة وتحرير المجلد لـ process أو journal آخر
+        self.flush()
+        with self.write_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        os.close(self.lock_fd)
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait(self.flush_interval)
+            try:
+                self.flush()
+                if self.snapshot_fn and self.entries_since_snapshot >= self.compact_every:
+                    self.compact()
+            except Exception as e:
+                logger.error("❌ Error writing state journal: %s", e)
+
+# =============================
+# 20. مخزن حالة الطلبات (ذاكرة أو SQLite مشترك بين الـ workers)
+# =============================
+# memory (الافتراضي، process واحد) أو sqlite (عدة workers في gunicorn)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_SQLITE_PATH = os.getenv("STATE_SQLITE_PATH", "ordertaker_state.db")
+# أقصى مدة نوم للـ checker مع مخزن مشترك (طلبات الـ workers الأخرى لا توقظه)
+STATE_POLL_INTERVAL = float(os.getenv("STATE_POLL_INTERVAL", 1))
+
+class StateStore(ABC):
+    """
+    الواجهة الموحدة لحالة الطلبات:
+    رسائل العملاء (contact_id → {scenario: {message_id, timestamp, channel}})،
+    الصور المنتظرة (chat_id → بيانات الطلب) ومواعيد تأخر الطلبات
+    shared: الحالة مشتركة بين الـ processes (يكفي checker واحد لكل الـ workers)
+    """
+    shared = False
+
+    @abstractmethod
+    def record_message(self, contact_id, scenario, message_id, channel, timestamp):
+        pass
+
+    @abstractmethod
+    def remove_message(self, contact_id, scenario):
+        pass
+
+    @abstractmethod
+    def get_contact(self, contact_id):
+        pass
+
+    @abstractmethod
+    def all_contacts(self):
+        pass
+
+    @abstractmethod
+    def count(self):
+        pass
+
+    @abstractmethod
+    def set_pending_photo(self, chat_id, data):
+        pass
+
+    @abstractmethod
+    def pop_pending_photo(self, chat_id):
+        pass
+
+    @abstractmethod
+    def pending_photos_count(self):
+        pass
+
+    @abstractmethod
+    def set_deadline(self, contact_id, due_ts):
+        pass
+
+    @abstractmethod
+    def pop_due_orders(self, now):
+        pass
+
+    @abstractmethod
+    def wait_until_due(self):
+        pass
+
+class MemoryStateStore(StateStore):
+    """
+    المخزن الافتراضي: القواميس الموجودة في الذاكرة + heap للمواعيد
+    مع journal اختياري لاستعادة الحالة بعد إعادة التشغيل
+    """
+
+    def __init__(self, messages, photos, journal=None):
+        self.messages = messages
+        self.photos = photos
+        self.deadlines = OrderDeadlineIndex()
+        self.lock = threading.Lock()
+        self.journal = journal
+        if journal:
+            self.restore()
+            journal.snapshot_fn = self.snapshot_state
+            atexit.register(journal.flush)
+
+    def log_change(self, entry):
+        # يُستدعى تحت self.lock حتى يطابق ترتيب الـ journal ترتيب التغييرات
+        if self.journal:
+            self.journal.append(entry)
+
+    def apply_change(self, entry):
+        op = entry['op']
+        if op == 'record':
+            self.messages.setdefault(entry['c'], {})[entry['s']] = {
+                'message_id': entry['m'],
+                'timestamp': datetime.fromtimestamp(entry['t']),
+                'channel': entry['ch']
+            }
+        elif op == 'remove':
+            scenarios = self.messages.get(entry['c'], {})
+            scenarios.pop(entry['s'], None)
+            if not scenarios:
+                self.messages.pop(entry['c'], None)
+        elif op == 'photo':
+            self.photos[entry['chat']] = entry['d']
+        elif op == 'photo_pop':
+            self.photos.pop(entry['chat'], None)
+
+    def restore(self):
+        started = time.monotonic()
+        snapshot, entries = self.journal.load()
+
+        for contact_id, scenarios in snapshot.get('messages', {}).items():
+            for scenario, data in scenarios.items():
+                self.apply_change({'op': 'record', 'c': contact_id, 's': scenario, **data})
+        self.photos.update(snapshot.get('photos', {}))
+        for entry in entries:
+            self.apply_change(entry)
+
+        # إعادة بناء مواعيد التأخر للطلبات التي لم يُرسل لها تنبيه بعد
+        for contact_id, scenarios in self.messages.items():
+            if 'order' in scenarios and 'delay' not in scenarios:
+                self.deadlines.add(contact_id, scenarios['order']['timestamp'].timestamp() + ORDER_DELAY_SECONDS)
+
+        logger.info("♻️ Restored %s contacts from journal (%s entries) in %.3fs", len(self.messages), len(entries), time.monotonic() - started)
+
+    def snapshot_state(self):
+        with self.lock:
+            state = {
+                'messages': {
+                    contact_id: {
+                        scenario: {'m': data['message_id'], 't': data['timestamp'].timestamp(), 'ch': data['channel']}
+                        for scenario, data in scenarios.items()
+                    }
+                    for contact_id, scenarios in self.messages.items()
+                },
+                'photos': dict(self.photos)
+            }
+            return state, self.journal.take_buffer()
+
+    def record_message(self, contact_id, scenario, message_id, channel, timestamp):
+        with self.lock:
+            self.messages.setdefault(contact_id, {})[scenario] = {
                 'message_id': message_id,
-                'timestamp': datetime.now(),
+                'timestamp': timestamp,
                 'channel': channel
             }
+            self.log_change({'op': 'record', 'c': contact_id, 's': scenario, 'm': message_id,
+                             't': timestamp.timestamp(), 'ch': channel})
+        # تسجيل موعد التأخر للطلب الجديد
+        if scenario == "order":
+            self.deadlines.add(contact_id, timestamp.timestamp() + ORDER_DELAY_SECONDS)
+
+    def remove_message(self, contact_id, scenario):
+        with self.lock:
+            scenarios = self.messages.get(contact_id)
+            if not scenarios or scenario not in scenarios:
+                return False
+            del scenarios[scenario]
+            if not scenarios:
+                del self.messages[contact_id]
+            self.log_change({'op': 'remove', 'c': contact_id, 's': scenario})
+        if scenario == "order":
+            self.deadlines.remove(contact_id)
+        return True
+
+    def get_contact(self, contact_id):
+        with self.lock:
+            return dict(self.messages.get(contact_id, {}))
+
+    def all_contacts(self):
+        with self.lock:
+            return {contact_id: dict(scenarios) for contact_id, scenarios in self.messages.items()}
+
+    def count(self):
+        return len(self.messages)
+
+    def set_pending_photo(self, chat_id, data):
+        with self.lock:
+            self.photos[chat_id] = data
+            self.log_change({'op': 'photo', 'chat': chat_id, 'd': data})
+
+    def pop_pending_photo(self, chat_id):
+        with self.lock:
+            data = self.photos.pop(chat_id, None)
+            if data is not None:
+                self.log_change({'op': 'photo_pop', 'chat': chat_id})
+            return data
+
+    def pending_photos_count(self):
+        return len(self.photos)
+
+    def set_deadline(self, contact_id, due_ts):
+        self.deadlines.add(contact_id, due_ts)
+
+    def pop_due_orders(self, now):
+        return self.deadlines.pop_due(now)
+
+    def wait_until_due(self):
+        self.deadlines.wait_until_due()
+
+class SqliteStateStore(StateStore):
+    """
+    مخزن SQLite بوضع WAL لمشاركة الحالة بين عدة workers على نفس الجهاز
+    اتصال مستقل لكل thread ولكل process (آمن بعد fork في gunicorn)
+    كل الاستعلامات تمر عبر run_blocking حتى لا توقف الـ event loop في وضع async
+    """
+    shared = True
+
+    def __init__(self, path, poll_interval=STATE_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.local = threading.local()
+        self.connection().executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                contact_id TEXT NOT NULL,
+                scenario TEXT NOT NULL,
+                message_id INTEGER,
+                channel TEXT,
+                timestamp REAL NOT NULL,
+                PRIMARY KEY (contact_id, scenario)
+            );
+            CREATE TABLE IF NOT EXISTS deadlines (
+                contact_id TEXT PRIMARY KEY,
+                due_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS deadlines_due_at ON deadlines (due_at);
+            CREATE TABLE IF NOT EXISTS pending_photos (
+                chat_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            );
+        """)
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def query(self, sql, params=()):
+        return run_blocking(self.run_query, sql, params)
+
+    def run_query(self, sql, params):
+        return self.connection().execute(sql, params).fetchall()
+
+    def transaction(self, statements):
+        return run_blocking(self.run_transaction, statements)
+
+    def run_transaction(self, statements):
+        # تنفيذ عدة عبارات في transaction واحدة تحجز الكتابة من البداية
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            results = [conn.execute(sql, params).fetchall() for sql, params in statements]
+            conn.execute("COMMIT")
+            return results
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def record_message(self, contact_id, scenario, message_id, channel, timestamp):
+        ts = timestamp.timestamp()
+        statements = [(
+            "INSERT OR REPLACE INTO messages (contact_id, scenario, message_id, channel, timestamp) VALUES (?, ?, ?, ?, ?)",
+            (contact_id, scenario, message_id, channel, ts)
+        )]
+        if scenario == "order":
+            statements.append((
+                "INSERT OR REPLACE INTO deadlines (contact_id, due_at) VALUES (?, ?)",
+                (contact_id, ts + ORDER_DELAY_SECONDS)
+            ))
+        self.transaction(statements)
+
+    def remove_message(self, contact_id, scenario):
+        statements = [
+            ("SELECT 1 FROM messages WHERE contact_id = ? AND scenario = ?", (contact_id, scenario)),
+            ("DELETE FROM messages WHERE contact_id = ? AND scenario = ?", (contact_id, scenario))
+        ]
+        if scenario == "order":
+            statements.append(("DELETE FROM deadlines WHERE contact_id = ?", (contact_id,)))
+        return bool(self.transaction(statements)[0])
+
+    def get_contact(self, contact_id):
+        rows = self.query(
+            "SELECT scenario, message_id, channel, timestamp FROM messages WHERE contact_id = ?",
+            (contact_id,)
+        )
+        return {
+            scenario: {'message_id': message_id, 'timestamp': datetime.fromtimestamp(ts), 'channel': channel}
+            for scenario, message_id, channel, ts in rows
+        }
+
+    def all_contacts(self):
+        contacts = {}
+        rows = self.query(
+            "SELECT contact_id, scenario, message_id, channel, timestamp FROM messages ORDER BY timestamp"
+        )
+        for contact_id, scenario, message_id, channel, ts in rows:
+            contacts.setdefault(contact_id, {})[scenario] = {
+                'message_id': message_id,
+                'timestamp': datetime.fromtimestamp(ts),
+                'channel': channel
+            }
+        return contacts
+
+    def count(self):
+        return self.query("SELECT COUNT(DISTINCT contact_id) FROM messages")[0][0]
+
+    def set_pending_photo(self, chat_id, data):
+        self.query(
+            "INSERT OR REPLACE INTO pending_photos (chat_id, data) VALUES (?, ?)",
+            (chat_id, json.dumps(data))
+        )
+
+    def pop_pending_photo(self, chat_id):
+        rows = self.transaction([
+            ("SELECT data FROM pending_photos WHERE chat_id = ?", (chat_id,)),
+            ("DELETE FROM pending_photos WHERE chat_id = ?", (chat_id,))
+        ])[0]
+        return json.loads(rows[0][0]) if rows else None
+
+    def pending_photos_count(self):
+        return self.query("SELECT COUNT(*) FROM pending_photos")[0][0]
+
+    def set_deadline(self, contact_id, due_ts):
+        self.query(
+            "INSERT OR REPLACE INTO deadlines (contact_id, due_at) VALUES (?, ?)",
+            (contact_id, due_ts)
+        )
+
+    def pop_due_orders(self, now):
+        # الاختيار والحذف في نفس الـ transaction حتى لا يرسل workerان نفس التنبيه
+        rows = self.transaction([
+            ("SELECT contact_id, due_at FROM deadlines WHERE due_at <= ? ORDER BY due_at", (now,)),
+            ("DELETE FROM deadlines WHERE due_at <= ?", (now,))
+        ])[0]
+        return [(contact_id, due_at) for contact_id, due_at in rows]
+
+    def wait_until_due(self):
+        while True:
+            next_due = self.query("SELECT MIN(due_at) FROM deadlines")[0][0]
+            now = time.time()
+            if next_due is not None and next_due <= now:
+                return
+            wait_time = self.poll_interval if next_due is None else min(next_due - now, self.poll_interval)
+            time.sleep(wait_time)
+
+def create_state_store():
+    if STATE_BACKEND == "sqlite":
+        logger.info("🗄️ Using SQLite state store at %s", STATE_SQLITE_PATH)
+        return SqliteStateStore(STATE_SQLITE_PATH)
+    if STATE_BACKEND != "memory":
+        logger.error("Unknown STATE_BACKEND: %s, falling back to memory", STATE_BACKEND)
+    journal = None
+    if STATE_JOURNAL_DIR:
+        try:
+            journal = StateJournal(STATE_JOURNAL_DIR)
+        except RuntimeError as e:
+            logger.error("❌ %s: running worker %s without a journal (use STATE_BACKEND=sqlite for several workers)",
+                         e, os.getpid())
+    return MemoryStateStore(client_messages, pending_photos, journal)
+
+state_store = create_state_store()
+
+# =============================
+# 21. دالة التحقق من الطلبات المتأخرة وإرسال تنبيه - محسنة
+# =============================
+# التأخير بين موعد التنبيه ووقت معالجته فعلياً في آخر فحص
+checker_lag_seconds = register_metric(Gauge(
+    "ordertaker_checker_lag_seconds", "Delay between an order deadline and the checker handling it"))
+
+def check_delayed_orders():
+    try:
+        now = time.time()
+        due_orders = state_store.pop_due_orders(now)
+        if not due_orders:
+            checker_lag_seconds.set(0)
+            return 0
+
+        checker_lag_seconds.set(round(max(now - due_ts for contact_id, due_ts in due_orders), 3))
+
+        logger.info("🔍 %s order(s) reached the delay deadline", len(due_orders))
+        alerts_sent = 0
+
+        # إرسال تنبيهات للطلبات المتأخرة فقط
+        for contact_id, due_ts in due_orders:
+            scenarios = state_store.get_contact(contact_id)
+            if 'order' not in scenarios:
+                continue
+            # التحقق إذا لم يكن هناك تنبيه تأخر مسبق
+            if 'delay' in scenarios:
+                logger.info("ℹ️ Delay alert already sent for contact: %s", contact_id)
+                continue
+
+            # بناء رسالة التنبيه
+            order_data = scenarios['order']
+            channel = order_data.get('channel', 'telegram')
+            logger.info("🚨 Order for contact %s is DELAYED - %.0f seconds passed", contact_id, time.time() - order_data['timestamp'].timestamp())
             
-            logger.info(f"✅ Message sent and stored: contact_id={contact_id}, scenario={scenario}, message_id={message_id}")
-            logger.info(f"📊 Current client_messages count: {len(client_messages)}")
+            delay_message = f"🚨 <b>تنبيه تأخر في التنفيذ</b>\n"
+            delay_message += f"🆔 الرقم التعريفي: {contact_id}\n"
+            delay_message += f"⏰ الوقت المنقضي: أكثر من {ORDER_DELAY_SECONDS // 60} دقائق\n"
+            delay_message += f"📞 القناة: {channel}\n"
+            delay_message += f"🔔 تم إرسال الطلب في: {order_data['timestamp'].strftime('%Y-%m-%d %H:%M:%S')}"
             
-            return True
-        else:
-            logger.error(f"❌ Failed to send to Telegram: {response.status_code}")
-            return False
+            # إرسال رسالة تنبيه التأخر
+            success = send_scenario_message_to_telegram(delay_message, contact_id, channel, "delay")
+            if success:
+                alerts_sent += 1
+                logger.info("✅ Delay alert sent successfully for contact: %s", contact_id)
+            else:
+                # إعادة الطلب للفهرس لمحاولة الإرسال لاحقاً
+                state_store.set_deadline(contact_id, time.time() + DELAY_ALERT_RETRY_SECONDS)
+                logger.error("❌ Failed to send delay alert for contact: %s", contact_id)
+
+        return alerts_sent
+        
     except Exception as e:
-        logger.error(f"❌ Error sending to Telegram: {e}")
-        return False
+        logger.error("❌ Error in check_delayed_orders: %s", e)
+        return 0
+
+# =============================
+# 22. بدء مؤقت للتحقق من الطلبات المتأخرة - محسنة
+# =============================
+def start_delayed_orders_checker():
+    def checker_loop():
+        logger.info("🔄 Starting delayed orders checker loop...")
+        while True:
+            try:
+                # النوم حتى أقرب موعد تأخر بدلاً من الفحص كل دقيقة
+                state_store.wait_until_due()
+                check_delayed_orders()
+            except Exception as e:
+                logger.error("❌ Error in delayed orders checker loop: %s", e)
+                time.sleep(30)  # انتظار 30 ثانية قبل إعادة المحاولة
+    
+    thread = threading.Thread(target=checker_loop)
+    thread.daemon = True
+    thread.start()
+    logger.info("✅ Delayed orders checker started successfully")
+
+# =============================
+# 23. اختيار worker واحد (leader) لتشغيل المهام الخلفية في gunicorn
+# =============================
+# ملف القفل مشترك بين كل الـ workers على نفس الجهاز، ومن يحجزه هو الـ leader
+SCHEDULER_LOCK_PATH = os.getenv("SCHEDULER_LOCK_PATH", os.path.join(tempfile.gettempdir(), "ordertaker-scheduler.lock"))
+# كل كم ثانية يحاول الـ followers حجز القفل (مدة استلام القيادة بعد موت الـ leader)
+SCHEDULER_LEADER_POLL = float(os.getenv("SCHEDULER_LEADER_POLL", 2))
+
+class LeaderElector:
+    """
+    flock غير حاجز على ملف مشترك: النظام يحرر القفل تلقائياً عند موت الـ process
+    فيحجزه أحد الـ followers في المحاولة التالية. الـ leader يكتب pid و heartbeat في الملف
+    حتى يستطيع أي worker عرض حالة القيادة
+    """
+
+    def __init__(self, path, poll_interval, on_elected):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.on_elected = on_elected
+        self.fd = None
+        self.is_leader = False
+        self.leader_since = None
+
+    def try_acquire(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def write_heartbeat(self):
+        info = json.dumps({
+            "pid": os.getpid(),
+            "since": self.leader_since,
+            "heartbeat": time.time(),
+            "checker_lag_seconds": checker_lag_seconds.value,
+        }).encode("utf-8")
+        os.ftruncate(self.fd, 0)
+        os.pwrite(self.fd, info, 0)
+
+    def read_leader(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.loads(f.read() or "{}")
+        except (OSError, ValueError):
+            return {}
+
+    def run(self):
+        while True:
+            try:
+                if not self.is_leader and self.try_acquire():
+                    self.is_leader = True
+                    self.leader_since = time.time()
+                    self.write_heartbeat()
+                    logger.info("👑 Worker %s elected scheduler leader", os.getpid())
+                    self.on_elected()
+                elif self.is_leader:
+                    self.write_heartbeat()
+            except Exception as e:
+                logger.error("❌ Error in scheduler leader election: %s", e)
+            time.sleep(self.poll_interval)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="leader-elector")
+        thread.daemon = True
+        thread.start()
+
+leader_elector = None
+background_services_pid = None
+
+def start_leader_services():
+    # تعمل في الـ leader فقط: checker التأخير مع المخزن المشترك و long polling (تليجرام يسمح بمستهلك واحد)
+    if state_store.shared:
+        start_delayed_orders_checker()
+    if TELEGRAM_MODE == "polling":
+        start_telegram_polling()
+
+def start_background_services():
+    """
+    تُستدعى مرة واحدة في كل process: من __main__ أو من post_worker_init في gunicorn.conf.py
+    مع مخزن مشترك (sqlite) worker واحد فقط يشغل checker التأخير، ومع مخزن الذاكرة
+    كل worker يفحص طلباته هو فقط (لا توجد تنبيهات مكررة لأن الحالة غير مشتركة)
+    في وضع polling يتم انتخاب leader لـ long polling فقط حتى مع مخزن الذاكرة
+    """
+    global leader_elector, background_services_pid
+    if background_services_pid == os.getpid():
+        return
+    background_services_pid = os.getpid()
+
+    if not state_store.shared:
+        start_delayed_orders_checker()
+    if state_store.shared or TELEGRAM_MODE == "polling":
+        leader_elector = LeaderElector(SCHEDULER_LOCK_PATH, SCHEDULER_LEADER_POLL, start_leader_services)
+        leader_elector.start()
+
+def scheduler_status():
+    status = {
+        "worker_pid": os.getpid(),
+        "checker": "leader" if state_store.shared else "local",
+        "checker_lag_seconds": checker_lag_seconds.value
+    }
+    if background_services_pid != os.getpid():
+        status["role"] = "stopped"
+        return status
+    if leader_elector is None:
+        status["role"] = "local"
+        return status
+
+    leader = leader_elector.read_leader()
+    status["role"] = "leader" if leader_elector.is_leader else "follower"
+    status["leader_pid"] = leader.get("pid")
+    status["leader_since"] = leader.get("since")
+    status["leader_checker_lag_seconds"] = leader.get("checker_lag_seconds")
+    if leader.get("heartbeat"):
+        status["leader_heartbeat_age_seconds"] = round(time.time() - leader["heartbeat"], 3)
+    return status
+
+# =============================
+# 24. بناء رسالة الجروب من بيانات SendPulse
+# =============================
+def build_scenario_message(data, scenario):
+    """
+    بناء نص رسالة الجروب بناءً على السيناريو
+    يستخدم neworder كما هو إن وجد، وإلا الحقول القديمة
+    """
+    # ⚡ **استخراج البيانات الجديدة من متغير neworder**
+    neworder = data.get("neworder", "")
+
+    # 🔍 **الحفاظ على التوافق مع النظام القديم**
+    full_name = data.get("full_name", "")
+    username = data.get("username", "")
+    agent = data.get("Agent", "")
+    price_in = data.get("PriceIN", "")
+    much2 = data.get("much2", "")
+    paid_by = data.get("PaidBy", "")
+    cash_control = data.get("CashControl", "")
+    short_url = data.get("ShortUrl", "")
+    much = data.get("much", "")
+    platform = data.get("Platform", "")
+    redid = data.get("redid", "")
+    note = data.get("Note", "")
+    complaint_reason = data.get("complaint_reason", "")
+
+    # ⚡ **معالجة أنواع الطلبات بناءً على scenario**
+    if scenario == "delay":
+        # بناء رسالة شكوى التأخر
+        if neworder:
+            # استخدام neworder كما هو بدون تنسيق
+            if isinstance(neworder, dict):
+                # إذا كان قاموسًا، نحوله إلى سلسلة نصية بشكل بسيط
+                formatted_order = json.dumps(neworder, ensure_ascii=False, indent=2)
+            else:
+                formatted_order = str(neworder)
+            message = f"🚨 <b>تنبيه تأخر في التنفيذ</b>\n{formatted_order}"
+        else:
+            # استخدام النظام القديم
+            message_lines = ["🚨 <b>تنبيه تأخر في التنفيذ</b>"]
+
+            if full_name:
+                message_lines.append(f"👤 العميل: {full_name}")
+            if username:
+                message_lines.append(f"📱 التليجرام: @{username}")
+            if redid:
+                message_lines.append(f"🆔 الرقم التعريفي: {redid}")
+            if complaint_reason:
+                message_lines.append(f"📝 سبب التأخر: {complaint_reason}")
+            elif note:
+                message_lines.append(f"📝 سبب التأخر: {note}")
+            else:
+                message_lines.append(f"📝 سبب التأخر: غير محدد")
+
+            message = "\n".join(message_lines)
+
+    elif scenario == "photo":
+        # بناء رسالة طلب الصورة الإضافية
+        if neworder:
+            # استخدام neworder كما هو بدون تنسيق
+            if isinstance(neworder, dict):
+                # إذا كان قاموسًا، نحوله إلى سلسلة نصية بشكل بسيط
+                formatted_order = json.dumps(neworder, ensure_ascii=False, indent=2)
+            else:
+                formatted_order = str(neworder)
+            message = f"📸 <b>طلب صورة إضافية من العميل</b>\n{formatted_order}"
+        else:
+            # استخدام النظام القديم
+            message_lines = ["📸 <b>طلب صورة إضافية من العميل</b>"]
+
+            if full_name:
+                message_lines.append(f"👤 العميل: {full_name}")
+            if username:
+                message_lines.append(f"📱 التليجرام: @{username}")
+            if redid:
+                message_lines.append(f"🆔 الرقم التعريفي: {redid}")
+            if note:
+                message_lines.append(f"📝 الملاحظة: {note}")
+
+            message = "\n".join(message_lines)
+
+    else:  # scenario == "order" (الافتراضي)
+        # بناء رسالة الطلب الجديد
+        if neworder:
+            # استخدام neworder كما هو بدون تنسيق
+            logger.info("📝 Using neworder data RAW (type: %s)", type(neworder))
+            if isinstance(neworder, dict):
+                # إذا كان قاموسًا، نحوله إلى سلسلة نصية بشكل بسيط
+                formatted_order = json.dumps(neworder, ensure_ascii=False, indent=2)
+            else:
+                formatted_order = str(neworder)
+            message = f"📩 <b>طلب جديد</b>\n{formatted_order}"
+            logger.info("📝 Raw order data preview: %s...", str(formatted_order)[:200])
+        else:
+            # استخدام النظام القديم مع التنسيق العادي
+            message_lines = []
+
+            # إضافة الحقول التي تحتوي على قيم فقط بنفس التنسيق المطلوب
+            if full_name or username:
+                line = ""
+                if full_name:
+                    line += f"👤 العميل {full_name}"
+                if username:
+                    if line:
+                        line += f" 📱 تليجرام @{username}"
+                    else:
+                        line += f"📱 تليجرام @{username}"
+                message_lines.append(line)
+
+            if agent or price_in:
+                line = ""
+                if agent:
+                    line += f"🛒 شفــت {agent}"
+                if price_in:
+                    if line:
+                        line += f" 💰 سعـر البيـع {price_in}"
+                    else:
+                        line += f"💰 سعـر البيـع {price_in}"
+                message_lines.append(line)
+
+            if much2 or paid_by:
+                line = ""
+                if much2:
+                    line += f"💵 المبلـغ {much2}"
+                if paid_by:
+                    if line:
+                        line += f" 💳 جنيـه {paid_by}"
+                    else:
+                        line += f"💳 جنيـه {paid_by}"
+                message_lines.append(line)
+
+            if cash_control:
+                message_lines.append(f"🏦 رقم/اسم المحفظـة {cash_control}")
+
+            if short_url:
+                message_lines.append(f"🧾 الإيصـال {short_url}")
+
+            if much or platform:
+                line = ""
+                if much:
+                    line += f"💎 الرصيــد {much}"
+                if platform:
+                    if line:
+                        line += f" 💻 $ {platform}"
+                    else:
+                        line += f"💻 $ {platform}"
+                message_lines.append(line)
+
+            if redid:
+                message_lines.append(f"🆔 {redid}")
+
+            if note:
+                message_lines.append(f"📝 {note}")
+
+            # إضافة عنوان الرسالة في الأعلى
+            if message_lines:
+                message_lines.insert(0, "📩 <b>طلب جديد</b>")
+
+            # دمج كل الأسطر في رسالة واحدة
+            message = "\n".join(message_lines) if message_lines else "📩 <b>طلب جديد</b>"
+
+    return message
+
+# =============================
+# 25. طابور الإرسال غير المتزامن إلى تليجرام
+# =============================
+# عدد الـ workers التي ترسل الرسائل إلى الجروب
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", 4))
+# الحد الأقصى للرسائل المنتظرة في الطابور (عند الامتلاء نرد 503)
+DISPATCH_QUEUE_SIZE = int(os.getenv("DISPATCH_QUEUE_SIZE", 1000))
+# مدة الاحتفاظ بحالة المهام المنتهية للاستعلام عنها
+DISPATCH_JOB_TTL = int(os.getenv("DISPATCH_JOB_TTL", 3600))
+DISPATCH_MAX_JOBS = int(os.getenv("DISPATCH_MAX_JOBS", 10000))
+# إعادة محاولة الرسائل الفاشلة بتأخير متضاعف (base × 2^n حتى max) قبل نقلها إلى قائمة الفاشلة
+DISPATCH_MAX_ATTEMPTS = int(os.getenv("DISPATCH_MAX_ATTEMPTS", 5))
+DISPATCH_RETRY_BASE_DELAY = float(os.getenv("DISPATCH_RETRY_BASE_DELAY", 2))
+DISPATCH_RETRY_MAX_DELAY = float(os.getenv("DISPATCH_RETRY_MAX_DELAY", 60))
+# الحد الأقصى للرسائل الفاشلة المحفوظة لإعادة إرسالها يدوياً من /jobs/failed/retry
+DISPATCH_DEAD_LETTER_MAX = int(os.getenv("DISPATCH_DEAD_LETTER_MAX", 1000))
+# الطلبات المباشرة (/webhook) تُرسل قبل طلبات الدفعات المنتظرة (/webhook/batch)
+DISPATCH_PRIORITY_LIVE = 0
+DISPATCH_PRIORITY_BATCH = 1
+# الحد الأقصى لطلبات الدفعات في الطابور في نفس الوقت، حتى يبقى مكان للطلبات المباشرة
+DISPATCH_BATCH_QUEUE_MAX = int(os.getenv("DISPATCH_BATCH_QUEUE_MAX", DISPATCH_QUEUE_SIZE // 2))
+
+# العناصر (priority, seq, job, message): seq يحافظ على ترتيب الوصول داخل نفس الأولوية
+dispatch_queue = queue.PriorityQueue(maxsize=DISPATCH_QUEUE_SIZE)
+dispatch_sequence = itertools.count()
+dispatch_batch_slots = threading.BoundedSemaphore(DISPATCH_BATCH_QUEUE_MAX)
+# حالة المهام (job_id → job) بترتيب الإضافة
+dispatch_jobs = {}
+dispatch_jobs_lock = threading.Lock()
+dispatch_workers = []
+# الرسائل التي فشلت بعد كل المحاولات (job_id → (job, message)) بترتيب الفشل
+dispatch_dead_letters = OrderedDict()
+dispatch_retry_scheduler = TimerScheduler("dispatch-retry", resolution=0.5)
+dispatch_outcomes = register_metric(Counter(
+    "ordertaker_dispatch_attempts_total", "Group message send attempts by outcome (sent, retried, failed)", ("outcome",)))
+
+def start_dispatch_workers():
+    # تشغيل الـ workers عند أول استخدام داخل كل process (متوافق مع gunicorn)
+    with dispatch_jobs_lock:
+        if dispatch_workers:
+            return
+        for i in range(OUTBOUND_WORKERS):
+            thread = threading.Thread(target=dispatch_worker_loop, name=f"dispatch-{i}")
+            thread.daemon = True
+            thread.start()
+            dispatch_workers.append(thread)
+    logger.info("✅ Started %s outbound dispatch workers", OUTBOUND_WORKERS)
+
+def prune_dispatch_jobs():
+    # مسح المهام المنتهية القديمة (dispatch_jobs_lock يجب أن يكون محجوزاً)
+    cutoff = time.time() - DISPATCH_JOB_TTL
+    for job_id in list(dispatch_jobs):
+        if len(dispatch_jobs) <= DISPATCH_MAX_JOBS and dispatch_jobs[job_id]['created_at'] > cutoff:
+            break
+        if dispatch_jobs[job_id]['status'] in ("sent", "failed"):
+            del dispatch_jobs[job_id]
+
+def enqueue_scenario_message(message, contact_id, channel, scenario, idempotency_key=None,
+                             priority=DISPATCH_PRIORITY_LIVE):
+    """
+    إضافة رسالة إلى طابور الإرسال وإرجاع المهمة فوراً
+    ترجع None إذا كان الطابور ممتلئاً (أو وصلت طلبات الدفعات إلى DISPATCH_BATCH_QUEUE_MAX)
+    idempotency_key يُحذف من ذاكرة منع التكرار إذا فشلت المهمة نهائياً حتى تُقبل إعادة إرسال الطلب
+    """
+    start_dispatch_workers()
+
+    # مكان طلب الدفعة في الطابور يتحرر عندما يأخذه أحد الـ workers
+    holds_batch_slot = priority == DISPATCH_PRIORITY_BATCH
+    if holds_batch_slot and not dispatch_batch_slots.acquire(blocking=False):
+        logger.error("❌ Too many batch orders queued, rejecting %s for contact %s", scenario, contact_id)
+        return None
+
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'status': 'queued',
+        'contact_id': contact_id,
+        'channel': channel,
+        'scenario': scenario,
+        'message_id': None,
+        'attempts': 0,
+        'last_error': None,
+        'idempotency': idempotency_cache.lookup(idempotency_key),
+        'priority': priority,
+        'holds_batch_slot': holds_batch_slot,
+        'created_at': time.time(),
+        'finished_at': None,
+        'done': threading.Event()
+    }
+
+    with dispatch_jobs_lock:
+        prune_dispatch_jobs()
+        dispatch_jobs[job['job_id']] = job
 
-# =============================
-# 14. دالة التحقق من الطلبات المتأخرة وإرسال تنبيه - محسنة
-# =============================
-def check_delayed_orders():
     try:
-        logger.info("🔍 Starting delayed orders check...")
-        logger.info(f"📊 Total orders in memory: {len(client_messages)}")
-        
-        current_time = datetime.now()
-        delayed_contacts = []
+        put_dispatch_job(job, message)
+    except queue.Full:
+        with dispatch_jobs_lock:
+            dispatch_jobs.pop(job['job_id'], None)
+        if holds_batch_slot:
+            dispatch_batch_slots.release()
+        logger.error("❌ Dispatch queue is full, rejecting %s for contact %s", scenario, contact_id)
+        return None
 
-        # التحقق من جميع الطلبات النشطة
-        for contact_id, scenarios in list(client_messages.items()):
-            if 'order' in scenarios:
-                order_data = scenarios['order']
-                order_time = order_data['timestamp']
-                time_diff = current_time - order_time
-                
-                logger.info(f"⏰ Checking order {contact_id}: {time_diff.total_seconds():.0f} seconds passed")
-                
-                # إذا مرت أكثر من 5 دقائق على الطلب
-                if time_diff.total_seconds() > 300:  # 300 ثانية = 5 دقائق
-                    # التحقق إذا لم يكن هناك تنبيه تأخر مسبق
-                    if 'delay' not in scenarios:
-                        delayed_contacts.append(contact_id)
-                        logger.info(f"🚨 Order for contact {contact_id} is DELAYED - {time_diff.total_seconds():.0f} seconds passed")
-
-        # إرسال تنبيهات للطلبات المتأخرة
-        for contact_id in delayed_contacts:
-            if contact_id in client_messages and 'delay' not in client_messages[contact_id]:
-                # بناء رسالة التنبيه
-                order_data = client_messages[contact_id]['order']
-                channel = order_data.get('channel', 'telegram')
-                
-                delay_message = f"🚨 <b>تنبيه تأخر في التنفيذ</b>\n"
-                delay_message += f"🆔 الرقم التعريفي: {contact_id}\n"
-                delay_message += f"⏰ الوقت المنقضي: أكثر من 5 دقائق\n"
-                delay_message += f"📞 القناة: {channel}\n"
-                delay_message += f"🔔 تم إرسال الطلب في: {order_data['timestamp'].strftime('%Y-%m-%d %H:%M:%S')}"
-                
-                # إرسال رسالة تنبيه التأخر
-                success = send_scenario_message_to_telegram(delay_message, contact_id, channel, "delay")
-                if success:
-                    logger.info(f"✅ Delay alert sent successfully for contact: {contact_id}")
-                else:
-                    logger.error(f"❌ Failed to send delay alert for contact: {contact_id}")
+    return job
+
+def put_dispatch_job(job, message):
+    dispatch_queue.put_nowait((job['priority'], next(dispatch_sequence), job, message))
+
+def dispatch_worker_loop():
+    while True:
+        priority, seq, job, message = dispatch_queue.get()
+        if job['holds_batch_slot']:
+            job['holds_batch_slot'] = False
+            dispatch_batch_slots.release()
+        try:
+            job['status'] = 'sending'
+            job['attempts'] += 1
+            retryable = False
+            try:
+                message_id = send_scenario_message_to_telegram(message, job['contact_id'], job['channel'], job['scenario'],
+                                                               raise_errors=True)
+            except DispatchError as e:
+                message_id = None
+                job['last_error'] = str(e)
+                retryable = e.retryable
+            except Exception as e:
+                message_id = None
+                job['last_error'] = str(e)
+                logger.error("❌ Error in dispatch worker: %s", e)
+
+            if message_id:
+                job['message_id'] = message_id
+                job['status'] = 'sent'
+                job['last_error'] = None
+                job['finished_at'] = time.time()
+                dispatch_outcomes.inc("sent")
+                logger.info("📨 %s processed for contact: %s", job['scenario'], job['contact_id'])
+                job['done'].set()
             else:
-                logger.info(f"ℹ️ Delay alert already sent for contact: {contact_id}")
-                
-        logger.info(f"📊 Delayed orders check completed. Found {len(delayed_contacts)} delayed orders")
-        
-    except Exception as e:
-        logger.error(f"❌ Error in check_delayed_orders: {e}")
+                schedule_dispatch_retry(job, message, retryable)
+        finally:
+            dispatch_queue.task_done()
+
+def schedule_dispatch_retry(job, message, retryable):
+    """
+    إعادة المحاولة بعد تأخير متضاعف فقط إذا لم تصل الرسالة لتليجرام (retryable)
+    الأخطاء الدائمة و read timeout (قد تكون الرسالة نُشرت) تنتقل مباشرة لقائمة الفاشلة
+    لإعادة إرسالها يدوياً، وكذلك بعد DISPATCH_MAX_ATTEMPTS
+    """
+    if retryable and job['attempts'] < DISPATCH_MAX_ATTEMPTS:
+        delay = min(DISPATCH_RETRY_MAX_DELAY, DISPATCH_RETRY_BASE_DELAY * 2 ** (job['attempts'] - 1))
+        job['status'] = 'retrying'
+        dispatch_outcomes.inc("retried")
+        logger.warning("🔁 Dispatch of %s for contact %s failed (attempt %s/%s), retrying in %.1fs",
+                       job['scenario'], job['contact_id'], job['attempts'], DISPATCH_MAX_ATTEMPTS, delay)
+        dispatch_retry_scheduler.schedule(job['job_id'], delay, requeue_dispatch_jobs, job, message)
+        return
+
+    job['status'] = 'failed'
+    job['finished_at'] = time.time()
+    dispatch_outcomes.inc("failed")
+    with dispatch_jobs_lock:
+        dispatch_dead_letters[job['job_id']] = (job, message)
+        while len(dispatch_dead_letters) > DISPATCH_DEAD_LETTER_MAX:
+            dispatch_dead_letters.popitem(last=False)
+    logger.error("❌ Dispatch of %s for contact %s failed after %s attempts: %s",
+                 job['scenario'], job['contact_id'], job['attempts'], job['last_error'])
+    if job['idempotency']:
+        # إعادة SendPulse لنفس الطلب يجب أن تنشئ مهمة جديدة وليس أن ترجع job_id الفاشل
+        idempotency_cache.release(*job['idempotency'])
+        job['idempotency'] = None
+    job['done'].set()
+
+def requeue_dispatch_jobs(batch):
+    # callback مجدول إعادة المحاولة: إرجاع المهام المستحقة إلى الطابور
+    for job, message in batch:
+        try:
+            job['status'] = 'queued'
+            put_dispatch_job(job, message)
+        except queue.Full:
+            # الطابور ممتلئ بطلبات جديدة: نحاول مرة أخرى لاحقاً بدون احتساب محاولة
+            job['status'] = 'retrying'
+            dispatch_retry_scheduler.schedule(job['job_id'], DISPATCH_RETRY_BASE_DELAY, requeue_dispatch_jobs, job, message)
+
+def retry_dead_letters(job_ids=None):
+    """
+    إعادة الرسائل الفاشلة إلى الطابور بعدد محاولات جديد، وترجع قائمة job_id التي أُعيدت
+    """
+    with dispatch_jobs_lock:
+        selected = [job_id for job_id in (job_ids or list(dispatch_dead_letters)) if job_id in dispatch_dead_letters]
+        entries = [dispatch_dead_letters.pop(job_id) for job_id in selected]
+        for job, message in entries:
+            dispatch_jobs[job['job_id']] = job
+
+    start_dispatch_workers()
+    requeued = []
+    for job, message in entries:
+        job['attempts'] = 0
+        job['finished_at'] = None
+        job['done'].clear()
+        job['status'] = 'retrying'
+        dispatch_retry_scheduler.schedule(job['job_id'], 0, requeue_dispatch_jobs, job, message)
+        requeued.append(job['job_id'])
+    if requeued:
+        logger.info("🔁 Requeued %s failed dispatch jobs", len(requeued))
+    return requeued
+
+def dispatch_job_info(job):
+    return {
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'contact_id': job['contact_id'],
+        'channel': job['channel'],
+        'scenario': job['scenario'],
+        'message_id': job['message_id'],
+        'attempts': job['attempts'],
+        'last_error': job['last_error'],
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at']
+    }
 
 # =============================
-# 15. بدء مؤقت للتحقق من الطلبات المتأخرة - محسنة
+# 26. منع تكرار معالجة نفس الطلب (idempotency)
 # =============================
-def start_delayed_orders_checker():
-    def checker_loop():
-        logger.info("🔄 Starting delayed orders checker loop...")
-        check_count = 0
-        while True:
-            try:
-                check_count += 1
-                logger.info(f"🔍 Check #{check_count} at {datetime.now().strftime('%H:%M:%S')}")
-                check_delayed_orders()
-                # التحقق كل دقيقة
-                time.sleep(60)
-            except Exception as e:
-                logger.error(f"❌ Error in delayed orders checker loop: {e}")
-                time.sleep(30)  # انتظار 30 ثانية قبل إعادة المحاولة
-    
-    thread = threading.Thread(target=checker_loop)
-    thread.daemon = True
-    thread.start()
-    logger.info("✅ Delayed orders checker started successfully")
+# SendPulse يعيد إرسال /webhook عند تأخر الرد، وتليجرام يعيد نفس update_id عند انتهاء المهلة
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 600))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", 10000))
+# مدة انتظار النسخة المكررة حتى تنتهي معالجة الطلب الأصلي
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", 5))
+
+class IdempotencyCache:
+    """
+    LRU محدود العدد مع انتهاء صلاحية (key → الرد المحفوظ)
+    أول طلب يحجز المفتاح، والنسخ المكررة تنتظره ثم ترجع نفس الرد بدون أي اتصال خارجي
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()   # key → {'response', 'ready', 'expires_at'}
+        self.lock = threading.Lock()
+
+    def purge_expired(self):
+        now = time.time()
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if entry['expires_at'] > now and len(self.entries) <= self.max_entries:
+                break
+            del self.entries[key]
+
+    def claim(self, key):
+        """
+        ترجع (entry, True) إذا كان هذا أول طلب بالمفتاح، أو (entry, False) للنسخة المكررة
+        """
+        with self.lock:
+            self.purge_expired()
+            entry = self.entries.get(key)
+            if entry and entry['expires_at'] > time.time():
+                self.entries.move_to_end(key)
+                return entry, False
+            entry = {'response': None, 'ready': threading.Event(), 'expires_at': time.time() + self.ttl}
+            self.entries[key] = entry
+            return entry, True
+
+    def complete(self, entry, response):
+        entry['response'] = response
+        entry['ready'].set()
+
+    def lookup(self, key):
+        # ترجع (key, entry) الحالي للمفتاح لتمريره لاحقاً إلى release، أو None
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+        return (key, entry) if entry else None
+
+    def release(self, key, entry):
+        # الطلب فشل: نحذف المفتاح حتى تتم معالجة إعادة المحاولة من جديد
+        with self.lock:
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+        entry['ready'].set()
+
+idempotency_cache = IdempotencyCache(IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_TTL)
+
+def sendpulse_idempotency_key(data):
+    # بصمة محتوى الطلب: contact_id + scenario + neworder (أو باقي الحقول للصيغة القديمة)
+    if "neworder" in data:
+        fields = [data.get("contact_id"), data.get("scenario", "order"), data.get("neworder")]
+    else:
+        fields = data
+    digest = hashlib.sha256(json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+    return f"sp:{digest.hexdigest()}"
+
+def run_idempotent(key, handler, pending_response):
+    """
+    تنفيذ handler مرة واحدة لكل key، والردود الناجحة (< 500) تُحفظ للنسخ المكررة
+    رد 202 لمهمة في الطابور يبقى محفوظاً فقط حتى تفشل المهمة نهائياً (schedule_dispatch_retry)
+    pending_response يرجع للنسخة المكررة إذا لم ينته الطلب الأصلي خلال المهلة
+    """
+    if key is None:
+        return handler()
+
+    entry, owner = idempotency_cache.claim(key)
+    if not owner:
+        entry['ready'].wait(IDEMPOTENCY_WAIT_SECONDS)
+        logger.info("♻️ Duplicate delivery %s answered from idempotency cache", key[:24])
+        return entry['response'] or pending_response
+
+    try:
+        response = handler()
+    except Exception:
+        idempotency_cache.release(key, entry)
+        raise
+
+    status = response[1] if isinstance(response, tuple) else 200
+    if status < 500:
+        idempotency_cache.complete(entry, response)
+    else:
+        idempotency_cache.release(key, entry)
+    return response
 
 # =============================
-# 16. استقبال Webhook من SendPulse - محسنة للتعامل مع JSON في neworder
+# 27. استقبال Webhook من SendPulse - محسنة للتعامل مع JSON في neworder
 # =============================
 @app.route("/webhook", methods=["POST"])
 def webhook():
     try:
         data = request.get_json()
-        logger.info(f"📩 Received webhook data")
+        logger.info("📩 Received webhook data")
 
         if not data:
             return {"status": "error", "message": "No data received"}, 400
 
-        # استخراج البيانات الأساسية من الـ webhook
-        contact_id = data.get("contact_id", "")
-        channel = data.get("channel", "telegram")
-        scenario = data.get("scenario", "order")
-        
-        # ⚡ **استخراج البيانات الجديدة من متغير neworder**
-        neworder = data.get("neworder", "")
-        
-        # 🔍 **الحفاظ على التوافق مع النظام القديم**
-        full_name = data.get("full_name", "")
-        username = data.get("username", "")
-        agent = data.get("Agent", "")
-        price_in = data.get("PriceIN", "")
-        much2 = data.get("much2", "")
-        paid_by = data.get("PaidBy", "")
-        cash_control = data.get("CashControl", "")
-        short_url = data.get("ShortUrl", "")
-        much = data.get("much", "")
-        platform = data.get("Platform", "")
-        redid = data.get("redid", "")
-        note = data.get("Note", "")
-        complaint_reason = data.get("complaint_reason", "")
-
-        if not contact_id:
-            logger.error("❌ No contact_id received in webhook")
-            return {"status": "error", "message": "No contact_id"}, 400
-
-        logger.info(f"📝 Processing scenario: {scenario}, contact_id: {contact_id}")
-
-        # ⚡ **معالجة أنواع الطلبات بناءً على scenario**
-        if scenario == "delay":
-            # بناء رسالة شكوى التأخر
-            if neworder:
-                # استخدام neworder كما هو بدون تنسيق
-                if isinstance(neworder, dict):
-                    # إذا كان قاموسًا، نحوله إلى سلسلة نصية بشكل بسيط
-                    formatted_order = json.dumps(neworder, ensure_ascii=False, indent=2)
-                else:
-                    formatted_order = str(neworder)
-                message = f"🚨 <b>تنبيه تأخر في التنفيذ</b>\n{formatted_order}"
-            else:
-                # استخدام النظام القديم
-                message_lines = ["🚨 <b>تنبيه تأخر في التنفيذ</b>"]
-                
-                if full_name:
-                    message_lines.append(f"👤 العميل: {full_name}")
-                if username:
-                    message_lines.append(f"📱 التليجرام: @{username}")
-                if redid:
-                    message_lines.append(f"🆔 الرقم التعريفي: {redid}")
-                if complaint_reason:
-                    message_lines.append(f"📝 سبب التأخر: {complaint_reason}")
-                elif note:
-                    message_lines.append(f"📝 سبب التأخر: {note}")
-                else:
-                    message_lines.append(f"📝 سبب التأخر: غير محدد")
-                    
-                message = "\n".join(message_lines)
-            
-            # إرسال رسالة شكوى التأخر (أزرار محددة)
-            success = send_scenario_message_to_telegram(message, contact_id, channel, scenario)
-            logger.info(f"📨 Delay complaint processed for contact: {contact_id}")
-            
-        elif scenario == "photo":
-            # بناء رسالة طلب الصورة الإضافية
-            if neworder:
-                # استخدام neworder كما هو بدون تنسيق
-                if isinstance(neworder, dict):
-                    # إذا كان قاموسًا، نحوله إلى سلسلة نصية بشكل بسيط
-                    formatted_order = json.dumps(neworder, ensure_ascii=False, indent=2)
-                else:
-                    formatted_order = str(neworder)
-                message = f"📸 <b>طلب صورة إضافية من العميل</b>\n{formatted_order}"
-            else:
-                # استخدام النظام القديم
-                message_lines = ["📸 <b>طلب صورة إضافية من العميل</b>"]
-                
-                if full_name:
-                    message_lines.append(f"👤 العميل: {full_name}")
-                if username:
-                    message_lines.append(f"📱 التليجرام: @{username}")
-                if redid:
-                    message_lines.append(f"🆔 الرقم التعريفي: {redid}")
-                if note:
-                    message_lines.append(f"📝 الملاحظة: {note}")
-                    
-                message = "\n".join(message_lines)
+        return accept_order_payload(data)
             
-            # إرسال رسالة طلب الصورة الإضافية (زر واحد فقط)
-            success = send_scenario_message_to_telegram(message, contact_id, channel, scenario)
-            logger.info(f"📨 Photo request processed for contact: {contact_id}")
-            
-        else:  # scenario == "order" (الافتراضي)
-            # بناء رسالة الطلب الجديد
-            if neworder:
-                # استخدام neworder كما هو بدون تنسيق
-                logger.info(f"📝 Using neworder data RAW (type: {type(neworder)})")
-                if isinstance(neworder, dict):
-                    # إذا كان قاموسًا، نحوله إلى سلسلة نصية بشكل بسيط
-                    formatted_order = json.dumps(neworder, ensure_ascii=False, indent=2)
-                else:
-                    formatted_order = str(neworder)
-                message = f"📩 <b>طلب جديد</b>\n{formatted_order}"
-                logger.info(f"📝 Raw order data preview: {str(formatted_order)[:200]}...")
-            else:
-                # استخدام النظام القديم مع التنسيق العادي
-                message_lines = []
-                
-                # إضافة الحقول التي تحتوي على قيم فقط بنفس التنسيق المطلوب
-                if full_name or username:
-                    line = ""
-                    if full_name:
-                        line += f"👤 العميل {full_name}"
-                    if username:
-                        if line:
-                            line += f" 📱 تليجرام @{username}"
-                        else:
-                            line += f"📱 تليجرام @{username}"
-                    message_lines.append(line)
-                
-                if agent or price_in:
-                    line = ""
-                    if agent:
-                        line += f"🛒 شفــت {agent}"
-                    if price_in:
-                        if line:
-                            line += f" 💰 سعـر البيـع {price_in}"
-                        else:
-                            line += f"💰 سعـر البيـع {price_in}"
-                    message_lines.append(line)
-                
-                if much2 or paid_by:
-                    line = ""
-                    if much2:
-                        line += f"💵 المبلـغ {much2}"
-                    if paid_by:
-                        if line:
-                            line += f" 💳 جنيـه {paid_by}"
-                        else:
-                            line += f"💳 جنيـه {paid_by}"
-                    message_lines.append(line)
-                
-                if cash_control:
-                    message_lines.append(f"🏦 رقم/اسم المحفظـة {cash_control}")
-                
-                if short_url:
-                    message_lines.append(f"🧾 الإيصـال {short_url}")
-                
-                if much or platform:
-                    line = ""
-                    if much:
-                        line += f"💎 الرصيــد {much}"
-                    if platform:
-                        if line:
-                            line += f" 💻 $ {platform}"
-                        else:
-                            line += f"💻 $ {platform}"
-                    message_lines.append(line)
-                
-                if redid:
-                    message_lines.append(f"🆔 {redid}")
-                
-                if note:
-                    message_lines.append(f"📝 {note}")
-                
-                # إضافة عنوان الرسالة في الأعلى
-                if message_lines:
-                    message_lines.insert(0, "📩 <b>طلب جديد</b>")
-                
-                # دمج كل الأسطر في رسالة واحدة
-                message = "\n".join(message_lines) if message_lines else "📩 <b>طلب جديد</b>"
+    except Exception as e:
+        logger.error("❌ Error in webhook: %s", e)
+        return {"status": "error", "message": str(e)}, 500
+
+def accept_order_payload(data, priority=DISPATCH_PRIORITY_LIVE):
+    """
+    التحقق من payload واحد بصيغة /webhook ووضعه في طابور الإرسال
+    ترجع (الرد، كود HTTP) وتستخدمها /webhook و /webhook/batch (بأولوية أقل)
+    """
+    if not isinstance(data, dict):
+        return {"status": "error", "message": "Payload must be a JSON object"}, 400
+
+    # استخراج البيانات الأساسية من الـ webhook
+    contact_id = data.get("contact_id", "")
+    channel = data.get("channel", "telegram")
+    scenario = data.get("scenario", "order")
+
+    if not contact_id:
+        logger.error("❌ No contact_id received in webhook")
+        return {"status": "error", "message": "No contact_id"}, 400
+
+    logger.info("📝 Processing scenario: %s, contact_id: %s", scenario, contact_id)
+
+    key = sendpulse_idempotency_key(data)
+
+    def dispatch():
+        message = build_scenario_message(data, scenario)
+
+        # ⚡ **الإرسال إلى تليجرام يتم في الخلفية والرد على SendPulse فوراً**
+        job = enqueue_scenario_message(message, contact_id, channel, scenario, key, priority)
+        if not job:
+            return {"status": "error", "message": "Dispatch queue is full"}, 503
+
+        return {"status": "queued", "job_id": job['job_id']}, 202
+
+    # إعادة إرسال نفس الطلب ترجع نفس job_id بدون رسالة ثانية في الجروب
+    return run_idempotent(key, dispatch,
+                          ({"status": "queued", "job_id": None}, 202))
+
+# =============================
+# 28. استقبال دفعة طلبات مرة واحدة (SendPulse flows وسكربتات الاسترجاع)
+# =============================
+# أقصى عدد طلبات في الدفعة الواحدة (يجب ألا يتجاوز DISPATCH_BATCH_QUEUE_MAX)
+WEBHOOK_BATCH_MAX = int(os.getenv("WEBHOOK_BATCH_MAX", 500))
+# أقصى مدة انتظار يمكن طلبها بـ ?wait= قبل الرد (الافتراضي بدون انتظار: الجروب يستقبل ~20 رسالة/دقيقة فقط
+# وانتظار الدفعة كاملة يحجز الـ worker عن طلبات /webhook المباشرة)
+WEBHOOK_BATCH_MAX_WAIT_SECONDS = float(os.getenv("WEBHOOK_BATCH_MAX_WAIT_SECONDS", 5))
+
+@app.route("/webhook/batch", methods=["POST"])
+def webhook_batch():
+    """
+    يقبل مصفوفة payloads بنفس صيغة /webhook (أو {"orders": [...]})
+    كل الطلبات تدخل طابور الإرسال مرة واحدة بأولوية أقل من /webhook فترسلها الـ workers بالتوازي حسب حدود تليجرام،
+    والرد 202 فوراً بنتيجة كل طلب بنفس الترتيب مع job_id (و message_id لاحقاً من /jobs/<job_id>)
+    ?wait=N ينتظر حتى N ثانية (بحد أقصى WEBHOOK_BATCH_MAX_WAIT_SECONDS) لإرجاع message_id للطلبات التي أُرسلت
+    """
+    try:
+        data = request.get_json(silent=True)
+        items = data.get("orders") if isinstance(data, dict) else data
+        if not isinstance(items, list) or not items:
+            return {"status": "error", "message": "Expected a non-empty JSON array of orders"}, 400
+        if len(items) > WEBHOOK_BATCH_MAX:
+            return {"status": "error", "message": f"Batch too large (max {WEBHOOK_BATCH_MAX})"}, 413
+
+        logger.info("📦 Received webhook batch of %s orders", len(items))
+
+        results = []
+        jobs = []
+        for index, item in enumerate(items):
+            try:
+                response, status = accept_order_payload(item, DISPATCH_PRIORITY_BATCH)
+            except Exception as e:
+                logger.error("❌ Error in webhook batch item %s: %s", index, e)
+                response, status = {"status": "error", "message": str(e)}, 500
+
+            result = {"index": index, "http_status": status, "status": response.get("status")}
+            if response.get("message"):
+                result["message"] = response["message"]
+            job_id = response.get("job_id")
+            with dispatch_jobs_lock:
+                job = dispatch_jobs.get(job_id) if job_id else None
+            if job:
+                jobs.append((result, job))
+            elif status < 300:
+                # نسخة مكررة لطلب ما زال قيد المعالجة
+                result["status"] = "duplicate"
+            results.append(result)
+
+        wait_seconds = min(max(request.args.get("wait", 0, type=float), 0), WEBHOOK_BATCH_MAX_WAIT_SECONDS)
+        deadline = time.monotonic() + wait_seconds
+        for result, job in jobs:
+            if wait_seconds:
+                job['done'].wait(max(0, deadline - time.monotonic()))
+            result.update(job_id=job['job_id'], status=job['status'], message_id=job['message_id'])
+
+        summary = {}
+        for result in results:
+            summary[result["status"]] = summary.get(result["status"], 0) + 1
+        logger.info("📦 Webhook batch accepted: %s", summary)
+        return {"status": "ok", "summary": summary, "results": results}, 202
 
-            # إرسال رسالة الطلب الجديد (بجميع الأزرار)
-            success = send_scenario_message_to_telegram(message, contact_id, channel, scenario)
-            logger.info(f"📨 New order processed for contact: {contact_id}")
-        
-        if success:
-            return {"status": "ok"}, 200
-        else:
-            return {"status": "error", "message": "Failed to send to Telegram"}, 500
-            
     except Exception as e:
-        logger.error(f"❌ Error in webhook: {e}")
+        logger.error("❌ Error in webhook batch: %s", e)
         return {"status": "error", "message": str(e)}, 500
 
+# =============================
+# 29. الاستعلام عن حالة مهمة إرسال
+# =============================
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    with dispatch_jobs_lock:
+        job = dispatch_jobs.get(job_id)
+        if not job and job_id in dispatch_dead_letters:
+            job = dispatch_dead_letters[job_id][0]
+    if not job:
+        return {"status": "error", "message": "Job not found"}, 404
+    return {"status": "ok", "job": dispatch_job_info(job)}
+
+@app.route("/jobs/failed")
+def failed_jobs():
+    # الرسائل التي لم تصل للجروب بعد كل المحاولات
+    with dispatch_jobs_lock:
+        jobs = [dispatch_job_info(job) for job, message in dispatch_dead_letters.values()]
+    return {"status": "ok", "count": len(jobs), "jobs": jobs}
+
+@app.route("/jobs/failed/retry", methods=["POST"])
+def retry_failed_jobs():
+    # إعادة إرسال كل الرسائل الفاشلة أو المحددة في {"job_ids": [...]}
+    data = request.get_json(silent=True) or {}
+    requeued = retry_dead_letters(data.get("job_ids"))
+    return {"status": "ok", "requeued": requeued}
+
         # =============================
-# 17. استقبال ضغط الأزرار + الصور من التليجرام
+# 30. تقديم صور الدعم الفني بروابط موقّعة
+# =============================
+@app.route("/photos/<photo_id>.jpg")
+def serve_photo(photo_id):
+    if not verify_photo_signature(photo_id, request.args.get("exp"), request.args.get("sig")):
+        return {"status": "error", "message": "Invalid or expired link"}, 403
+
+    cached = get_photo_cache().get(photo_id)
+    if not cached:
+        return {"status": "error", "message": "Photo not found"}, 404
+
+    data, close = cached
+    if close is None:
+        response = app.response_class(data, mimetype="image/jpeg")
+    else:
+        # قراءة الملف من الـ mmap على دفعات ثم إغلاقه بعد انتهاء الإرسال
+        def stream():
+            try:
+                for offset in range(0, len(data), PHOTO_STREAM_CHUNK_SIZE):
+                    yield data[offset:offset + PHOTO_STREAM_CHUNK_SIZE]
+            finally:
+                close()
+        response = app.response_class(stream(), mimetype="image/jpeg")
+        response.headers["Content-Length"] = str(len(data))
+    response.headers["Cache-Control"] = "private, max-age=300"
+    return response
+
 # =============================
+# 31. استقبال ضغط الأزرار + الصور من التليجرام
+# =============================
+# تليجرام ينفذ طلب Bot API واحد موجود في رد الـ webhook: نستخدمه لـ answerCallbackQuery بدلاً من اتصال منفصل
+TELEGRAM_WEBHOOK_REPLY = os.getenv("TELEGRAM_WEBHOOK_REPLY", "true").lower() in ("1", "true", "yes")
+# عدد الـ threads التي تنفذ إجراءات الأزرار بعد الرد الفوري على تليجرام
+CALLBACK_WORKERS = int(os.getenv("CALLBACK_WORKERS", 8))
+
+callback_executor = None
+callback_executor_pid = None
+
+def get_callback_executor():
+    # executor منفصل عن fan_out لأن الإجراءات نفسها تستخدم fan_out (executor لكل process كما في get_fanout_executor)
+    global callback_executor, callback_executor_pid
+    if callback_executor_pid != os.getpid():
+        with fanout_lock:
+            if callback_executor_pid != os.getpid():
+                callback_executor = ThreadPoolExecutor(max_workers=CALLBACK_WORKERS, thread_name_prefix="callback")
+                callback_executor_pid = os.getpid()
+    return callback_executor
+
 @app.route("/telegram", methods=["POST"])
 def telegram_webhook():
+    data = request.get_json(silent=True)
+    update_id = data.get("update_id") if isinstance(data, dict) else None
+    # تليجرام يعيد إرسال نفس update_id إذا تأخر الرد
+    key = f"tg:{update_id}" if update_id is not None else None
+    return run_idempotent(key, lambda: handle_telegram_update(data, TELEGRAM_WEBHOOK_REPLY), ({"status": "ok"}, 200))
+
+def handle_telegram_update(data, inline_reply=False):
+    """
+    inline_reply: الرد على الـ callback داخل رد الـ webhook نفسه وتنفيذ الإجراء في الخلفية (فقط عند الاستقبال عبر /telegram)
+    """
     try:
         token = os.getenv("TELEGRAM_TOKEN")
         group_id = os.getenv("GROUP_ID")
@@ -874,8 +3216,7 @@ def telegram_webhook():
             logger.error("❌ TELEGRAM_TOKEN not set")
             return {"status": "error"}, 500
 
-        data = request.get_json()
-        logger.info(f"📨 Received Telegram update")
+        logger.info("📨 Received Telegram update")
 
         if not data:
             return {"status": "ok"}, 200
@@ -884,139 +3225,32 @@ def telegram_webhook():
         if "callback_query" in data:
             callback = data["callback_query"]
             query_id = callback["id"]
-            chat_id = callback["message"]["chat"]["id"]
-            message_id = callback["message"]["message_id"]
-            callback_data = callback["data"]
 
-            logger.info(f"🔄 Callback received: {callback_data} from chat {chat_id}")
+            logger.info("🔄 Callback received: %s from chat %s", callback["data"], callback["message"]["chat"]["id"])
 
-            # الرد على callback query لإزالة "Loading" من الزر
-            requests.post(
-                f"https://api.telegram.org/bot{token}/answerCallbackQuery",
-                json={"callback_query_id": query_id},
-                timeout=30
-            )
+            if inline_reply:
+                # الرد على callback query يرجع فوراً في رد الـ webhook بدون اتصال خارجي لإزالة "Loading" من الزر،
+                # والإجراء نفسه يتم في الخلفية حتى لا ينتظر الرد أبطأ اتصال
+                get_callback_executor().submit(handle_callback_in_background, callback)
+                return {"method": "answerCallbackQuery", "callback_query_id": query_id}, 200
 
-            # تقسيم callback_data إلى أجزاء: action, contact_id, channel, scenario
-            parts = callback_data.split(':')
-            action = parts[0]
-            contact_id = parts[1]
-            channel = parts[2] if len(parts) > 2 else 'telegram'
-            scenario = parts[3] if len(parts) > 3 else 'order'
-
-            # معالجة الإجراءات المختلفة
-            if action == "done":
-                send_to_client(contact_id, "✅ تم تنفيذ طلبك بنجاح", channel)
-                new_text = f"✅ تم تنفيذ الطلب بنجاح"
-                
-                # تعديل الرسالة الأصلية في الجروب
-                edit_url = f"https://api.telegram.org/bot{token}/editMessageText"
-                edit_payload = {
-                    "chat_id": chat_id,
-                    "message_id": message_id,
-                    "text": new_text,
-                    "parse_mode": "HTML"
-                }
-                edit_response = requests.post(edit_url, json=edit_payload, timeout=30)
-                
-                if edit_response.status_code == 200:
-                    # مسح رسالة التأكيد بعد 5 ثواني
-                    delete_message_after_delay(chat_id, message_id, 5)
-                    logger.info(f"🗑️ Success message scheduled for deletion: {message_id}")
-                    
-                    # مسح رسالة الطلب من الذاكرة
-                    if contact_id in client_messages and scenario in client_messages[contact_id]:
-                        del client_messages[contact_id][scenario]
-                        if not client_messages[contact_id]:
-                            del client_messages[contact_id]
-                        logger.info(f"🧹 Removed {scenario} message from memory for contact: {contact_id}")
-                else:
-                    logger.error(f"❌ Failed to edit message")
-                
-            elif action == "cancel":
-                send_to_client(contact_id, "❌ تم إلغاء طلبك.", channel)
-                new_text = f"❌ تم إلغاء الطلب"
-                
-                # تعديل الرسالة الأصلية في الجروب
-                edit_url = f"https://api.telegram.org/bot{token}/editMessageText"
-                edit_payload = {
-                    "chat_id": chat_id,
-                    "message_id": message_id,
-                    "text": new_text,
-                    "parse_mode": "HTML"
-                }
-                edit_response = requests.post(edit_url, json=edit_payload, timeout=30)
-                
-                if edit_response.status_code == 200:
-                    # مسح رسالة التأكيد بعد 5 ثواني
-                    delete_message_after_delay(chat_id, message_id, 5)
-                    logger.info(f"🗑️ Cancel message scheduled for deletion: {message_id}")
-                    
-                    # مسح رسالة الطلب من الذاكرة
-                    if contact_id in client_messages and scenario in client_messages[contact_id]:
-                        del client_messages[contact_id][scenario]
-                        if not client_messages[contact_id]:
-                            del client_messages[contact_id]
-                        logger.info(f"🧹 Removed {scenario} message from memory for contact: {contact_id}")
-                else:
-                    logger.error(f"❌ Failed to edit message")
-                
-            elif action == "sendpic":
-                # حفظ معرف الرسالة الحالية (التي تحتوي على طلب رفع الصورة)
-                pending_photos[str(chat_id)] = {
-                    'contact_id': contact_id,
-                    'channel': channel,
-                    'scenario': scenario,
-                    'request_message_id': message_id  # حفظ معرف الرسالة التي تطلب الصورة
-                }
-                new_text = f"📷 من فضلك ارفع صورة في الجروب وسأقوم بإرسالها للعميل"
-                
-                # تعديل الرسالة الأصلية في الجروب
-                edit_url = f"https://api.telegram.org/bot{token}/editMessageText"
-                edit_payload = {
-                    "chat_id": chat_id,
-                    "message_id": message_id,
-                    "text": new_text,
-                    "parse_mode": "HTML"
-                }
-                edit_response = requests.post(edit_url, json=edit_payload, timeout=30)
-                
-                if edit_response.status_code != 200:
-                    logger.error(f"❌ Failed to edit message")
+            # الرد على callback query بالتوازي مع تنفيذ الإجراء
+            answered = []
 
-            elif action in ["transfer_minus", "transfer_plus"]:
-                # تحديد نوع الرسالة بناءً على نوع التحويل
-                flow_type = action
-                flow_name = "تحويل ناقص" if flow_type == "transfer_minus" else "تحويل زائد"
-                
-                # تشغيل Flow المناسب
-                success = run_flow(contact_id, channel, flow_type)
-                if success:
-                    confirmation_message = f"🔄 تم {flow_name} للطلب بنجاح"
-                    send_to_client(contact_id, f"🔄 تم {flow_name} لطلبك وسيتم متابعته من قبل الفريق المختص", channel)
-                else:
-                    confirmation_message = f"❌ فشل {flow_name} للطلب"
-                
-                # إرسال رسالة تأكيد منفصلة
-                confirmation_response = requests.post(
-                    f"https://api.telegram.org/bot{token}/sendMessage",
-                    json={
-                        "chat_id": chat_id,
-                        "text": confirmation_message,
-                        "parse_mode": "HTML"
-                    },
-                    timeout=30
-                )
-                
-                if confirmation_response.status_code == 200:
-                    confirmation_data = confirmation_response.json()
-                    confirmation_message_id = confirmation_data['result']['message_id']
-                    
-                    # مسح رسالة التأكيد بعد 5 ثواني
-                    delete_message_after_delay(chat_id, confirmation_message_id, 5)
-                    logger.info(f"🗑️ {flow_name} confirmation message scheduled for deletion: {confirmation_message_id}")
-                else:
-                    logger.error(f"❌ Failed to send confirmation message")
+            def answer_callback():
+                answered.append(query_id)
+                return telegram_client.post("answerCallbackQuery", {"callback_query_id": query_id})
+
+            try:
+                handle_callback_query(callback, answer_callback)
+            except Exception:
+                # الرد على الزر حتى عند الفشل حتى لا يبقى "Loading" ظاهراً
+                if not answered:
+                    try:
+                        answer_callback()
+                    except Exception as e:
+                        logger.error("❌ Error answering callback query: %s", e)
+                raise
 
         # التعامل مع الصور
         elif "message" in data and "photo" in data["message"]:
@@ -1024,10 +3258,10 @@ def telegram_webhook():
             chat_id = message_data["chat"]["id"]
             message_id = message_data["message_id"]  # معرف رسالة الصورة المرسلة
 
-            logger.info(f"🖼️ Photo received in chat {chat_id}")
+            logger.info("🖼️ Photo received in chat %s", chat_id)
 
-            if str(chat_id) in pending_photos:
-                pending_data = pending_photos.pop(str(chat_id))
+            pending_data = state_store.pop_pending_photo(str(chat_id))
+            if pending_data:
                 contact_id = pending_data['contact_id']
                 channel = pending_data['channel']
                 scenario = pending_data['scenario']
@@ -1037,22 +3271,21 @@ def telegram_webhook():
                 photo = message_data["photo"][-1]
                 file_id = photo["file_id"]
 
-                logger.info(f"🔄 Processing photo for contact {contact_id} on channel {channel}, scenario: {scenario}")
+                logger.info("🔄 Processing photo for contact %s on channel %s, scenario: %s", contact_id, channel, scenario)
 
                 # الحصول على معلومات الملف
-                file_info_url = f"https://api.telegram.org/bot{token}/getFile?file_id={file_id}"
-                file_info_response = requests.get(file_info_url, timeout=30)
+                file_info_response = telegram_client.get("getFile", {"file_id": file_id})
                 
                 if file_info_response.status_code == 200:
                     file_info = file_info_response.json()
                     if file_info.get("ok"):
                         file_path = file_info["result"]["file_path"]
-                        file_url = f"https://api.telegram.org/file/bot{token}/{file_path}"
+                        file_url = telegram_client.file_url(file_path)
 
-                        logger.info(f"📎 Telegram file URL: {file_url}")
+                        logger.info("📎 Telegram file path: %s", file_path)
                         
-                        # 1. تحميل الصورة وإنشاء رابط مؤقت
-                        temp_photo_url = download_and_create_temp_url(file_url, token, contact_id)
+                        # 1. تحميل الصورة وإنشاء رابط مؤقت (من OrderTaker نفسه أو خدمة الرفع)
+                        temp_photo_url = create_photo_url(file_url, contact_id)
                         
                         if temp_photo_url:
                             # 2. إرسال الصورة باستخدام الرابط المؤقت
@@ -1063,20 +3296,16 @@ def telegram_webhook():
                                 
                                 # مسح رسالة طلب الصورة (إذا كانت موجودة)
                                 if request_message_id:
-                                    delete_telegram_message(chat_id, request_message_id)
+                                    queue_message_deletion(chat_id, request_message_id)
                                 
                                 # مسح الصورة المرسلة في الجروب
-                                delete_telegram_message(chat_id, message_id)
+                                queue_message_deletion(chat_id, message_id)
                                 
                                 # 4. إرسال رسالة تأكيد في الجروب
-                                confirmation_response = requests.post(
-                                    f"https://api.telegram.org/bot{token}/sendMessage",
-                                    json={
-                                        "chat_id": chat_id,
-                                        "text": f"✅ تم إرسال الصورة للعميل بنجاح"
-                                    },
-                                    timeout=30
-                                )
+                                confirmation_response = telegram_client.post("sendMessage", {
+                                    "chat_id": chat_id,
+                                    "text": f"✅ تم إرسال الصورة للعميل بنجاح"
+                                })
                                 
                                 if confirmation_response.status_code == 200:
                                     confirmation_data = confirmation_response.json()
@@ -1085,24 +3314,239 @@ def telegram_webhook():
                                     # مسح رسالة التأكيد بعد 5 ثواني
                                     delete_message_after_delay(chat_id, confirmation_message_id, 5)
                                 
-                                logger.info(f"✅ Photo sent successfully to client {contact_id} on channel {channel}")
+                                logger.info("✅ Photo sent successfully to client %s on channel %s", contact_id, channel)
                             else:
-                                logger.error(f"❌ Failed to send photo to client {contact_id} on channel {channel}")
+                                logger.error("❌ Failed to send photo to client %s on channel %s", contact_id, channel)
                                 # إذا فشل إرسال الصورة، نرسل الرابط كبديل
                                 send_to_client(contact_id, f"📸 صورة من الدعم الفني: {temp_photo_url}", channel)
                         else:
                             logger.error("❌ Failed to create temporary photo URL")
-                            # إذا فشل إنشاء الرابط المؤقت، نرسل الرابط الأصلي
-                            send_to_client(contact_id, f"📸 صورة من الدعم الفني: {file_url}", channel)
+                            # لا نرسل رابط Telegram الأصلي للعميل لأنه يحتوي على توكن البوت
+                            telegram_client.post("sendMessage", {
+                                "chat_id": chat_id,
+                                "text": f"❌ فشل تجهيز الصورة للعميل، من فضلك حاول مرة أخرى"
+                            })
 
         return {"status": "ok"}, 200
         
     except Exception as e:
-        logger.error(f"❌ Error in Telegram webhook: {e}")
+        logger.error("❌ Error in Telegram webhook: %s", e)
         return {"status": "error", "message": str(e)}, 500
 
+def handle_callback_query(callback, answer_callback=None):
+    """
+    تنفيذ إجراء الزر (تعديل رسالة الجروب، إبلاغ العميل، تشغيل flow)
+    answer_callback: دالة الرد على الـ callback لتعمل بالتوازي مع الإجراء، أو None إذا تم الرد مسبقاً
+    """
+    chat_id = callback["message"]["chat"]["id"]
+    message_id = callback["message"]["message_id"]
+    callback_data = callback["data"]
+
+    # تقسيم callback_data إلى أجزاء: action, contact_id, channel, scenario
+    parts = callback_data.split(':')
+    action = parts[0]
+    contact_id = parts[1]
+    channel = parts[2] if len(parts) > 2 else 'telegram'
+    scenario = parts[3] if len(parts) > 3 else 'order'
+
+    # معالجة الإجراءات المختلفة
+    if action == "done":
+        new_text = f"✅ تم تنفيذ الطلب بنجاح"
+
+        # تعديل الرسالة الأصلية في الجروب
+        edit_payload = {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "text": new_text,
+            "parse_mode": "HTML"
+        }
+        # إبلاغ العميل وتعديل رسالة الجروب مستقلان: زمن الضغطة = أبطأ اتصال وليس مجموعهم
+        _, _, edit_response = fan_out(
+            answer_callback,
+            lambda: send_to_client(contact_id, "✅ تم تنفيذ طلبك بنجاح", channel),
+            lambda: telegram_client.post("editMessageText", edit_payload)
+        )
+
+        if edit_response.status_code == 200:
+            # مسح رسالة التأكيد بعد 5 ثواني
+            delete_message_after_delay(chat_id, message_id, 5)
+            logger.info("🗑️ Success message scheduled for deletion: %s", message_id)
+
+            # مسح رسالة الطلب من الذاكرة
+            if state_store.remove_message(contact_id, scenario):
+                logger.info("🧹 Removed %s message from memory for contact: %s", scenario, contact_id)
+        else:
+            logger.error("❌ Failed to edit message")
+
+    elif action == "cancel":
+        new_text = f"❌ تم إلغاء الطلب"
+
+        # تعديل الرسالة الأصلية في الجروب
+        edit_payload = {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "text": new_text,
+            "parse_mode": "HTML"
+        }
+        # إبلاغ العميل وتعديل رسالة الجروب مستقلان: زمن الضغطة = أبطأ اتصال وليس مجموعهم
+        _, _, edit_response = fan_out(
+            answer_callback,
+            lambda: send_to_client(contact_id, "❌ تم إلغاء طلبك.", channel),
+            lambda: telegram_client.post("editMessageText", edit_payload)
+        )
+
+        if edit_response.status_code == 200:
+            # مسح رسالة التأكيد بعد 5 ثواني
+            delete_message_after_delay(chat_id, message_id, 5)
+            logger.info("🗑️ Cancel message scheduled for deletion: %s", message_id)
+
+            # مسح رسالة الطلب من الذاكرة
+            if state_store.remove_message(contact_id, scenario):
+                logger.info("🧹 Removed %s message from memory for contact: %s", scenario, contact_id)
+        else:
+            logger.error("❌ Failed to edit message")
+
+    elif action == "sendpic":
+        # حفظ معرف الرسالة الحالية (التي تحتوي على طلب رفع الصورة)
+        state_store.set_pending_photo(str(chat_id), {
+            'contact_id': contact_id,
+            'channel': channel,
+            'scenario': scenario,
+            'request_message_id': message_id  # حفظ معرف الرسالة التي تطلب الصورة
+        })
+        new_text = f"📷 من فضلك ارفع صورة في الجروب وسأقوم بإرسالها للعميل"
+
+        # تعديل الرسالة الأصلية في الجروب
+        edit_payload = {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "text": new_text,
+            "parse_mode": "HTML"
+        }
+        _, edit_response = fan_out(answer_callback, lambda: telegram_client.post("editMessageText", edit_payload))
+
+        if edit_response.status_code != 200:
+            logger.error("❌ Failed to edit message")
+
+    elif action in ["transfer_minus", "transfer_plus"]:
+        # تحديد نوع الرسالة بناءً على نوع التحويل
+        flow_type = action
+        flow_name = "تحويل ناقص" if flow_type == "transfer_minus" else "تحويل زائد"
+
+        # تشغيل Flow المناسب
+        _, success = fan_out(answer_callback, lambda: run_flow(contact_id, channel, flow_type))
+        notify_client = None
+        if success:
+            confirmation_message = f"🔄 تم {flow_name} للطلب بنجاح"
+            notify_client = lambda: send_to_client(contact_id, f"🔄 تم {flow_name} لطلبك وسيتم متابعته من قبل الفريق المختص", channel)
+        else:
+            confirmation_message = f"❌ فشل {flow_name} للطلب"
+
+        # إرسال رسالة تأكيد منفصلة (بالتوازي مع إبلاغ العميل)
+        confirmation_response = fan_out(lambda: telegram_client.post("sendMessage", {
+            "chat_id": chat_id,
+            "text": confirmation_message,
+            "parse_mode": "HTML"
+        }), notify_client)[0]
+
+        if confirmation_response.status_code == 200:
+            confirmation_data = confirmation_response.json()
+            confirmation_message_id = confirmation_data['result']['message_id']
+
+            # مسح رسالة التأكيد بعد 5 ثواني
+            delete_message_after_delay(chat_id, confirmation_message_id, 5)
+            logger.info("🗑️ %s confirmation message scheduled for deletion: %s", flow_name, confirmation_message_id)
+        else:
+            logger.error("❌ Failed to send confirmation message")
+
+    elif answer_callback:
+        answer_callback()
+
+def handle_callback_in_background(callback):
+    # يعمل على callback executor بعد إرجاع answerCallbackQuery في رد الـ webhook
+    try:
+        handle_callback_query(callback)
+    except Exception as e:
+        logger.error("❌ Error handling callback %s: %s", callback.get("data"), e)
+
+# =============================
+# 32. استقبال التحديثات بـ long polling (بديل عن /telegram webhook)
+# =============================
+# TELEGRAM_MODE=polling يسحب التحديثات بـ getUpdates على دفعات (لا يحتاج رابط عام)
+# يعمل في الـ leader فقط لأن تليجرام يرفض أكثر من getUpdates في نفس الوقت
+TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "webhook").lower()
+TELEGRAM_POLL_TIMEOUT = int(os.getenv("TELEGRAM_POLL_TIMEOUT", 30))
+TELEGRAM_POLL_LIMIT = int(os.getenv("TELEGRAM_POLL_LIMIT", 100))
+# عدد المحادثات التي تتم معالجتها في نفس الوقت من كل دفعة
+TELEGRAM_POLL_WORKERS = int(os.getenv("TELEGRAM_POLL_WORKERS", 8))
+
+def telegram_update_chat_id(update):
+    if "callback_query" in update:
+        return update["callback_query"].get("message", {}).get("chat", {}).get("id")
+    return update.get("message", {}).get("chat", {}).get("id")
+
+def process_telegram_updates(updates, executor):
+    """
+    معالجة دفعة تحديثات: المحادثات المختلفة بالتوازي وتحديثات نفس المحادثة بالترتيب
+    ترجع بعد انتهاء الدفعة كلها حتى لا يسبق تحديث لاحق تحديثاً سابقاً لنفس المحادثة
+    """
+    by_chat = OrderedDict()
+    for update in updates:
+        by_chat.setdefault(telegram_update_chat_id(update), []).append(update)
+
+    def process_chat(chat_updates):
+        for update in chat_updates:
+            try:
+                run_idempotent(f"tg:{update['update_id']}", lambda: handle_telegram_update(update),
+                               ({"status": "ok"}, 200))
+            except Exception as e:
+                logger.error("❌ Error processing Telegram update %s: %s", update.get('update_id'), e)
+
+    futures = [executor.submit(process_chat, chat_updates) for chat_updates in by_chat.values()]
+    for future in futures:
+        future.result()
+
+def telegram_polling_loop():
+    logger.info("🔄 Starting Telegram long polling loop...")
+    # getUpdates لا يعمل مع webhook مفعّل
+    try:
+        telegram_client.get("deleteWebhook")
+    except Exception as e:
+        logger.error("❌ Error deleting webhook before polling: %s", e)
+
+    executor = ThreadPoolExecutor(max_workers=TELEGRAM_POLL_WORKERS, thread_name_prefix="telegram-poll")
+    offset = None
+    while True:
+        try:
+            params = {"timeout": TELEGRAM_POLL_TIMEOUT, "limit": TELEGRAM_POLL_LIMIT,
+                      "allowed_updates": '["message","callback_query"]'}
+            if offset is not None:
+                params["offset"] = offset
+            response = telegram_client.get("getUpdates", params,
+                                           timeout=(HTTP_CONNECT_TIMEOUT, TELEGRAM_POLL_TIMEOUT + HTTP_READ_TIMEOUT))
+            result = response.json()
+            if not result.get("ok"):
+                logger.error("❌ getUpdates failed: %s", response.text)
+                time.sleep(5)
+                continue
+
+            updates = result.get("result", [])
+            if updates:
+                logger.info("📨 Received %s Telegram updates", len(updates))
+                process_telegram_updates(updates, executor)
+                offset = updates[-1]["update_id"] + 1
+        except Exception as e:
+            logger.error("❌ Error in Telegram polling loop: %s", e)
+            time.sleep(5)
+
+def start_telegram_polling():
+    thread = threading.Thread(target=telegram_polling_loop, name="telegram-poller")
+    thread.daemon = True
+    thread.start()
+    logger.info("✅ Telegram long polling started")
+
 # =============================
-# 18. صفحات التحقق
+# 33. صفحات التحقق
 # =============================
 @app.route("/")
 def home():
@@ -1110,15 +3554,20 @@ def home():
         "status": "running",
         "service": "OrderTaker - Multi-Channel Telegram Bot Webhook",
         "timestamp": time.time(),
-        "active_orders": len(client_messages)
+        "active_orders": state_store.count()
     }
 
 @app.route("/health")
 def health():
-    return {"status": "healthy", "timestamp": time.time(), "active_orders": len(client_messages)}, 200
+    circuits = {host: breaker.state for host, breaker in list(circuit_breakers.items())}
+    return {"status": "healthy", "timestamp": time.time(), "active_orders": state_store.count(), "circuits": circuits}, 200
+
+@app.route("/scheduler_status")
+def scheduler_status_page():
+    return {"status": "ok", "scheduler": scheduler_status()}, 200
 
 # =============================
-# 19. إعداد Webhook للتليجرام
+# 34. إعداد Webhook للتليجرام
 # =============================
 @app.route("/set_webhook")
 def set_webhook():
@@ -1129,17 +3578,16 @@ def set_webhook():
         if not webhook_url:
             return {"error": "RAILWAY_STATIC_URL not set"}, 400
         
-        url = f"https://api.telegram.org/bot{token}/setWebhook?url={webhook_url}/telegram"
-        response = requests.get(url, timeout=30)
+        response = telegram_client.get("setWebhook", {"url": f"{webhook_url}/telegram"})
         result = response.json()
-        logger.info(f"✅ Webhook set: {result}")
+        logger.info("✅ Webhook set: %s", result)
         return result
     except Exception as e:
-        logger.error(f"❌ Error setting webhook: {e}")
+        logger.error("❌ Error setting webhook: %s", e)
         return {"error": str(e)}, 500
 
 # =============================
-# 20. صفحة لعرض الطلبات النشطة
+# 35. صفحة لعرض الطلبات النشطة
 # =============================
 @app.route("/active_orders")
 def active_orders():
@@ -1147,7 +3595,7 @@ def active_orders():
         orders_info = []
         current_time = datetime.now()
         
-        for contact_id, scenarios in client_messages.items():
+        for contact_id, scenarios in state_store.all_contacts().items():
             if 'order' in scenarios:
                 order_data = scenarios['order']
                 time_diff = current_time - order_data['timestamp']
@@ -1157,7 +3605,7 @@ def active_orders():
                     'channel': order_data.get('channel', 'telegram'),
                     'timestamp': order_data['timestamp'].strftime('%Y-%m-%d %H:%M:%S'),
                     'minutes_passed': int(time_diff.total_seconds() / 60),
-                    'is_delayed': time_diff.total_seconds() > 300,
+                    'is_delayed': time_diff.total_seconds() > ORDER_DELAY_SECONDS,
                     'has_delay_alert': 'delay' in scenarios
                 })
         
@@ -1168,11 +3616,11 @@ def active_orders():
             "orders": orders_info
         }
     except Exception as e:
-        logger.error(f"❌ Error in active_orders: {e}")
+        logger.error("❌ Error in active_orders: %s", e)
         return {"status": "error", "message": str(e)}, 500
 
 # =============================
-# 21. صفحة لتفعيل التنبيهات يدوياً
+# 36. صفحة لتفعيل التنبيهات يدوياً
 # =============================
 @app.route("/trigger_check")
 def trigger_check():
@@ -1180,18 +3628,175 @@ def trigger_check():
         check_delayed_orders()
         return {"status": "ok", "message": "Delayed orders check triggered manually"}
     except Exception as e:
-        logger.error(f"❌ Error in trigger_check: {e}")
+        logger.error("❌ Error in trigger_check: %s", e)
         return {"status": "error", "message": str(e)}, 500
 
 # =============================
-# 22. بدء التطبيق
+# 37. مقاييس التشغيل بصيغة Prometheus
+# =============================
+register_metric(Gauge("ordertaker_active_contacts", "Contacts with tracked group messages", lambda: state_store.count()))
+register_metric(Gauge("ordertaker_pending_photos", "Support chats waiting for a photo", lambda: state_store.pending_photos_count()))
+register_metric(Gauge("ordertaker_dispatch_queue_depth", "Group messages waiting in the dispatch queue", lambda: dispatch_queue.qsize()))
+register_metric(Gauge("ordertaker_dispatch_retrying", "Group messages waiting for a retry after a failed send", lambda: len(dispatch_retry_scheduler.entries)))
+register_metric(Gauge("ordertaker_dispatch_failed_jobs", "Group messages that failed all attempts (see /jobs/failed)", lambda: len(dispatch_dead_letters)))
+register_metric(Gauge("ordertaker_log_records_dropped", "Log records dropped because the log queue was full", lambda: log_handler.dropped))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get("request_started")
+    if started is not None:
+        # نستخدم قالب الـ route وليس الرابط الفعلي حتى لا يكبر عدد الـ labels
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        http_request_duration.observe(time.perf_counter() - started, route)
+        http_requests_total.inc(route, request.method, response.status_code)
+    return response
+
+@app.route("/metrics")
+def metrics():
+    return app.response_class(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+# =============================
+# 38. تسجيل طلبات /webhook و /telegram لإعادة تشغيلها في اختبارات الحمل
+# =============================
+# اختياري: TRAFFIC_RECORD_PATH=/path/traffic.jsonl (سطر JSON لكل طلب مع الوقت)
+TRAFFIC_RECORD_PATH = os.getenv("TRAFFIC_RECORD_PATH", "")
+RECORDED_ROUTES = {"/webhook", "/telegram"}
+# حقول لا تحتوي بيانات شخصية وتحتاجها إعادة التشغيل كما هي
+TRAFFIC_PRESERVED_KEYS = {"scenario", "channel", "update_id", "message_id", "date", "parse_mode", "type",
+                          "file_size", "width", "height", "is_bot", "language_code", "ok"}
+# معرفات يتم استبدالها باسم مستعار ثابت (نفس القيمة → نفس الاسم المستعار في كل الطلبات)
+TRAFFIC_ID_KEYS = {"contact_id", "id", "chat_id", "file_id", "file_unique_id"}
+
+def traffic_vocabulary():
+    # الكلمات المفتاحية التي يعتمد عليها format_order_data وأسماء الأزرار تبقى كما هي
+    words = set()
+    for pattern_list in ORDER_FIELD_PATTERNS.values():
+        for pattern in pattern_list:
+            words.update(word.lower() for word in re.findall(r"\w+", pattern))
+    words.update(["order", "delay", "photo", "telegram", "messenger", "done", "cancel", "sendpic",
+                  "transfer_minus", "transfer_plus", "http", "https", "www", "com", "org", "url"])
+    return words
+
+class TrafficRecorder:
+    """
+    كتابة الطلبات في ملف JSON lines من thread في الخلفية
+    إخفاء البيانات الشخصية يتم في الـ thread أيضاً حتى لا يبطئ الرد على الطلب
+    """
+
+    def __init__(self, path, secret):
+        self.path = path
+        self.secret = secret
+        self.vocabulary = traffic_vocabulary()
+        self.pending = queue.SimpleQueue()
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def record(self, route, body):
+        # بعد fork في gunicorn يبدأ كل worker الـ thread الخاص به
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    thread = threading.Thread(target=self.writer_loop, name="traffic-recorder")
+                    thread.daemon = True
+                    thread.start()
+        self.pending.put((time.time(), route, body))
+
+    def pseudonym(self, value, digits=None):
+        digest = hmac.new(self.secret, str(value).encode("utf-8"), hashlib.sha256).hexdigest()
+        if digits is None:
+            return f"x{digest[:12]}"
+        return str(int(digest, 16))[:digits].rjust(digits, "1")
+
+    def redact_id(self, value):
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            return value
+        if isinstance(value, int):
+            # نحافظ على الإشارة وعدد الأرقام (معرفات الجروبات سالبة)
+            pseudo = int(self.pseudonym(abs(value), len(str(abs(value)))))
+            return -pseudo if value < 0 else pseudo
+        return self.pseudonym(value)
+
+    def redact_word(self, match):
+        word = match.group(0)
+        if word.isdigit():
+            return self.pseudonym(word, len(word))
+        if word.lower() in self.vocabulary:
+            return word
+        return self.pseudonym(word)
+
+    def redact_text(self, text):
+        return re.sub(r"\w+", self.redact_word, text)
+
+    def redact_callback_data(self, text):
+        # action:contact_id:channel:scenario
+        parts = text.split(":")
+        if len(parts) > 1:
+            parts[1] = self.redact_id(parts[1])
+        return ":".join(parts)
+
+    def redact(self, value, key=None):
+        if isinstance(value, dict):
+            return {k: self.redact(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.redact(item, key) for item in value]
+        if key in TRAFFIC_PRESERVED_KEYS:
+            return value
+        if key in TRAFFIC_ID_KEYS:
+            return self.redact_id(value)
+        if key == "data" and isinstance(value, str):
+            return self.redact_callback_data(value)
+        if isinstance(value, str):
+            return self.redact_text(value)
+        return value
+
+    def writer_loop(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        while True:
+            entries = [self.pending.get()]
+            while not self.pending.empty() and len(entries) < 500:
+                entries.append(self.pending.get())
+            lines = []
+            for recorded_at, route, body in entries:
+                try:
+                    lines.append(json_dumps({"t": round(recorded_at, 3), "route": route, "body": self.redact(body)}))
+                except Exception as e:
+                    logger.error("❌ Error recording %s request: %s", route, e)
+            if lines:
+                # كتابة واحدة بـ O_APPEND لكل دفعة حتى لا تتداخل أسطر الـ workers المختلفة
+                os.write(fd, ("\n".join(lines) + "\n").encode("utf-8"))
+
+traffic_recorder = None
+if TRAFFIC_RECORD_PATH:
+    traffic_secret = os.getenv("TRAFFIC_RECORD_SECRET") or f"traffic:{os.getenv('TELEGRAM_TOKEN')}"
+    traffic_recorder = TrafficRecorder(TRAFFIC_RECORD_PATH, hashlib.sha256(traffic_secret.encode()).digest())
+    logger.info("📼 Recording redacted webhook traffic to %s", TRAFFIC_RECORD_PATH)
+
+@app.before_request
+def record_traffic():
+    if traffic_recorder and request.path in RECORDED_ROUTES and request.method == "POST":
+        body = request.get_json(silent=True)
+        if body is not None:
+            traffic_recorder.record(request.path, body)
+
+# =============================
+# 39. بدء التطبيق
 # =============================
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
-    logger.info(f"🚀 Starting OrderTaker server on port {port}")
+    logger.info("🚀 Starting OrderTaker server on port %s", port)
     
-    # بدء نظام التحقق من الطلبات المتأخرة
-    start_delayed_orders_checker()
-    logger.info("✅ Delayed orders checker initialized")
+    # بدء نظام التحقق من الطلبات المتأخرة (و long polling إن كان مفعلاً)
+    start_background_services()
+    logger.info("✅ Background services initialized")
     
-    app.run(host="0.0.0.0", port=port, debug=False)
+    if SERVING_MODE == "async":
+        from gevent.pywsgi import WSGIServer
+        logger.info("⚡ Serving in async mode (gevent)")
+        WSGIServer(("0.0.0.0", port), app, log=None).serve_forever()
+    else:
+        app.run(host="0.0.0.0", port=port, debug=False)